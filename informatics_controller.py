@@ -1,5 +1,8 @@
 # informatics_controller.py
 
+import os
+import tempfile
+
 from modules.cheminformatics import Cheminformatics
 from modules.bioinformatics import Bioinformatics
 from modules.machine_learning import MachineLearning
@@ -14,6 +17,9 @@ from simulation.informatics_analysis import perform_gsea, logistic_regression
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
+# the .fai indexes of the FASTA files are kept here rather than next to the (example) data files
+FASTA_INDEX_DIR = os.path.join(tempfile.gettempdir(), 'informatics_fasta_index')
+
 class InformaticsController:
     """
     Informatics Controller Class
@@ -39,12 +45,16 @@ class InformaticsController:
     
     This information supports machine learning and cheminformatics analyses in the project.
     """
-    def __init__(self):
+    def __init__(self, index_dir=FASTA_INDEX_DIR):
         """
         Initializes the controller by creating instances of the relevant analysis modules.
+
+        Args:
+            index_dir (str): Directory to keep the .fai indexes of the FASTA files in.
         """
+        self.index_dir = index_dir
         self.cheminformatics = Cheminformatics()
-        self.bioinformatics = Bioinformatics()
+        self.bioinformatics = Bioinformatics(index_dir=index_dir)
         self.ml = MachineLearning()
         self.ipr_conn = IprConnection(username="user", password="pass", url="https://iprstaging-api.bcgsc.ca/api")  # Replace with real credentials
 
@@ -57,7 +67,8 @@ class InformaticsController:
         Args:
             molecule (str): Molecule identifier or data for cheminformatics analysis.
             fasta_file (str): Path to the FASTA file for bioinformatics analysis.
-            data (str): Data used for machine learning predictions (e.g., genomic features).
+            data (str): Data used for machine learning predictions, with the f0-f19 motif model features
+                (e.g., data/fake_data/motif_features.csv).
         
         Returns:
             dict: A dictionary containing the results of each analysis type.
@@ -90,7 +101,7 @@ class InformaticsController:
         # 2. Genome and Cancer Analysis
         print("Running Genome and Cancer Analysis...")
         load_chip_seq_data("data/fake_data/chip_seq_peaks.csv")
-        process_genomic_sequences("data/fake_data/genome.fa")
+        process_genomic_sequences("data/fake_data/genome.fa", index_dir=self.index_dir)
 
         X = pd.read_csv("data/fake_data/genomic_features.csv")
         y = pd.read_csv("data/fake_data/cancer_outcomes.csv")
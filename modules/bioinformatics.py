@@ -2,21 +2,36 @@
 
 from Bio import SeqIO
 
+from .fasta import IndexedFasta
+from .kmers import count_fasta_kmers
+from .twobit import GenomeStore, build_genome_store
+
 class Bioinformatics:
-    def __init__(self):
-        pass
+    def __init__(self, index_dir=None):
+        """
+        Args:
+            index_dir (str): Directory to keep the .fai indexes of the FASTA files in (see
+                fasta.index_path). Defaults to next to each FASTA file.
+        """
+        self.index_dir = index_dir
 
-    def analyze_genome(self, fasta_file):
+    def analyze_genome(self, fasta_file, metadata_only=False):
         """
         This function parses a FASTA file containing genomic sequences and extracts
         the ID and length of each sequence. It's useful in genome analysis workflows.
         
         Args:
             fasta_file (str): Path to the FASTA file containing genome sequences.
+            metadata_only (bool): Only return the ID and length of each sequence, read from the
+                .fai index of the file (built on first use) without loading any sequence.
         
         Returns:
             List[Dict]: A list of dictionaries containing sequence data (ID, length, sequence).
         """
+        if metadata_only:
+            with IndexedFasta(fasta_file, index_dir=self.index_dir) as fasta:
+                return [{"id": entry.name, "length": entry.length} for entry in fasta]
+
         sequence_data = []
         for record in SeqIO.parse(fasta_file, "fasta"):
             print(f"ID: {record.id}, Sequence Length: {len(record.seq)}")
@@ -27,3 +42,68 @@ class Bioinformatics:
             })
         return sequence_data
 
+    def fetch_region(self, fasta_file, chrom, start, end):
+        """
+        Read the bases [start, end) (0-based) of a sequence through the .fai index of the file,
+        reading only the bytes of the region.
+        
+        Args:
+            fasta_file (str): Path to the FASTA file containing genome sequences.
+            chrom (str): ID of the sequence.
+            start (int): Start of the region.
+            end (int): End of the region (exclusive).
+        
+        Returns:
+            str: The bases of the region.
+        """
+        with IndexedFasta(fasta_file, index_dir=self.index_dir) as fasta:
+            return fasta.fetch(chrom, start, end).decode('ascii')
+
+    def build_genome_store(self, fasta_file, store_dir):
+        """
+        Convert a FASTA file into a 2-bit packed genome store (see twobit.build_genome_store),
+        about a quarter of the size of the FASTA file.
+        
+        Args:
+            fasta_file (str): Path to the FASTA file containing genome sequences.
+            store_dir (str): Directory to write the store to.
+        
+        Returns:
+            GenomeStore: The memory-mapped store.
+        """
+        return GenomeStore.open(build_genome_store(fasta_file, store_dir, index_dir=self.index_dir))
+
+    def extract_regions(self, store_dir, chroms, starts, ends):
+        """
+        Extract many regions [start, end) (0-based) from a genome store at once.
+        
+        Args:
+            store_dir (str): Directory of the genome store.
+            chroms (Iterable[str]): Sequence of each region.
+            starts (Iterable[int]): Start of each region.
+            ends (Iterable[int]): End of each region (exclusive).
+        
+        Returns:
+            Tuple[ndarray, ndarray]: The uint8 base codes (A=0, C=1, G=2, T=3, N=4) of every region
+            concatenated, and the offset of each region in them.
+        """
+        return GenomeStore.open(store_dir).extract_regions(chroms, starts, ends)
+
+    def count_kmers(self, fasta_file, k=5, window=None, step=None, kmers=None, workers=None):
+        """
+        Count the k-mers of each sequence (or of each window of each sequence) of a FASTA file with
+        2-bit rolling hashes (see kmers.count_fasta_kmers). The counts are not the f0-f19 features
+        the motif models take.
+        
+        Args:
+            fasta_file (str): Path to the FASTA file containing genome sequences.
+            k (int): Length of the k-mers.
+            window (int): Length of the windows counted separately (defaults to whole sequences).
+            step (int): Distance between the starts of consecutive windows (defaults to window).
+            kmers (List[str]): k-mers to keep (defaults to all 4^k).
+            workers (int): Number of worker processes.
+        
+        Returns:
+            DataFrame: One row per sequence or window and one column of counts per k-mer.
+        """
+        return count_fasta_kmers(fasta_file, k=k, window=window, step=step, kmers=kmers, workers=workers)
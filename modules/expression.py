@@ -1,70 +1,662 @@
 # expression.py
 
+import hashlib
+import multiprocessing
 import os
+import shutil
 import tempfile
-from typing import Dict
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+import numpy
 import pandas
-import seaborn
 from ipr.connection import IprConnection
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 
-from .util import logger, read_csv
+from simulation.util import logger, read_csv
 
 GENE_NAME = 'Hugo_Symbol'
 GENE_ID = 'Entrez_Gene_Id'
 
+# kbCategory codes of the categorized expression matrix
+EXPRESSION_UP = 1
+EXPRESSION_DOWN = -1
+# uint8 percentile used where the z-score is missing
+MISSING_PERCENTILE = 255
+# number of sample columns processed at once when computing percentiles and categories
+SAMPLE_BLOCK_SIZE = 1024
+# files of an expression store (see build_expression_store)
+STORE_ZSCORES = 'zscores.npy'
+STORE_PERCENTILES = 'percentiles.npy'
+STORE_GENES = 'genes.tsv'
+STORE_SAMPLES = 'samples.txt'
+# expression density plots
+MAX_DENSITY_BINS = 50
+KDE_GRID_SIZE = 200
+DENSITY_COLOR = '#1f77b4'
+# bump when the look of the density plots changes so that cached plots are not reused
+DENSITY_PLOT_VERSION = 1
+DENSITY_PLOT_CACHE_BYTES = 1 << 30
+HISTOGRAM_CACHE_BYTES = 1 << 28
 
-def load_zscore_data(filename: str) -> pandas.DataFrame:
-    df = read_csv(filename, dtype={GENE_NAME: 'string', GENE_ID: 'string'})
+
+def categorize_expression(
+    zscores: numpy.ndarray,
+    percentiles: numpy.ndarray,
+    zscore_threshold: float = 2,
+    percentile_threshold: float = 97.5,
+) -> numpy.ndarray:
+    """
+    Categorize each expression value as an outlier (EXPRESSION_UP, EXPRESSION_DOWN) or not (0)
+
+    Returns:
+        int8 array the same shape as the input matrices
+    """
+    high = zscores >= zscore_threshold
+    up = high & (percentiles >= percentile_threshold) & (percentiles != MISSING_PERCENTILE)
+    down = ~high & (zscores <= zscore_threshold * -1) & (percentiles <= 100 - percentile_threshold)
+    categories = numpy.zeros(zscores.shape, dtype=numpy.int8)
+    categories[up] = EXPRESSION_UP
+    categories[down] = EXPRESSION_DOWN
+    return categories
+
+
+class ExpressionMatrix:
+    """
+    Gene by sample z-score (float32) and percentile (uint8) matrices for a cohort. Both are stored
+    column-major so that the values for a single sample are a contiguous, zero-copy view
+    """
+
+    def __init__(
+        self,
+        genes: pandas.DataFrame,
+        samples: List[str],
+        zscores: numpy.ndarray,
+        percentiles: numpy.ndarray,
+        store_dir: Optional[str] = None,
+    ):
+        self.store_dir = store_dir
+        self.genes = genes[['gene', 'gene_id']].reset_index(drop=True)
+        self.samples = pandas.Index(samples)
+        self.zscores = numpy.asfortranarray(zscores, dtype=numpy.float32)
+        self.percentiles = numpy.asfortranarray(percentiles, dtype=numpy.uint8)
+        # first row for each gene name
+        self.gene_rows = {
+            gene: row
+            for row, gene in reversed(list(enumerate(self.genes.gene)))
+            if not pandas.isnull(gene)
+        }
+        self.categories_by_threshold: Dict[Tuple[float, float], numpy.ndarray] = {}
+        self.histograms = HistogramCache()
+
+    @classmethod
+    def open(cls, store_dir: str) -> 'ExpressionMatrix':
+        """
+        Open an expression store. The matrices are memory-mapped read-only so opening is
+        immediate and the pages are shared by every process which opens the same store
+        """
+        genes = read_csv(
+            os.path.join(store_dir, STORE_GENES),
+            comment=None,
+            dtype={'gene': 'string', 'gene_id': 'string'},
+        )
+        with open(os.path.join(store_dir, STORE_SAMPLES), 'r') as fh:
+            samples = fh.read().splitlines()
+        return cls(
+            genes,
+            samples,
+            numpy.load(os.path.join(store_dir, STORE_ZSCORES), mmap_mode='r'),
+            numpy.load(os.path.join(store_dir, STORE_PERCENTILES), mmap_mode='r'),
+            store_dir=store_dir,
+        )
+
+    def __reduce_ex__(self, protocol):
+        # re-open the memory-mapped store in other processes rather than copying the matrices
+        if self.store_dir:
+            return (ExpressionMatrix.open, (self.store_dir,))
+        return super().__reduce_ex__(protocol)
+
+    def __contains__(self, sample_id: str) -> bool:
+        return sample_id in self.samples
+
+    def sample_column(self, sample_id: str) -> int:
+        return self.samples.get_loc(sample_id)
+
+    def sample_zscores(self, sample_id: str) -> numpy.ndarray:
+        return self.zscores[:, self.sample_column(sample_id)]
+
+    def sample_percentiles(self, sample_id: str) -> numpy.ndarray:
+        return self.percentiles[:, self.sample_column(sample_id)]
+
+    def gene_zscores(self, gene: str) -> numpy.ndarray:
+        """
+        z-scores of the gene across the cohort (for the first row with this gene name)
+        """
+        return self.zscores[self.gene_rows[gene], :]
+
+    def categories(
+        self, zscore_threshold: float = 2, percentile_threshold: float = 97.5
+    ) -> numpy.ndarray:
+        """
+        kbCategory codes for every gene and sample. Computed once per set of thresholds
+        """
+        key = (zscore_threshold, percentile_threshold)
+        if key not in self.categories_by_threshold:
+            categories = numpy.zeros(self.zscores.shape, dtype=numpy.int8, order='F')
+            for start in range(0, len(self.samples), SAMPLE_BLOCK_SIZE):
+                block = slice(start, start + SAMPLE_BLOCK_SIZE)
+                categories[:, block] = categorize_expression(
+                    self.zscores[:, block],
+                    self.percentiles[:, block],
+                    zscore_threshold,
+                    percentile_threshold,
+                )
+            self.categories_by_threshold[key] = categories
+        return self.categories_by_threshold[key]
+
+    def sample_frame(
+        self, sample_id: str, zscore_threshold: float = 2, percentile_threshold: float = 97.5
+    ) -> pandas.DataFrame:
+        """
+        Per-gene expression values for a single sample, excluding genes with no z-score. The values
+        of genes with several rows are averaged and categorized again, as the pivot of the long
+        frame did
+        """
+        column = self.sample_column(sample_id)
+        present = ~numpy.isnan(self.zscores[:, column])
+        percentiles = self.percentiles[present, column].astype(numpy.float64)
+        percentiles[percentiles == MISSING_PERCENTILE] = numpy.nan
+        df = pandas.DataFrame(
+            {
+                'gene': self.genes.gene[present].reset_index(drop=True),
+                'diseasePercentile': percentiles,
+                'diseaseZScore': float32_decimals(self.zscores[present, column]),
+                'kbCategory': self.categories(zscore_threshold, percentile_threshold)[
+                    present, column
+                ],
+            }
+        )
+        duplicated = df.gene.duplicated(keep=False) & df.gene.notna()
+        if duplicated.any():
+            means = (
+                df[duplicated]
+                .groupby('gene', sort=False)[['diseasePercentile', 'diseaseZScore']]
+                .mean()
+                .reset_index()
+            )
+            means['kbCategory'] = categorize_expression(
+                means.diseaseZScore.to_numpy(),
+                means.diseasePercentile.to_numpy(),
+                zscore_threshold,
+                percentile_threshold,
+            )
+            df = pandas.concat([df[~duplicated], means], ignore_index=True)
+        return df
+
+
+def float32_decimals(values: numpy.ndarray) -> numpy.ndarray:
+    """
+    float64 values of the shortest decimal representation of each float32 value (ex. -2.3912 rather
+    than -2.391200065612793), so that the values sent to IPR are the ones read from the input file
+    """
+    return values.astype(str).astype(numpy.float64)
+
+
+def compute_percentiles(zscores: numpy.ndarray, percentiles: numpy.ndarray) -> None:
+    """
+    Fill the percentiles matrix with the rank of each gene within each sample, one block of sample
+    columns at a time
+    """
+    for start in range(0, zscores.shape[1], SAMPLE_BLOCK_SIZE):
+        block = slice(start, start + SAMPLE_BLOCK_SIZE)
+        ranks = pandas.DataFrame(zscores[:, block]).rank(0, pct=True).to_numpy()
+        ranks = numpy.round(ranks * 100)
+        percentiles[:, block] = numpy.where(numpy.isnan(ranks), MISSING_PERCENTILE, ranks)
+
+
+def read_zscore_header(filename: str) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Returns the sample columns of a z-score file and the dtypes to read it with
+    """
+    columns = read_csv(filename, nrows=0).columns
+    dtype = {col: 'float32' for col in columns}
+    dtype.update({GENE_NAME: 'string', GENE_ID: 'string'})
+    return [col for col in columns if col not in [GENE_NAME, GENE_ID]], dtype
+
+
+def load_zscore_data(filename: str) -> ExpressionMatrix:
+    """
+    Load a cBioPortal z-score file, or open an expression store created by build_expression_store
+    """
+    if os.path.isdir(filename):
+        return ExpressionMatrix.open(filename)
+
+    samples, dtype = read_zscore_header(filename)
+    df = read_csv(filename, dtype=dtype)
     df = df.rename(columns={GENE_NAME: 'gene', GENE_ID: 'gene_id'})
-    df['type'] = 'zscore'
-    # calculate the percentiles
-    ranks = df.copy().set_index('gene_id')
-    ranks = ranks.rank(0, pct=True, numeric_only=True).apply(lambda x: round(x * 100))
-    ranks['type'] = 'percentile'
-    ranks['gene_id'] = ranks.index
-    ranks = ranks.reset_index(drop=True)
-    ranks = ranks.merge(df[['gene_id', 'gene']], on='gene_id')
+    zscores = numpy.asfortranarray(df[samples].to_numpy(dtype=numpy.float32))
+
+    percentiles = numpy.full(zscores.shape, MISSING_PERCENTILE, dtype=numpy.uint8, order='F')
+    compute_percentiles(zscores, percentiles)
+    return ExpressionMatrix(df[['gene', 'gene_id']], samples, zscores, percentiles)
+
+
+def build_expression_store(filename: str, store_dir: str, chunksize: int = 1000) -> str:
+    """
+    Convert a cBioPortal z-score file into an expression store: memory-mapped .npy matrices with
+    sidecar gene and sample indexes which load_zscore_data can open without parsing. The file is
+    read in chunks of rows so the full matrix is never held in memory
+
+    Returns:
+        the store directory
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    samples, dtype = read_zscore_header(filename)
+    genes = read_csv(filename, usecols=[GENE_NAME, GENE_ID], dtype=dtype)
+    genes = genes.rename(columns={GENE_NAME: 'gene', GENE_ID: 'gene_id'})
+    shape = (len(genes), len(samples))
+
+    zscores = numpy.lib.format.open_memmap(
+        os.path.join(store_dir, STORE_ZSCORES),
+        mode='w+',
+        dtype=numpy.float32,
+        shape=shape,
+        fortran_order=True,
+    )
+    row = 0
+    for chunk_df in read_csv(filename, dtype=dtype, usecols=samples, chunksize=chunksize):
+        zscores[row : row + len(chunk_df), :] = chunk_df[samples].to_numpy(dtype=numpy.float32)
+        row += len(chunk_df)
+
+    percentiles = numpy.lib.format.open_memmap(
+        os.path.join(store_dir, STORE_PERCENTILES),
+        mode='w+',
+        dtype=numpy.uint8,
+        shape=shape,
+        fortran_order=True,
+    )
+    compute_percentiles(zscores, percentiles)
+    zscores.flush()
+    percentiles.flush()
+
+    genes.to_csv(os.path.join(store_dir, STORE_GENES), sep='\t', index=False)
+    with open(os.path.join(store_dir, STORE_SAMPLES), 'w') as fh:
+        fh.write('\n'.join(samples) + '\n')
+    logger.info(f'wrote expression store for {shape[0]} genes x {shape[1]} samples to {store_dir}')
+    return store_dir
+
+
+class CohortHistogram(NamedTuple):
+    """
+    Density histogram of the cohort z-scores of a single gene
+    """
+
+    gene: str
+    start: float  # left edge of the first bin
+    width: float
+    density: numpy.ndarray
+    values: numpy.ndarray  # the non-missing cohort z-scores, used for the density curve
+
+    def current_bins(self, current: float) -> numpy.ndarray:
+        """
+        mask of the bins which contain the value (a value on an edge is in both bins)
+        """
+        lefts = self.start + self.width * numpy.arange(len(self.density))
+        return (current >= lefts) & (current <= lefts + self.width)
+
+
+class HistogramCache:
+    """
+    Size-bounded cache of the cohort histograms of a matrix. Least recently used histograms are
+    evicted once the cohort values held by the cache are larger than max_bytes. The entries are not
+    pickled, so a matrix sent to another process (or to the study cache) starts with an empty cache
+    """
+
+    def __init__(self, max_bytes: int = HISTOGRAM_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[str, CohortHistogram]' = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, gene: str) -> Optional[CohortHistogram]:
+        with self.lock:
+            histogram = self.entries.get(gene)
+            if histogram is not None:
+                self.entries.move_to_end(gene)
+            return histogram
+
+    def put(self, histogram: CohortHistogram) -> None:
+        with self.lock:
+            previous = self.entries.pop(histogram.gene, None)
+            if previous is not None:
+                self.nbytes -= previous.values.nbytes + previous.density.nbytes
+            self.entries[histogram.gene] = histogram
+            self.nbytes += histogram.values.nbytes + histogram.density.nbytes
+            # always keep the newest histogram, even when it alone is larger than the bound
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.values.nbytes + evicted.density.nbytes
+
+
+def cohort_histograms(
+    expression_matrix: ExpressionMatrix, genes: List[str]
+) -> List[CohortHistogram]:
+    """
+    Bin the cohort z-scores of all of the genes at once. The number of bins per gene follows the
+    Freedman-Diaconis rule (capped at MAX_DENSITY_BINS) as the seaborn distplot did. Histograms
+    only depend on the cohort so they are kept on the matrix (see HistogramCache) and reused for
+    every sample
+    """
+    histograms = {}
+    for gene in genes:
+        histogram = expression_matrix.histograms.get(gene)
+        if histogram is not None:
+            histograms[gene] = histogram
+    missing = [gene for gene in dict.fromkeys(genes) if gene not in histograms]
+    if missing:
+        for histogram in bin_cohort(expression_matrix, missing):
+            expression_matrix.histograms.put(histogram)
+            histograms[histogram.gene] = histogram
+    return [histograms[gene] for gene in genes]
+
+
+def bin_cohort(expression_matrix: ExpressionMatrix, genes: List[str]) -> List[CohortHistogram]:
+    rows = [expression_matrix.gene_rows[gene] for gene in genes]
+    values = expression_matrix.zscores[rows, :].astype(numpy.float64)
+    finite = ~numpy.isnan(values)
+    counts = finite.sum(axis=1)
+    if (counts == 0).any():
+        raise ValueError(f'no cohort expression values for {numpy.array(genes)[counts == 0]}')
+
+    low = numpy.nanmin(values, axis=1)
+    high = numpy.nanmax(values, axis=1)
+    upper_quartile, lower_quartile = numpy.nanpercentile(values, [75, 25], axis=1)
+    bin_width = 2 * (upper_quartile - lower_quartile) / counts ** (1 / 3)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        bins = numpy.where(
+            bin_width > 0, numpy.ceil((high - low) / bin_width), numpy.floor(numpy.sqrt(counts))
+        )
+    bins = numpy.clip(bins, 1, MAX_DENSITY_BINS).astype(numpy.int64)
+    # single valued cohorts are drawn as a single unit-wide bin around the value
+    constant = high == low
+    low = numpy.where(constant, low - 0.5, low)
+    high = numpy.where(constant, high + 0.5, high)
+    width = (high - low) / bins
 
-    df = pandas.concat([df, ranks])
-    return df
+    # the maximum value belongs to the last bin (its right edge is inclusive)
+    index = numpy.floor((numpy.nan_to_num(values, nan=0) - low[:, None]) / width[:, None])
+    index = numpy.clip(index, 0, bins[:, None] - 1).astype(numpy.int64)
+    index += numpy.arange(len(genes))[:, None] * MAX_DENSITY_BINS
+    bin_counts = numpy.bincount(index[finite], minlength=len(genes) * MAX_DENSITY_BINS)
+    density = bin_counts.reshape(len(genes), MAX_DENSITY_BINS) / (counts * width)[:, None]
+
+    return [
+        CohortHistogram(gene, low[i], width[i], density[i, : bins[i]], values[i, finite[i]])
+        for i, gene in enumerate(genes)
+    ]
+
+
+def gaussian_kde(values: numpy.ndarray, grid_size: int = KDE_GRID_SIZE):
+    """
+    Gaussian kernel density estimate using the (robust) Scott bandwidth
+
+    Returns:
+        the x and y coordinates of the density curve, or None if the bandwidth is zero
+    """
+    spread = numpy.std(values, ddof=1) if len(values) > 1 else 0
+    iqr = numpy.subtract(*numpy.percentile(values, [75, 25])) / 1.349
+    spread = min(spread, iqr) if iqr > 0 else spread
+    bandwidth = 1.059 * spread * len(values) ** (-1 / 5)
+    if not bandwidth > 0:
+        return None
+    x = numpy.linspace(values.min() - 3 * bandwidth, values.max() + 3 * bandwidth, grid_size)
+    y = numpy.exp(-0.5 * ((x[:, None] - values[None, :]) / bandwidth) ** 2).mean(axis=1)
+    return x, y / (bandwidth * numpy.sqrt(2 * numpy.pi))
+
+
+def render_density_plot(
+    histogram: CohortHistogram, current: float, plot_name: str, dpi: int = 600
+) -> str:
+    """
+    Draw the cohort histogram and density curve of a gene, marking the bin which contains the
+    current sample's value with an asterisk. The output format follows the plot_name extension
+    (ex. png, svg)
+    """
+    figure = Figure()
+    ax = figure.add_subplot()
+    lefts = histogram.start + histogram.width * numpy.arange(len(histogram.density))
+    current_bins = histogram.current_bins(current)
+    ax.bar(
+        lefts,
+        histogram.density,
+        width=histogram.width,
+        align='edge',
+        color=numpy.where(current_bins, 'black', DENSITY_COLOR),
+        alpha=0.4,
+    )
+    curve = gaussian_kde(histogram.values)
+    if curve is not None:
+        ax.plot(*curve, color=DENSITY_COLOR)
+
+    # add the sample marker
+    for left, height in zip(lefts[current_bins], histogram.density[current_bins]):
+        ax.text(
+            left + (histogram.width / 2),
+            height,
+            '*',
+            horizontalalignment='center',
+            verticalalignment='bottom',
+        )
+    ax.set_xlabel('RNA z-score')
+    ax.grid(True)
+    ax.set_axisbelow(True)
+    figure.savefig(plot_name, bbox_inches='tight', dpi=dpi)
+    return plot_name
+
+
+class DensityPlotCache:
+    """
+    Content-addressed, size-bounded cache of rendered expression density plots. A plot depends only
+    on the cohort values of the gene and on which bin is marked for the sample, so every sample of a
+    cohort reuses one of at most MAX_DENSITY_BINS renders per gene. Least recently used plots are
+    evicted once the cache is larger than max_bytes
+
+    The size and recency of the entries are tracked in memory (the directory is only scanned when
+    the cache is opened) so that storing a plot does not list the whole cache
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DENSITY_PLOT_CACHE_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # entry name to size, least recently used first
+        self.entries: 'OrderedDict[str, int]' = OrderedDict()
+        self.nbytes = 0
+
+        found = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.nbytes += size
+        with self.lock:
+            self.evict()
+
+    def key(
+        self, histogram: CohortHistogram, current: float, dpi: int, image_format: str
+    ) -> str:
+        digest = hashlib.sha256()
+        digest.update(f'{DENSITY_PLOT_VERSION}:{dpi}:{image_format}'.encode('utf8'))
+        digest.update(histogram.values.tobytes())
+        digest.update(histogram.current_bins(current).tobytes())
+        return f'{digest.hexdigest()[:32]}.{image_format}'
+
+    def fetch(self, key: str, plot_name: str) -> bool:
+        """
+        Copy the cached plot to plot_name. Returns False if the plot is not cached
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            shutil.copyfile(entry, plot_name)
+            os.utime(entry)  # mark as recently used for the next time the cache is opened
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.forget(key)
+            return False
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:  # stored by another process
+                self.add(key, os.path.getsize(plot_name))
+        return True
+
+    def store(self, key: str, plot_name: str) -> None:
+        entry = os.path.join(self.cache_dir, key)
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(plot_name, tmp_filename)
+        os.replace(tmp_filename, entry)
+        with self.lock:
+            self.forget(key)
+            self.add(key, os.path.getsize(entry))
+            if self.nbytes > self.max_bytes:
+                self.evict()
+
+    def add(self, key: str, size: int) -> None:
+        self.entries[key] = size
+        self.nbytes += size
+
+    def forget(self, key: str) -> None:
+        self.nbytes -= self.entries.pop(key, 0)
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used plots until the cache is within max_bytes. Called with the
+        lock held
+        """
+        while self.entries and self.nbytes > self.max_bytes:
+            key, size = self.entries.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:  # evicted by another process
+                pass
+
+
+def start_density_plot_pool(workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Process pool to render density plots in. The workers are spawned rather than forked, as the
+    pool is started from the report threads of generate_reports and forking a multi-threaded
+    process is unsafe
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def plot_expression_densities(
+    expression_matrix: ExpressionMatrix,
+    sample_id: str,
+    genes: List[str],
+    output_dir: str,
+    dpi: int = 600,
+    image_format: str = 'png',
+    workers: Optional[int] = None,
+    plot_cache: Optional[DensityPlotCache] = None,
+    pool: Optional[Executor] = None,
+) -> Dict[str, str]:
+    """
+    Draw the expression density plots of several genes for a given sample. The cohort histograms
+    are computed together and the plots are rendered in a process pool
+
+    Args:
+        workers: number of processes to render with (defaults to the number of CPUs). Rendered
+            in the current process when 1
+        plot_cache: when given, plots already rendered for the same cohort values and marked bin
+            are copied from the cache rather than drawn again
+        pool: render in this (long-lived, shared) pool rather than starting one for this call
+
+    Returns:
+        mapping of gene name to plot file
+    """
+    logger.info(f'generating expression density plots for {len(genes)} genes')
+    histograms = cohort_histograms(expression_matrix, genes)
+    current = expression_matrix.sample_zscores(sample_id)[
+        [expression_matrix.gene_rows[gene] for gene in genes]
+    ]
+    plot_names = [os.path.join(output_dir, f'{gene}.{image_format}') for gene in genes]
+
+    to_render = list(zip(histograms, current, plot_names))
+    if plot_cache:
+        keys = {
+            plot_name: plot_cache.key(histogram, value, dpi, image_format)
+            for histogram, value, plot_name in to_render
+        }
+        to_render = [
+            (histogram, value, plot_name)
+            for histogram, value, plot_name in to_render
+            if not plot_cache.fetch(keys[plot_name], plot_name)
+        ]
+        logger.info(f'{len(genes) - len(to_render)} of {len(genes)} density plots were cached')
+
+    if len(to_render) < 2 or (pool is None and workers == 1):
+        for args in to_render:
+            render_density_plot(*args, dpi=dpi)
+    elif pool is not None:
+        list(pool.map(render_density_plot, *zip(*to_render), repeat(dpi)))
+    else:
+        with start_density_plot_pool(workers) as call_pool:
+            list(call_pool.map(render_density_plot, *zip(*to_render), repeat(dpi)))
+
+    if plot_cache:
+        for _, _, plot_name in to_render:
+            plot_cache.store(keys[plot_name], plot_name)
+    return dict(zip(genes, plot_names))
 
 
 def plot_expression_density(
-    expression_df: pandas.DataFrame, sample_id: str, gene: str, plot_name: str
+    expression_matrix: ExpressionMatrix, sample_id: str, gene: str, plot_name: str, dpi: int = 600
 ) -> None:
     """
     Draw the expression density plot for a given gene in a given sample
     """
     logger.info(f'generating expression density plot for {gene}')
-    plt.figure()
-    df = expression_df[expression_df.gene == gene]
-    df = df[df.type == 'zscore']
-    sample_columns = [c for c in expression_df.columns if c not in ['gene', 'gene_id', 'type']]
-    df = df[sample_columns]
-    current = df[sample_id].values[0]
-    values = df.values.tolist()[0]
-    seaborn.set_style("whitegrid")
-    ax = seaborn.distplot(values, axlabel="RNA z-score")
-
-    # add the sample marker
-    for p in ax.patches:
-        if current >= p.get_x() and current <= p.get_x() + p.get_width():
-            p.set_color('black')
-            plt.text(
-                p.get_x() + (p.get_width() / 2),
-                p.get_height(),
-                '*',
-                horizontalalignment='center',
-                verticalalignment='bottom',
-            )
-    ax.figure.savefig(plot_name, bbox_inches="tight", dpi=600)
-    plt.close()
+    histogram = cohort_histograms(expression_matrix, [gene])[0]
+    current = expression_matrix.sample_zscores(sample_id)[expression_matrix.gene_rows[gene]]
+    render_density_plot(histogram, current, plot_name, dpi=dpi)
 
 
 def upload_expression_density_plots(
-    ipr_conn: IprConnection, expression_df: pandas.DataFrame, sample_id: str, content: Dict
+    ipr_conn: IprConnection,
+    expression_matrix: ExpressionMatrix,
+    sample_id: str,
+    content: Dict,
+    dpi: int = 600,
+    image_format: str = 'png',
+    workers: Optional[int] = None,
+    plot_cache: Optional[DensityPlotCache] = None,
+    pool: Optional[Executor] = None,
 ) -> None:
     """
     Given a report that has been created, generate expression density reports
@@ -87,10 +679,19 @@ def upload_expression_density_plots(
     with tempfile.TemporaryDirectory() as tmpdir:
         files = {}
         data = {}
+        plots = plot_expression_densities(
+            expression_matrix,
+            sample_id,
+            sorted(list(expression_genes_to_plot)),
+            tmpdir,
+            dpi=dpi,
+            image_format=image_format,
+            workers=workers,
+            plot_cache=plot_cache,
+            pool=pool,
+        )
 
-        for gene in sorted(list(expression_genes_to_plot)):
-            plot_name = os.path.join(tmpdir, f'{gene}.png')
-            plot_expression_density(expression_df, sample_id, gene, plot_name)
+        for gene, plot_name in plots.items():
             key = f'expDensity.{gene}'
             files[key] = plot_name
             data[f'{key}_title'] = f'{gene} RNA Expression Z-Scores'
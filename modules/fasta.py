@@ -0,0 +1,189 @@
+# fasta.py
+
+"""
+Random access to FASTA files through a samtools-style .fai index, so that regions are read from
+disk (through mmap) without loading whole sequences
+"""
+import hashlib
+import mmap
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from simulation.util import logger
+
+INDEX_SUFFIX = '.fai'
+
+
+def index_path(filename: str, index_dir: Optional[str] = None) -> str:
+    """
+    Index file of a FASTA file: next to it (samtools-style) by default, or in index_dir under a name
+    unique to the path of the FASTA file, so that the directory can be shared as a cache of indexes
+    """
+    if not index_dir:
+        return filename + INDEX_SUFFIX
+    os.makedirs(index_dir, exist_ok=True)
+    path_hash = hashlib.sha256(os.path.abspath(filename).encode('utf8')).hexdigest()[:16]
+    return os.path.join(index_dir, f'{os.path.basename(filename)}.{path_hash}{INDEX_SUFFIX}')
+
+
+class FastaIndexEntry(NamedTuple):
+    name: str
+    length: int
+    offset: int  # byte offset of the first base
+    line_bases: int
+    line_width: int  # bytes per line, including the line ending
+
+
+def build_fasta_index(filename: str, index_filename: Optional[str] = None) -> List[FastaIndexEntry]:
+    """
+    Index a FASTA file in one pass over its lines and write the index (by default next to the file,
+    with the .fai suffix). Every line of a record but the last must have the same length, and every
+    record must have a unique name
+    """
+    index_filename = index_filename or index_path(filename)
+    entries: List[FastaIndexEntry] = []
+    names = set()
+    record = None
+
+    def finish():
+        if record is not None:
+            entries.append(FastaIndexEntry(**record))
+
+    with open(filename, 'rb') as fh:
+        offset = 0
+        short_line = False
+        for line_number, line in enumerate(fh, start=1):
+            if line.startswith(b'>'):
+                finish()
+                words = line[1:].split(maxsplit=1)
+                if not words:
+                    raise ValueError(
+                        f'cannot index {filename}: the header on line {line_number} has no name'
+                    )
+                name = words[0].decode('utf8')
+                if name in names:
+                    raise ValueError(
+                        f'cannot index {filename}: {name} is the name of several sequences '
+                        f'(line {line_number})'
+                    )
+                names.add(name)
+                record = {
+                    'name': name,
+                    'length': 0,
+                    'offset': offset + len(line),
+                    'line_bases': 0,
+                    'line_width': 0,
+                }
+                short_line = False
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases:
+                    if not record['line_bases']:
+                        record['line_bases'], record['line_width'] = bases, len(line)
+                    elif (
+                        short_line
+                        or bases > record['line_bases']
+                        # a different line ending
+                        or (line.endswith(b'\n') and len(line) - bases != record['line_width'] - record['line_bases'])
+                    ):
+                        raise ValueError(
+                            f'cannot index {filename}: the lines of {record["name"]} have '
+                            f'different lengths (line {line_number})'
+                        )
+                    short_line = bases < record['line_bases']
+                    record['length'] += bases
+                else:
+                    short_line = True
+            offset += len(line)
+        finish()
+
+    with open(index_filename, 'w') as fh:
+        for entry in entries:
+            fh.write('\t'.join(str(value) for value in entry) + '\n')
+    logger.info(f'indexed {len(entries)} sequences of {filename}')
+    return entries
+
+
+def read_fasta_index(index_filename: str) -> List[FastaIndexEntry]:
+    entries = []
+    with open(index_filename, 'r') as fh:
+        for line in fh:
+            name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+            entries.append(
+                FastaIndexEntry(name, int(length), int(offset), int(line_bases), int(line_width))
+            )
+    return entries
+
+
+class IndexedFasta:
+    """
+    FASTA file opened through its .fai index, which is built the first time (or when the FASTA
+    file is newer than the index). fetch maps the file and copies only the bytes of the region.
+    The index is kept next to the FASTA file unless an index_filename or index_dir is given (see
+    index_path)
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        index_filename: Optional[str] = None,
+        index_dir: Optional[str] = None,
+    ):
+        self.filename = filename
+        index_filename = index_filename or index_path(filename, index_dir)
+        if (
+            not os.path.exists(index_filename)
+            or os.path.getmtime(index_filename) < os.path.getmtime(filename)
+        ):
+            entries = build_fasta_index(filename, index_filename)
+        else:
+            entries = read_fasta_index(index_filename)
+        self.index: Dict[str, FastaIndexEntry] = {entry.name: entry for entry in entries}
+        self.fh = open(filename, 'rb')
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else b''
+
+    @property
+    def references(self) -> List[str]:
+        return list(self.index)
+
+    @property
+    def lengths(self) -> Dict[str, int]:
+        return {name: entry.length for name, entry in self.index.items()}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def __iter__(self) -> Iterator[FastaIndexEntry]:
+        return iter(self.index.values())
+
+    def byte_offset(self, entry: FastaIndexEntry, position: int) -> int:
+        lines, column = divmod(position, entry.line_bases) if entry.line_bases else (0, 0)
+        return entry.offset + lines * entry.line_width + column
+
+    def fetch(self, name: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        """
+        Bases [start, end) (0-based) of the sequence, clipped to the sequence
+        """
+        if name not in self.index:
+            raise KeyError(f'no sequence named {name} in {self.filename}')
+        entry = self.index[name]
+        end = entry.length if end is None else min(end, entry.length)
+        start = max(start, 0)
+        if start >= end:
+            return b''
+        region = self.data[self.byte_offset(entry, start) : self.byte_offset(entry, end)]
+        if entry.line_width > entry.line_bases:
+            region = region.replace(b'\n', b'').replace(b'\r', b'')
+        return region
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fh.close()
+
+    def __enter__(self) -> 'IndexedFasta':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
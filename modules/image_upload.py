@@ -0,0 +1,189 @@
+# image_upload.py
+
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from simulation.util import call_with_retries, logger
+
+# IPR does not accept more than 20 images in a single request
+IMAGE_MAX = 20
+MAX_REQUEST_BYTES = 50 * 1024 * 1024
+READ_BLOCK_SIZE = 1 << 16
+
+
+class MultipartBody:
+    """
+    multipart/form-data request body which reads the files from disk as it is sent rather than
+    loading them into memory. Defines __len__ so that requests sends a Content-Length instead of
+    a chunked body
+    """
+
+    def __init__(self, files: Dict[str, str], data: Dict[str, str]):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        # (part header, field value or None, file path or None)
+        self.parts: List[Tuple[bytes, Optional[bytes], Optional[str]]] = []
+
+        for name, value in data.items():
+            header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            self.parts.append((header.encode('utf8'), str(value).encode('utf8'), None))
+
+        for name, path in files.items():
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            header = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"; filename="{os.path.basename(path)}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n'
+            )
+            self.parts.append((header.encode('utf8'), None, path))
+        self.closing = f'--{self.boundary}--\r\n'.encode('utf8')
+
+    def __len__(self) -> int:
+        length = len(self.closing)
+        for header, value, path in self.parts:
+            length += len(header) + (len(value) if path is None else os.path.getsize(path)) + 2
+        return length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for header, value, path in self.parts:
+            yield header
+            if path is None:
+                yield value
+            else:
+                with open(path, 'rb') as fh:
+                    for block in iter(lambda: fh.read(READ_BLOCK_SIZE), b''):
+                        yield block
+            yield b'\r\n'
+        yield self.closing
+
+
+class ImageUploader:
+    """
+    Uploads report images to IPR over a single pooled HTTP session which is shared by every report
+    (and every report worker thread) of a study. The images of a report are packed into as few
+    requests as the server limits allow and the files are streamed from disk.
+
+    Each request is retried on its own when it fails before reaching the server (see
+    call_with_retries), so that the images of the batches already sent are never sent twice.
+
+    Has the same post_images method as ipr.connection.IprConnection so it can be used in its place
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        ipr_url: str,
+        pool_size: int = 10,
+        max_images: int = IMAGE_MAX,
+        max_request_bytes: int = MAX_REQUEST_BYTES,
+        retries: int = 0,
+        retry_delay: float = 1,
+    ):
+        self.url = ipr_url.rstrip('/')
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_images = max_images
+        self.max_request_bytes = max_request_bytes
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.image_count = 0
+        self.byte_count = 0
+        self.upload_seconds = 0.0
+
+    def batches(self, files: Dict[str, str]) -> List[Dict[str, str]]:
+        """
+        Split the images into groups within the per-request image and size limits
+        """
+        batches: List[Dict[str, str]] = []
+        batch: Dict[str, str] = {}
+        batch_bytes = 0
+
+        for key, path in files.items():
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            size = os.path.getsize(path)
+            if batch and (
+                len(batch) >= self.max_images or batch_bytes + size > self.max_request_bytes
+            ):
+                batches.append(batch)
+                batch, batch_bytes = {}, 0
+            batch[key] = path
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def post_batch(self, report_id: str, batch: Dict[str, str], data: Dict[str, str]) -> int:
+        """
+        Upload a single group of images. Returns the size of the request body
+        """
+        body = MultipartBody(batch, data)
+        resp = self.session.post(
+            f'{self.url}/reports/{report_id}/image',
+            data=body,
+            headers={'Content-Type': body.content_type},
+        )
+        resp.raise_for_status()
+        for status in resp.json():
+            if status.get('upload') != 'successful':
+                raise ValueError(f'failed to upload ({status["key"]}): {status["error"]}')
+        return len(body)
+
+    def post_images(self, report_id: str, files: Dict[str, str], data: Dict[str, str] = {}) -> None:
+        for batch in self.batches(files):
+            start_time = time.time()
+            length = call_with_retries(
+                self.post_batch,
+                report_id,
+                batch,
+                data,
+                retries=self.retries,
+                retry_delay=self.retry_delay,
+                idempotent=False,
+            )
+            with self.lock:
+                self.request_count += 1
+                self.image_count += len(batch)
+                self.byte_count += length
+                self.upload_seconds += time.time() - start_time
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Totals of everything uploaded so far. The throughput is over the time spent in requests,
+        which overlap when several reports upload at once
+        """
+        with self.lock:
+            seconds = self.upload_seconds
+            return {
+                'requests': self.request_count,
+                'images': self.image_count,
+                'bytes': self.byte_count,
+                'seconds': seconds,
+                'images_per_second': self.image_count / seconds if seconds else 0,
+                'bytes_per_second': self.byte_count / seconds if seconds else 0,
+            }
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(
+            f'uploaded {stats["images"]} images ({stats["bytes"] / 2 ** 20:.1f} MiB) in '
+            f'{stats["requests"]} requests: {stats["images_per_second"]:.1f} images/s, '
+            f'{stats["bytes_per_second"] / 2 ** 20:.2f} MiB/s'
+        )
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,246 @@
+# intervals.py
+
+"""
+Batch interval queries (overlap and nearest feature) over sorted arrays, used to assign ChIP-seq
+peaks to genes. Intervals are half-open [start, end) and 0-based, as in BED files and the UCSC
+gene tables
+"""
+
+from typing import Iterable, Tuple
+
+import numpy
+import pandas
+
+from simulation.util import logger
+
+# chromosomes are laid out one after the other on a single axis, at multiples of this
+CHROM_SPAN = 1 << 40
+GENE_NAME_COLUMNS = ['geneSymbol', 'name2', 'gene', 'name']
+
+
+class IntervalIndex:
+    """
+    Intervals of every chromosome sorted by start on one global axis. Empty intervals [p, p) are
+    taken as the single position [p, p + 1), both in the index and in the queries.
+
+    For overlaps, the intervals are also split into length classes (lengths in [2^c, 2^(c+1))). An
+    interval of a class can only overlap a query if it starts less than the longest length of its
+    class before the end of the query, so each class is a couple of searchsorted calls over all
+    query intervals at once. The intervals scanned beyond the hits are the ones of each class which
+    start just before the query and end before it, at most about as many as the hits of that class,
+    so a long interval (ex. a long gene body) does not make every later query scan the intervals
+    after it. nearest uses the running maximum of the ends
+    """
+
+    def __init__(self, chroms: Iterable[str], starts: Iterable[int], ends: Iterable[int]):
+        chrom_ids, self.chrom_names = pandas.factorize(numpy.asarray(chroms).ravel())
+        self.chrom_index = {name: i for i, name in enumerate(self.chrom_names)}
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        if len(starts) and (
+            (starts < 0).any() or (ends < starts).any() or ends.max() >= CHROM_SPAN
+        ):
+            raise ValueError('intervals must have 0 <= start <= end < 2^40')
+        keys = chrom_ids.astype(numpy.int64) * CHROM_SPAN + starts
+        # rows of the input, in index order
+        self.order = numpy.argsort(keys, kind='stable')
+        self.starts = keys[self.order]
+        lengths = numpy.maximum(ends - starts, 1)[self.order]
+        self.ends = self.starts + lengths
+        self.chrom_ids = chrom_ids[self.order]
+        self.max_ends = numpy.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+        # the interval holding the running maximum end (the last one reaching it)
+        positions = numpy.arange(len(self.ends))
+        self.max_end_rows = (
+            numpy.maximum.accumulate(numpy.where(self.ends >= self.max_ends, positions, 0))
+            if len(self.ends)
+            else positions
+        )
+        # (positions in index order, their starts, the longest length) of each length class
+        length_classes = numpy.frexp(lengths.astype(numpy.float64))[1]
+        self.length_classes = []
+        for length_class in numpy.unique(length_classes):
+            class_positions = numpy.flatnonzero(length_classes == length_class)
+            self.length_classes.append(
+                (
+                    class_positions,
+                    self.starts[class_positions],
+                    int(lengths[class_positions].max()),
+                )
+            )
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def keys(
+        self, chroms: Iterable[str], positions: numpy.ndarray
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Global positions of the query positions, and whether the chromosome of each is indexed
+        """
+        query_chroms, names = pandas.factorize(numpy.asarray(chroms).ravel())
+        name_ids = numpy.array(
+            [self.chrom_index.get(name, -1) for name in names], dtype=numpy.int64
+        )
+        chrom_ids = (
+            name_ids[query_chroms] if len(query_chroms) else numpy.empty(0, dtype=numpy.int64)
+        )
+        known = chrom_ids >= 0
+        return numpy.where(known, chrom_ids, 0) * CHROM_SPAN + positions, known
+
+    def overlaps(
+        self, chroms: Iterable[str], starts: Iterable[int], ends: Iterable[int]
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Every (query, interval) pair which overlap. Empty intervals (in the index or in the query)
+        overlap the intervals which contain their position
+
+        Returns:
+            the query rows and the interval rows (in the order the intervals were given) of each
+            pair, ordered by query and then by interval start
+        """
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        query_starts, known = self.keys(chroms, starts)
+        query_ends = query_starts + numpy.maximum(ends - starts, 1)
+        all_query_rows = [numpy.empty(0, dtype=numpy.int64)]
+        all_positions = [numpy.empty(0, dtype=numpy.int64)]
+        for class_positions, class_starts, max_length in self.length_classes:
+            # intervals of the class which start before the end of the query, and late enough
+            # that the longest of the class would reach the start of the query
+            first = numpy.searchsorted(class_starts, query_starts - max_length, side='right')
+            last = numpy.searchsorted(class_starts, query_ends, side='left')
+            counts = numpy.where(known, numpy.maximum(last - first, 0), 0)
+
+            query_rows = numpy.repeat(numpy.arange(len(starts)), counts)
+            offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+            candidates = numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1] - first, counts)
+            positions = class_positions[candidates]
+            hit = self.ends[positions] > query_starts[query_rows]
+            all_query_rows.append(query_rows[hit])
+            all_positions.append(positions[hit])
+
+        query_rows = numpy.concatenate(all_query_rows)
+        positions = numpy.concatenate(all_positions)
+        order = numpy.lexsort((positions, query_rows))
+        return query_rows[order], self.order[positions[order]]
+
+    def nearest(
+        self, chroms: Iterable[str], positions: Iterable[int]
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Nearest interval to each position (0 distance when an interval contains it; ties go to the
+        interval before the position)
+
+        Returns:
+            the interval row (-1 if the chromosome has no intervals) and the distance for each position
+        """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        keys, known = self.keys(chroms, positions)
+        chrom_ids = keys // CHROM_SPAN
+        rows = numpy.full(len(keys), -1, dtype=numpy.int64)
+        distances = numpy.full(len(keys), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        if not len(self):
+            return rows, distances
+
+        # the interval reaching furthest among those starting at or before the position
+        before = numpy.searchsorted(self.starts, keys, side='right') - 1
+        left = self.max_end_rows[numpy.maximum(before, 0)]
+        left_distance = numpy.maximum(keys - self.ends[left] + 1, 0)
+        left_ok = known & (before >= 0) & (self.chrom_ids[left] == chrom_ids)
+        # the first interval starting after the position
+        right = numpy.minimum(before + 1, len(self) - 1)
+        right_distance = self.starts[right] - keys
+        right_ok = known & (before + 1 < len(self)) & (self.chrom_ids[right] == chrom_ids)
+
+        use_left = left_ok & (~right_ok | (left_distance <= right_distance))
+        use_right = right_ok & ~use_left
+        rows[use_left] = self.order[left[use_left]]
+        distances[use_left] = left_distance[use_left]
+        rows[use_right] = self.order[right[use_right]]
+        distances[use_right] = right_distance[use_right]
+        return rows, distances
+
+
+def read_gene_table(filename: str) -> pandas.DataFrame:
+    """
+    Read a UCSC gene table (ex. mm9.knownGene.xls, refGene) into the gene, chrom, strand, start,
+    end and tss columns
+    """
+    genes = pandas.read_csv(filename, sep='\t')
+    genes.columns = [column.lstrip('#') for column in genes.columns]
+    name_column = next((column for column in GENE_NAME_COLUMNS if column in genes.columns), None)
+    missing = [
+        column for column in ['chrom', 'strand', 'txStart', 'txEnd'] if column not in genes.columns
+    ]
+    if name_column is None or missing:
+        raise ValueError(
+            f'{filename} is not a UCSC gene table (missing {missing or GENE_NAME_COLUMNS})'
+        )
+    genes = pandas.DataFrame(
+        {
+            'gene': genes[name_column].astype(str),
+            'chrom': genes['chrom'].astype(str),
+            'strand': genes['strand'].astype(str),
+            'start': genes['txStart'].astype(numpy.int64),
+            'end': genes['txEnd'].astype(numpy.int64),
+        }
+    )
+    genes['tss'] = numpy.where(genes['strand'] == '-', genes['end'] - 1, genes['start'])
+    return genes
+
+
+def regions_to_genes(
+    regions: pandas.DataFrame,
+    genes: pandas.DataFrame,
+    window: int = 1000,
+    include_nearest: bool = True,
+) -> pandas.DataFrame:
+    """
+    Assign each region (chrom, start, end) to the genes whose TSS is within window of its center,
+    and (with include_nearest) to the gene with the nearest TSS
+
+    Returns:
+        one row per (region, gene) pair with the region, gene, strand and TSS of the gene, the signed
+        distance from the TSS to the region center (negative upstream of the gene) and whether the
+        gene is the nearest to the region
+    """
+    index = IntervalIndex(genes['chrom'], genes['tss'], genes['tss'] + 1)
+    region_chroms = regions['chrom'].to_numpy()
+    centers = ((regions['start'].to_numpy() + regions['end'].to_numpy()) // 2).astype(numpy.int64)
+
+    region_rows, gene_rows = index.overlaps(region_chroms, centers - window, centers + window + 1)
+    nearest = numpy.zeros(len(region_rows), dtype=bool)
+    if include_nearest:
+        nearest_rows, _ = index.nearest(region_chroms, centers)
+        found = numpy.flatnonzero(nearest_rows >= 0)
+        region_rows = numpy.concatenate([region_rows, found])
+        gene_rows = numpy.concatenate([gene_rows, nearest_rows[found]])
+        nearest = numpy.concatenate([nearest, numpy.ones(len(found), dtype=bool)])
+    # one row per pair, ordered by region then gene; a nearest gene within the window is kept once
+    pairs = region_rows * len(genes) + gene_rows
+    order = numpy.lexsort((~nearest, pairs))
+    first = numpy.concatenate([[True], pairs[order][1:] != pairs[order][:-1]])
+    keep = order[first]
+    region_rows, gene_rows, nearest = region_rows[keep], gene_rows[keep], nearest[keep]
+
+    tss = genes['tss'].to_numpy()[gene_rows]
+    strand = genes['strand'].to_numpy()[gene_rows]
+    offset = centers[region_rows] - tss
+    result = pandas.DataFrame(
+        {
+            'chrom': region_chroms[region_rows],
+            'start': regions['start'].to_numpy()[region_rows],
+            'end': regions['end'].to_numpy()[region_rows],
+            'gene': genes['gene'].to_numpy()[gene_rows],
+            'strand': strand,
+            'tss': tss,
+            'distance': numpy.where(strand == '-', -offset, offset),
+            'nearest': nearest,
+        }
+    )
+    logger.info(
+        f'assigned {len(numpy.unique(region_rows))} of {len(regions)} regions to '
+        f'{len(numpy.unique(gene_rows))} genes ({len(result)} pairs)'
+    )
+    return result
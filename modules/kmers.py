@@ -0,0 +1,235 @@
+# kmers.py
+
+"""
+k-mer counting over 2-bit encoded sequences. Each k-mer is hashed to the integer formed by the
+2-bit codes of its bases (A=0, C=1, G=2, T=3), so k-mers are counted with bincount instead of
+dictionaries of strings; k-mers containing any other base (ex. N) are skipped
+"""
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import repeat
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy
+import pandas
+
+from simulation.util import logger
+
+BASES = 'ACGT'
+# code of any base which is not one of BASES
+INVALID_CODE = 4
+# largest k for which a count table per window is allocated (4 ** 12 counts)
+MAX_DENSE_K = 12
+# records read ahead of the ones being counted, per worker process
+PENDING_RECORDS_PER_WORKER = 2
+
+BASE_CODES = numpy.full(256, INVALID_CODE, dtype=numpy.uint8)
+for _code, _base in enumerate(BASES):
+    BASE_CODES[ord(_base)] = BASE_CODES[ord(_base.lower())] = _code
+
+
+def read_fasta(filename: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yield the name (first word of the header) and sequence of each record, one record at a time
+    """
+    name = None
+    lines: List[bytes] = []
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(lines)
+                name = line[1:].split(maxsplit=1)[0].decode('utf8') if line[1:].strip() else ''
+                lines = []
+            else:
+                lines.append(line.strip())
+    if name is not None:
+        yield name, b''.join(lines)
+
+
+def encode_sequence(sequence: bytes) -> numpy.ndarray:
+    """
+    uint8 code of each base (see BASE_CODES), case-insensitive
+    """
+    return BASE_CODES[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+
+
+def kmer_names(k: int) -> List[str]:
+    """
+    k-mer of each hash value, in hash order
+    """
+    codes = (numpy.arange(4 ** k)[:, None] >> (2 * numpy.arange(k - 1, -1, -1))[None, :]) & 3
+    return [''.join(BASES[c] for c in row) for row in codes]
+
+
+def kmer_hash(kmer: str, canonical: bool = False) -> int:
+    """
+    Hash of a k-mer (see kmer_hashes). With canonical, the smaller of the hashes of the k-mer and
+    of its reverse complement
+    """
+    value = reverse = 0
+    for base in kmer.upper():
+        if base not in BASES:
+            raise ValueError(f'k-mer ({kmer}) has a base which is not one of {BASES}')
+        value = (value << 2) | BASES.index(base)
+    if not canonical:
+        return value
+    for base in reversed(kmer.upper()):
+        reverse = (reverse << 2) | (3 - BASES.index(base))
+    return min(value, reverse)
+
+
+def kmer_hashes(codes: numpy.ndarray, k: int, canonical: bool = False) -> numpy.ndarray:
+    """
+    Hash of the k-mer starting at each position, computed for every position at once by shifting
+    in one base per step. Positions whose k-mer contains an invalid base are -1
+
+    Args:
+        codes: 2-bit codes of the sequence (see encode_sequence)
+        k: length of the k-mers (at most 31)
+        canonical: hash each k-mer and its reverse complement to the smaller of the two
+    """
+    num_kmers = len(codes) - k + 1
+    if num_kmers <= 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    bases = (codes & 3).astype(numpy.int64)
+    hashes = numpy.zeros(num_kmers, dtype=numpy.int64)
+    for offset in range(k):
+        hashes = (hashes << 2) | bases[offset : offset + num_kmers]
+    if canonical:
+        reverse = numpy.zeros(num_kmers, dtype=numpy.int64)
+        for offset in range(k - 1, -1, -1):
+            reverse = (reverse << 2) | (3 - bases[offset : offset + num_kmers])
+        hashes = numpy.minimum(hashes, reverse)
+
+    invalid = numpy.concatenate([[0], numpy.cumsum(codes == INVALID_CODE)])
+    hashes[invalid[k:] - invalid[:num_kmers] > 0] = -1
+    return hashes
+
+
+def count_kmers(
+    codes: numpy.ndarray,
+    k: int,
+    window: Optional[int] = None,
+    step: Optional[int] = None,
+    canonical: bool = False,
+) -> numpy.ndarray:
+    """
+    Count the k-mers of a sequence, or of each window of it. A k-mer is counted in a window when it
+    starts in the window and fits in the sequence
+
+    Args:
+        codes: 2-bit codes of the sequence (see encode_sequence)
+        k: length of the k-mers
+        window: length of the windows (defaults to the whole sequence)
+        step: distance between the starts of consecutive windows (defaults to window)
+
+    Returns:
+        (num_windows, 4 ** k) int32 counts, indexed by k-mer hash (see kmer_names)
+    """
+    if k > MAX_DENSE_K:
+        raise ValueError(f'k ({k}) is too large for dense counts, the maximum is {MAX_DENSE_K}')
+    size = 4 ** k
+    hashes = kmer_hashes(codes, k, canonical=canonical)
+    if window is None:
+        return numpy.bincount(hashes[hashes >= 0], minlength=size).astype(numpy.int32)[None, :]
+
+    step = step or window
+    num_windows = max(-(-(len(codes) - window) // step), 0) + 1 if len(codes) else 0
+    counts = numpy.zeros((num_windows, size), dtype=numpy.int32)
+    positions = numpy.flatnonzero(hashes >= 0)
+    # overlapping windows (step < window) count each k-mer in every window it starts in
+    for overlap in range(-(-window // step)):
+        windows = positions // step - overlap
+        inside = (windows >= 0) & (windows < num_windows) & (positions < windows * step + window)
+        counts += numpy.bincount(
+            windows[inside] * size + hashes[positions[inside]], minlength=num_windows * size
+        ).reshape(num_windows, size).astype(numpy.int32)
+    return counts
+
+
+def ordered_map(executor: Executor, func: Callable, tasks: Iterable, max_pending: int) -> Iterator:
+    """
+    Like executor.map, in order, but only takes the next task once fewer than max_pending are
+    running or waiting to be collected, so that a large input is never read all at once
+    """
+    pending: deque = deque()
+    for task in tasks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, task))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _count_record(args) -> Tuple[str, int, numpy.ndarray]:
+    (name, sequence), k, window, step, canonical = args
+    return name, len(sequence), count_kmers(encode_sequence(sequence), k, window, step, canonical)
+
+
+def count_fasta_kmers(
+    filename: str,
+    k: int = 5,
+    window: Optional[int] = None,
+    step: Optional[int] = None,
+    canonical: bool = False,
+    kmers: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+) -> pandas.DataFrame:
+    """
+    Count the k-mers of every sequence (or window of each sequence) of a FASTA file, counting the
+    sequences in parallel worker processes. Records are read as the workers take them, at most
+    PENDING_RECORDS_PER_WORKER ahead
+
+    Args:
+        canonical: count each k-mer together with its reverse complement. A k-mer column then holds
+            the count of both (ex. TTTTT and AAAAA have the same counts)
+        kmers: only keep the counts of these k-mers, in this order. Defaults to every k-mer (every
+            canonical k-mer with canonical), in hash order
+        workers: number of worker processes (defaults to the number of cores)
+
+    Returns:
+        one row per sequence or window (with the chrom, start and end columns) and one float32
+        column of counts per k-mer. These are raw counts, not the f0-f19 feature vectors the motif
+        models score (see motif_models.FEATURE_NAMES)
+    """
+    if kmers is not None:
+        names = kmers
+    elif canonical:
+        names = [
+            kmer for kmer in kmer_names(k) if kmer_hash(kmer, canonical=True) == kmer_hash(kmer)
+        ]
+    else:
+        names = kmer_names(k)
+    if any(len(kmer) != k for kmer in names):
+        raise ValueError(f'every k-mer must be of length {k}')
+    columns = numpy.array(
+        [kmer_hash(kmer, canonical=canonical) for kmer in names], dtype=numpy.int64
+    )
+
+    tasks = zip(read_fasta(filename), repeat(k), repeat(window), repeat(step), repeat(canonical))
+    workers = workers or os.cpu_count() or 1
+    frames = []
+
+    def collect(results):
+        for name, length, counts in results:
+            starts = numpy.arange(counts.shape[0], dtype=numpy.int64) * (step or window or 0)
+            ends = numpy.minimum(starts + (window or length), length)
+            frame = pandas.DataFrame(counts[:, columns].astype(numpy.float32), columns=names)
+            frame.insert(0, 'chrom', name)
+            frame.insert(1, 'start', starts)
+            frame.insert(2, 'end', ends)
+            frames.append(frame)
+            logger.debug(f'counted {k}-mers of {name} ({length} bases)')
+
+    if workers <= 1:
+        collect(map(_count_record, tasks))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            collect(
+                ordered_map(executor, _count_record, tasks, workers * PENDING_RECORDS_PER_WORKER)
+            )
+    if not frames:
+        return pandas.DataFrame(columns=['chrom', 'start', 'end'] + list(names))
+    return pandas.concat(frames, ignore_index=True)
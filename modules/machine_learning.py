@@ -1,19 +1,83 @@
 # machine_learning.py
 
+import os
+
+import pandas
+
+from .motif_models import (
+    FEATURE_NAMES,
+    MODEL_DIR,
+    MODEL_MEMORY_BUDGET,
+    MODEL_SUFFIX,
+    ModelRegistry,
+    as_feature_matrix,
+)
+from .motif_trees import STORE_MODELS, CompiledModels
+
+
 class MachineLearning:
-    def __init__(self):
-        pass
+    def __init__(self, model_dir=MODEL_DIR, memory_budget=MODEL_MEMORY_BUDGET, workers=None, compiled_dir=None):
+        self.model_dir = model_dir
+        self.memory_budget = memory_budget
+        self.workers = workers
+        # compiled models (see motif_trees.compile_motif_models) are used instead of the pickles when present
+        self.compiled_dir = compiled_dir or os.path.join(model_dir, 'compiled')
+        self.registry = None
+        self.compiled = None
+
+    def models(self):
+        """
+        Motif model registry, created on first use so that constructing this class stays cheap.
+        """
+        if self.registry is None:
+            self.registry = ModelRegistry(self.model_dir, memory_budget=self.memory_budget)
+        return self.registry
+
+    def compiled_models(self):
+        """
+        Compiled motif models, or None if they have not been compiled.
+        """
+        if self.compiled is None and os.path.exists(os.path.join(self.compiled_dir, STORE_MODELS)):
+            self.compiled = CompiledModels.open(self.compiled_dir)
+        return self.compiled
 
     def predict_drug_target(self, data):
         """
-        Placeholder function for machine learning-based drug target prediction.
-        This can be enhanced with models like RandomForest or Deep Learning.
+        Score each row of the input with every motif model, from the compiled models when they exist
+        (see CompiledModels.predict) and otherwise from the pickled models (see ModelRegistry.predict_all).
         
         Args:
-            data (str): Path to the input dataset used for training the model.
+            data (str): Path to the input dataset (comma or tab separated, by extension) with the
+                f0-f19 feature columns, or a DataFrame with those columns.
         
         Returns:
-            str: Result of the machine learning prediction.
+            DataFrame: One row per input row and one column of scores per motif.
+        
+        Raises:
+            ValueError: If the input lacks feature columns, or there are no models which can be used.
         """
-        return "ML Prediction Result"
-
+        if isinstance(data, str):
+            delimiter = ',' if os.path.splitext(data)[1].lower() == '.csv' else '\t'
+            data = pandas.read_csv(data, delimiter=delimiter)
+        missing = [name for name in FEATURE_NAMES if name not in data.columns]
+        if missing:
+            raise ValueError(f'input is missing the feature columns: {missing}')
+        features = as_feature_matrix(data[FEATURE_NAMES])
+        compiled = self.compiled_models()
+        if compiled is not None:
+            return pandas.DataFrame(compiled.predict(features), index=data.index, columns=compiled.motifs)
+        registry = self.models() if os.path.isdir(self.model_dir) else None
+        if not registry:
+            raise ValueError(
+                f'no motif models: {self.model_dir} has no {MODEL_SUFFIX} files and {self.compiled_dir} '
+                'has no compiled models'
+            )
+        try:
+            scores = registry.predict_all(features, workers=self.workers)
+        except (ImportError, ValueError) as err:
+            # ex. xgboost is missing, or too recent to load the pickled models
+            raise ValueError(
+                f'the pickled motif models cannot be used ({err}), compile them into {self.compiled_dir} '
+                'with motif_trees.compile_motif_models'
+            ) from err
+        return pandas.DataFrame(scores, index=data.index, columns=registry.motifs)
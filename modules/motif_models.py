@@ -0,0 +1,239 @@
+# motif_models.py
+
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy
+
+from simulation.util import logger
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'model')
+MODEL_SUFFIX = '.m'
+# models are kept until their total (on-disk) size exceeds this
+MODEL_MEMORY_BUDGET = 512 * 1024 * 1024
+# every motif model takes the same features
+FEATURE_NAMES = [f'f{i}' for i in range(20)]
+
+
+class _BoosterUnpickler(pickle.Unpickler):
+    """
+    Unpickles an XGBClassifier without its classes, so that only the plain state is kept
+    """
+
+    class State:
+        def __init__(self, *pos, **kwargs):
+            self.state = None
+
+        def __setstate__(self, state):
+            self.state = state
+
+    def find_class(self, module, name):
+        if module == 'builtins' and name == 'bytearray':
+            return bytearray
+        if module.startswith('numpy'):
+            return super().find_class(module, name)
+        return self.State
+
+
+def read_booster_buffer(filename: str) -> bytes:
+    """
+    Raw booster of a pickled XGBClassifier
+    """
+    with open(filename, 'rb') as fh:
+        model = _BoosterUnpickler(fh).load()
+    return bytes(model.state['_Booster'].state['handle'])
+
+
+def load_pickled_model(filename: str):
+    """
+    xgboost Booster of a pickled XGBClassifier. The boosters are in the pre-1.0 binary format, so
+    they are read from the raw buffer rather than unpickled (which fails on any recent xgboost). The
+    format can no longer be loaded from xgboost 3.0 on, use compile_motif_models instead
+    """
+    import xgboost
+
+    booster = xgboost.Booster()
+    try:
+        booster.load_model(bytearray(read_booster_buffer(filename)))
+    except xgboost.core.XGBoostError as err:
+        raise ValueError(
+            f'xgboost {xgboost.__version__} cannot load the legacy binary booster of {filename}, '
+            'use xgboost<3 or the compiled models (see compile_motif_models)'
+        ) from err
+    return booster
+
+
+def model_scores(model, features: numpy.ndarray) -> numpy.ndarray:
+    """
+    Probability of the positive class for each row of the (n, len(FEATURE_NAMES)) float32 matrix.
+    Predicts straight from the array (no DMatrix or DataFrame), which releases the GIL
+    """
+    booster = model.get_booster() if hasattr(model, 'get_booster') else model
+    return booster.inplace_predict(features)
+
+
+def as_feature_matrix(features) -> numpy.ndarray:
+    features = numpy.ascontiguousarray(features, dtype=numpy.float32)
+    if features.ndim != 2 or features.shape[1] != len(FEATURE_NAMES):
+        raise ValueError(
+            f'expected an (n, {len(FEATURE_NAMES)}) feature matrix, got shape {features.shape}'
+        )
+    return features
+
+
+class ModelRegistry:
+    """
+    Index of the motif models (ex. data/model/AAATC.m) which loads each model the first time it is
+    requested. Loaded models are kept in an LRU cache bounded by memory_budget, using the size of the
+    model file as the estimate of the memory it takes once loaded. Safe to use from several threads;
+    a model requested by several threads at once is only loaded once
+    """
+
+    def __init__(
+        self,
+        model_dir: str = MODEL_DIR,
+        memory_budget: int = MODEL_MEMORY_BUDGET,
+        loader: Callable[[str], Any] = load_pickled_model,
+    ):
+        self.model_dir = model_dir
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self.paths: Dict[str, str] = {}
+        self.sizes: Dict[str, int] = {}
+        for entry in sorted(os.scandir(model_dir), key=lambda entry: entry.name):
+            if entry.is_file() and entry.name.endswith(MODEL_SUFFIX):
+                motif = entry.name[: -len(MODEL_SUFFIX)]
+                self.paths[motif] = entry.path
+                self.sizes[motif] = entry.stat().st_size
+        self.models: 'OrderedDict[str, Any]' = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.load_locks: Dict[str, threading.Lock] = {motif: threading.Lock() for motif in self.paths}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    @property
+    def motifs(self) -> List[str]:
+        return list(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __contains__(self, motif: str) -> bool:
+        return motif in self.paths
+
+    def get(self, motif: str):
+        """
+        Return the model of the motif, loading it if it is not cached
+        """
+        if motif not in self.paths:
+            raise KeyError(f'no model for motif ({motif}) in {self.model_dir}')
+        with self.lock:
+            if motif in self.models:
+                self.models.move_to_end(motif)
+                self.hits += 1
+                return self.models[motif]
+
+        with self.load_locks[motif]:
+            # loaded by another thread while this one was waiting
+            with self.lock:
+                if motif in self.models:
+                    self.models.move_to_end(motif)
+                    self.hits += 1
+                    return self.models[motif]
+                self.misses += 1
+
+            start_time = time.time()
+            model = self.loader(self.paths[motif])
+            seconds = time.time() - start_time
+            logger.debug(f'loaded motif model {motif} in {seconds:.2f}s')
+
+            with self.lock:
+                self.load_seconds += seconds
+                self.models[motif] = model
+                self.cached_bytes += self.sizes[motif]
+                self.evict()
+        return model
+
+    def __getitem__(self, motif: str):
+        return self.get(motif)
+
+    def predict_all(
+        self,
+        features: numpy.ndarray,
+        motifs: Optional[List[str]] = None,
+        workers: Optional[int] = None,
+    ) -> numpy.ndarray:
+        """
+        Score every row of the feature matrix with every motif model, running the models in
+        worker threads
+
+        Args:
+            features: (n, len(FEATURE_NAMES)) matrix
+            motifs: models to score with (defaults to all of them, in the order of self.motifs)
+            workers: number of threads (defaults to the number of cores)
+
+        Returns:
+            (n, len(motifs)) float32 matrix of scores, one column per motif
+        """
+        features = as_feature_matrix(features)
+        motifs = self.motifs if motifs is None else motifs
+        scores = numpy.empty((features.shape[0], len(motifs)), dtype=numpy.float32)
+
+        def score(column: int) -> None:
+            scores[:, column] = model_scores(self.get(motifs[column]), features)
+
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or len(motifs) <= 1:
+            for column in range(len(motifs)):
+                score(column)
+        else:
+            with ThreadPoolExecutor(min(workers, len(motifs))) as executor:
+                # list() re-raises the first error of any model
+                list(executor.map(score, range(len(motifs))))
+        return scores
+
+    def evict(self) -> None:
+        """
+        Drop the least recently used models until the cache is within the memory budget. Always
+        keeps the most recently used model, even if it is larger than the budget by itself
+        """
+        while self.cached_bytes > self.memory_budget and len(self.models) > 1:
+            motif, _ = self.models.popitem(last=False)
+            self.cached_bytes -= self.sizes[motif]
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.models.clear()
+            self.cached_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            loads = self.misses
+            return {
+                'models': len(self.paths),
+                'cached': len(self.models),
+                'cached_bytes': self.cached_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_seconds': self.load_seconds,
+                'seconds_per_load': self.load_seconds / loads if loads else 0,
+            }
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(
+            f'motif models: {stats["cached"]}/{stats["models"]} cached '
+            f'({stats["cached_bytes"] / 2 ** 20:.1f} MiB), {stats["hits"]} hits, '
+            f'{stats["misses"]} misses, {stats["evictions"]} evictions, '
+            f'{stats["load_seconds"]:.1f}s loading ({stats["seconds_per_load"]:.2f}s per model)'
+        )
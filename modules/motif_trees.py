@@ -0,0 +1,289 @@
+# motif_trees.py
+
+"""
+Portable, array-backed form of the motif models (data/model/*.m). The pickles hold an old
+xgboost.sklearn.XGBClassifier whose booster is in the pre-1.0 binary format; compile_motif_models
+reads the boosters straight from the pickles (without importing xgboost or sklearn) and writes
+the trees of every model as flat NumPy arrays which CompiledModels memory-maps and predicts from
+"""
+import json
+import os
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy
+
+from simulation.util import logger
+
+from .motif_models import (
+    FEATURE_NAMES,
+    MODEL_DIR,
+    MODEL_SUFFIX,
+    as_feature_matrix,
+    read_booster_buffer,
+)
+
+# files of a compiled model set (see compile_motif_models)
+STORE_NODES = 'nodes.npy'
+STORE_ROOTS = 'roots.npy'
+STORE_MODELS = 'models.json'
+STORE_VERSION = 1
+# one record per tree node. Leaves point back to themselves so that every tree can be walked the
+# same number of steps; missing is the child taken when the feature value is nan
+NODE_DTYPE = numpy.dtype(
+    [
+        ('feature', '<i4'),
+        ('threshold', '<f4'),
+        ('left', '<i4'),
+        ('right', '<i4'),
+        ('missing', '<i4'),
+        ('value', '<f4'),
+    ]
+)
+# rows scored at once, bounds the (rows x trees) arrays of the predictor
+PREDICT_BLOCK_ELEMENTS = 1 << 22
+
+# sizes of the structures of the pre-1.0 xgboost binary model format
+LEARNER_PARAM_SIZE = 136
+GBTREE_PARAM_SIZE = 160
+TREE_PARAM_SIZE = 148
+NODE_SIZE = 20
+NODE_STAT_SIZE = 16
+
+
+class LegacyTree(NamedTuple):
+    left: numpy.ndarray  # -1 for leaves
+    right: numpy.ndarray
+    feature: numpy.ndarray
+    default_left: numpy.ndarray
+    value: numpy.ndarray  # split threshold, or the leaf value for leaves
+
+
+def parse_legacy_booster(buffer: bytes) -> Tuple[float, List[LegacyTree]]:
+    """
+    Read a gbtree booster saved in the pre-1.0 binary format
+
+    Returns:
+        the base margin and the trees of the booster
+    """
+    if buffer[:4] == b'binf':
+        buffer = buffer[4:]
+    if buffer[:1] == b'{':
+        raise ValueError('booster is in the JSON format, not the legacy binary format')
+    (base_margin,) = struct.unpack_from('<f', buffer, 0)
+    offset = LEARNER_PARAM_SIZE
+    names = []
+    for _ in range(2):
+        (length,) = struct.unpack_from('<Q', buffer, offset)
+        names.append(buffer[offset + 8 : offset + 8 + length].decode('utf8'))
+        offset += 8 + length
+    objective, booster = names
+    if booster != 'gbtree' or objective != 'binary:logistic':
+        raise ValueError(f'unsupported booster ({booster}) or objective ({objective})')
+
+    num_trees, num_roots = struct.unpack_from('<ii', buffer, offset)
+    (num_output_group,) = struct.unpack_from('<i', buffer, offset + 24)
+    if num_roots != 1 or num_output_group != 1:
+        raise ValueError('only single-root, single-output boosters are supported')
+    offset += GBTREE_PARAM_SIZE
+
+    trees = []
+    for _ in range(num_trees):
+        _, num_nodes = struct.unpack_from('<ii', buffer, offset)
+        (size_leaf_vector,) = struct.unpack_from('<i', buffer, offset + 20)
+        offset += TREE_PARAM_SIZE
+        nodes = numpy.frombuffer(
+            buffer,
+            dtype=[('parent', '<i4'), ('left', '<i4'), ('right', '<i4'), ('index', '<u4'), ('value', '<f4')],
+            count=num_nodes,
+            offset=offset,
+        )
+        offset += num_nodes * (NODE_SIZE + NODE_STAT_SIZE)
+        if size_leaf_vector:
+            (length,) = struct.unpack_from('<Q', buffer, offset)
+            offset += 8 + 4 * length
+        trees.append(
+            LegacyTree(
+                left=nodes['left'].copy(),
+                right=nodes['right'].copy(),
+                feature=(nodes['index'] & 0x7FFFFFFF).astype(numpy.int32),
+                default_left=(nodes['index'] >> 31).astype(bool),
+                value=nodes['value'].copy(),
+            )
+        )
+    return base_margin, trees
+
+
+def tree_depth(tree: LegacyTree) -> int:
+    depth = numpy.zeros(len(tree.left), dtype=numpy.int32)
+    # children always come after their parent
+    for node in range(len(tree.left)):
+        if tree.left[node] != -1:
+            depth[tree.left[node]] = depth[tree.right[node]] = depth[node] + 1
+    return int(depth.max())
+
+
+def flatten_trees(trees: List[LegacyTree], node_offset: int = 0) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Concatenate the trees into one NODE_DTYPE array, with the child indices made global
+
+    Returns:
+        the nodes and the index of the root of each tree
+    """
+    sizes = [len(tree.left) for tree in trees]
+    starts = node_offset + numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]]).astype(numpy.int64)
+    nodes = numpy.empty(sum(sizes), dtype=NODE_DTYPE)
+    position = 0
+    for start, tree in zip(starts, trees):
+        size = len(tree.left)
+        block = nodes[position : position + size]
+        leaf = tree.left == -1
+        own = start + numpy.arange(size)
+        block['feature'] = numpy.where(leaf, 0, tree.feature)
+        block['threshold'] = numpy.where(leaf, 0, tree.value)
+        block['left'] = numpy.where(leaf, own, start + tree.left)
+        block['right'] = numpy.where(leaf, own, start + tree.right)
+        block['missing'] = numpy.where(tree.default_left, block['left'], block['right'])
+        block['value'] = numpy.where(leaf, tree.value, 0)
+        position += size
+    return nodes, starts
+
+
+def compile_motif_models(model_dir: str = MODEL_DIR, output_dir: Optional[str] = None) -> str:
+    """
+    Convert every pickled motif model of model_dir into one compiled model set
+
+    Returns:
+        the path of the compiled model set (output_dir, by default model_dir/compiled)
+    """
+    output_dir = output_dir or os.path.join(model_dir, 'compiled')
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = sorted(name for name in os.listdir(model_dir) if name.endswith(MODEL_SUFFIX))
+
+    node_blocks, root_blocks = [], []
+    models = []
+    num_nodes = num_trees = 0
+    for name in filenames:
+        base_margin, trees = parse_legacy_booster(read_booster_buffer(os.path.join(model_dir, name)))
+        nodes, roots = flatten_trees(trees, num_nodes)
+        node_blocks.append(nodes)
+        root_blocks.append(roots)
+        models.append(
+            {
+                'motif': name[: -len(MODEL_SUFFIX)],
+                'base_margin': base_margin,
+                'first_tree': num_trees,
+                'num_trees': len(trees),
+                'depth': max((tree_depth(tree) for tree in trees), default=0),
+            }
+        )
+        num_nodes += len(nodes)
+        num_trees += len(trees)
+
+    numpy.save(os.path.join(output_dir, STORE_NODES), numpy.concatenate(node_blocks))
+    numpy.save(os.path.join(output_dir, STORE_ROOTS), numpy.concatenate(root_blocks))
+    with open(os.path.join(output_dir, STORE_MODELS), 'w') as fh:
+        json.dump(
+            {'version': STORE_VERSION, 'features': FEATURE_NAMES, 'models': models}, fh, indent=2
+        )
+    logger.info(
+        f'compiled {len(models)} motif models ({num_trees} trees, {num_nodes} nodes) to {output_dir}'
+    )
+    return output_dir
+
+
+class CompiledModels:
+    """
+    Memory-mapped compiled model set (see compile_motif_models). Scores are the probabilities
+    of the positive class, as predicted by the original boosters
+    """
+
+    def __init__(self, nodes: numpy.ndarray, roots: numpy.ndarray, models: List[Dict]):
+        self.nodes = nodes
+        self.roots = roots
+        self.feature = nodes['feature']
+        self.threshold = nodes['threshold']
+        self.left = nodes['left']
+        self.right = nodes['right']
+        self.missing = nodes['missing']
+        self.value = nodes['value']
+        self.models = models
+        self.motifs = [model['motif'] for model in models]
+        self.model_index = {motif: i for i, motif in enumerate(self.motifs)}
+
+    @classmethod
+    def open(cls, store_dir: str) -> 'CompiledModels':
+        with open(os.path.join(store_dir, STORE_MODELS), 'r') as fh:
+            metadata = json.load(fh)
+        if metadata['version'] != STORE_VERSION:
+            raise ValueError(
+                f'compiled models ({store_dir}) are version {metadata["version"]}, expected {STORE_VERSION}'
+            )
+        return cls(
+            numpy.load(os.path.join(store_dir, STORE_NODES), mmap_mode='r'),
+            numpy.load(os.path.join(store_dir, STORE_ROOTS), mmap_mode='r'),
+            metadata['models'],
+        )
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def __contains__(self, motif: str) -> bool:
+        return motif in self.model_index
+
+    def margins(self, features: numpy.ndarray, model: Dict) -> numpy.ndarray:
+        """
+        Raw (pre-sigmoid) scores of one model. Walks every (row, tree) pair down one level per
+        step. Leaves point to themselves, so pairs which reached a leaf stay put; they are dropped
+        from the walk once they are the majority, as most paths are much shorter than the deepest
+        """
+        roots = numpy.asarray(self.roots[model['first_tree'] : model['first_tree'] + model['num_trees']])
+        num_rows, num_features = features.shape
+        flat_features = features.ravel()
+        margins = numpy.full(num_rows, model['base_margin'], dtype=numpy.float64)
+        block_rows = max(PREDICT_BLOCK_ELEMENTS // max(len(roots), 1), 1)
+
+        for start in range(0, num_rows, block_rows):
+            rows = numpy.arange(start, min(start + block_rows, num_rows))
+            leaves = numpy.tile(roots.astype(numpy.int32), len(rows))
+            node = leaves
+            offset = numpy.repeat(rows * num_features, len(roots))
+            position = None
+
+            for _ in range(model['depth']):
+                value = flat_features[offset + self.feature[node]]
+                step = numpy.where(value < self.threshold[node], self.left[node], self.right[node])
+                step = numpy.where(numpy.isnan(value), self.missing[node], step)
+                moved = step != node
+                if position is None:
+                    leaves = step
+                else:
+                    leaves[position] = step
+                node = step
+                num_moved = int(moved.sum())
+                if not num_moved:
+                    break
+                if num_moved < len(node) // 2:
+                    keep = numpy.flatnonzero(moved)
+                    node, offset = node[keep], offset[keep]
+                    position = keep if position is None else position[keep]
+
+            values = self.value[leaves].reshape(len(rows), len(roots))
+            # sum in float32 like xgboost does
+            margins[rows] += values.sum(axis=1, dtype=numpy.float32)
+        return margins
+
+    def predict(self, features: numpy.ndarray, motifs: Optional[List[str]] = None) -> numpy.ndarray:
+        """
+        Score every row of the (n, len(FEATURE_NAMES)) matrix with every model
+
+        Returns:
+            (n, len(motifs)) float32 matrix of scores, one column per motif
+        """
+        features = as_feature_matrix(features)
+        motifs = self.motifs if motifs is None else motifs
+        scores = numpy.empty((features.shape[0], len(motifs)), dtype=numpy.float32)
+        for column, motif in enumerate(motifs):
+            margins = self.margins(features, self.models[self.model_index[motif]])
+            scores[:, column] = 1 / (1 + numpy.exp(-margins))
+        return scores
@@ -0,0 +1,319 @@
+# twobit.py
+
+"""
+2-bit packed, memory-mapped genome store. Bases are packed 4 per byte (A=0, C=1, G=2, T=3, first
+base in the high bits), with the runs of N and of soft-masked (lowercase) bases kept as interval
+arrays, so regions are extracted as uint8 code arrays (see kmers.BASE_CODES) without ever building
+Python strings
+"""
+
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy
+import pandas
+from numpy.lib.format import open_memmap
+
+from simulation.util import logger
+
+from .fasta import IndexedFasta
+from .kmers import BASES, BASE_CODES, INVALID_CODE
+
+# files of a genome store (see build_genome_store)
+STORE_PACKED = 'packed.npy'
+STORE_N_BLOCKS = 'n_blocks.npy'
+STORE_MASK_BLOCKS = 'mask_blocks.npy'
+STORE_SEQUENCES = 'sequences.json'
+# bump when the content of the stores changes, GenomeStore.open rejects stores of other versions
+STORE_VERSION = 2
+# bases read from the FASTA file at once while building a store (a multiple of 4)
+BUILD_CHUNK_BASES = 1 << 24
+# the 4 codes packed in each byte value
+BYTE_CODES = ((numpy.arange(256)[:, None] >> numpy.array([6, 4, 2, 0])[None, :]) & 3).astype(
+    numpy.uint8
+)
+CODE_LETTERS = numpy.frombuffer((BASES + 'N').encode('ascii'), dtype=numpy.uint8)
+
+
+def find_runs(flags: numpy.ndarray, offset: int = 0) -> numpy.ndarray:
+    """
+    (start, end) of each run of True values, shifted by offset
+
+    Returns:
+        (num_runs, 2) int64 array
+    """
+    edges = numpy.diff(numpy.concatenate([[0], flags.view(numpy.int8), [0]]))
+    return (
+        numpy.stack([numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)], axis=1).astype(
+            numpy.int64
+        )
+        + offset
+    )
+
+
+def merge_runs(blocks: List[numpy.ndarray]) -> numpy.ndarray:
+    """
+    Concatenate sorted runs, joining runs which touch (ex. a run split across two chunks)
+    """
+    runs = numpy.concatenate(blocks) if blocks else numpy.empty((0, 2), dtype=numpy.int64)
+    if len(runs) < 2:
+        return runs
+    starts_new_run = numpy.concatenate([[True], runs[1:, 0] != runs[:-1, 1]])
+    run_index = numpy.cumsum(starts_new_run) - 1
+    merged = numpy.empty((run_index[-1] + 1, 2), dtype=numpy.int64)
+    merged[:, 0] = runs[starts_new_run, 0]
+    merged[run_index, 1] = runs[:, 1]
+    return merged
+
+
+def build_genome_store(
+    fasta_file: str,
+    store_dir: str,
+    chunk_bases: int = BUILD_CHUNK_BASES,
+    index_dir: Optional[str] = None,
+) -> str:
+    """
+    Convert a FASTA file into a genome store, reading it chunk by chunk through its .fai index
+    (kept in index_dir when given, see fasta.index_path). Each sequence starts on a byte boundary;
+    N and soft-mask runs are stored in the global base coordinates of the packed array
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    chunk_bases -= chunk_bases % 4
+    with IndexedFasta(fasta_file, index_dir=index_dir) as fasta:
+        entries = list(fasta)
+        byte_offsets = numpy.concatenate(
+            [[0], numpy.cumsum([-(-entry.length // 4) for entry in entries])]
+        )
+        packed = open_memmap(
+            os.path.join(store_dir, STORE_PACKED),
+            mode='w+',
+            dtype=numpy.uint8,
+            shape=(int(byte_offsets[-1]),),
+        )
+        n_blocks: List[numpy.ndarray] = []
+        mask_blocks: List[numpy.ndarray] = []
+        sequences = []
+
+        for entry, byte_offset in zip(entries, byte_offsets):
+            base_offset = int(byte_offset) * 4
+            for start in range(0, entry.length, chunk_bases):
+                raw = numpy.frombuffer(
+                    fasta.fetch(entry.name, start, start + chunk_bases), dtype=numpy.uint8
+                )
+                codes = BASE_CODES[raw]
+                n_blocks.append(find_runs(codes == INVALID_CODE, base_offset + start))
+                # only lowercase letters are soft-masked (not ex. '-' or '*', which also have 0x20 set)
+                lowercase = (raw >= ord('a')) & (raw <= ord('z'))
+                mask_blocks.append(find_runs(lowercase, base_offset + start))
+                codes = codes & 3
+                codes = numpy.concatenate(
+                    [codes, numpy.zeros(-len(codes) % 4, dtype=numpy.uint8)]
+                ).reshape(-1, 4)
+                first_byte = int(byte_offset) + start // 4
+                packed[first_byte : first_byte + len(codes)] = (
+                    (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+                )
+            sequences.append({'name': entry.name, 'length': entry.length, 'offset': base_offset})
+        packed.flush()
+        del packed
+
+    numpy.save(os.path.join(store_dir, STORE_N_BLOCKS), merge_runs(n_blocks))
+    numpy.save(os.path.join(store_dir, STORE_MASK_BLOCKS), merge_runs(mask_blocks))
+    with open(os.path.join(store_dir, STORE_SEQUENCES), 'w') as fh:
+        json.dump({'version': STORE_VERSION, 'sequences': sequences}, fh, indent=2)
+    logger.info(f'wrote genome store for {len(sequences)} sequences of {fasta_file} to {store_dir}')
+    return store_dir
+
+
+class GenomeStore:
+    """
+    Memory-mapped genome store (see build_genome_store)
+    """
+
+    def __init__(
+        self,
+        packed: numpy.ndarray,
+        n_blocks: numpy.ndarray,
+        mask_blocks: numpy.ndarray,
+        sequences: List[Dict],
+    ):
+        self.packed = packed
+        self.n_blocks = n_blocks
+        self.mask_blocks = mask_blocks
+        self.sequences = sequences
+        self.sequence_index = {sequence['name']: i for i, sequence in enumerate(sequences)}
+        self.offsets = numpy.array(
+            [sequence['offset'] for sequence in sequences], dtype=numpy.int64
+        )
+        self.lengths = numpy.array(
+            [sequence['length'] for sequence in sequences], dtype=numpy.int64
+        )
+
+    @classmethod
+    def open(cls, store_dir: str) -> 'GenomeStore':
+        with open(os.path.join(store_dir, STORE_SEQUENCES), 'r') as fh:
+            metadata = json.load(fh)
+        if metadata['version'] != STORE_VERSION:
+            raise ValueError(
+                f'genome store ({store_dir}) is version {metadata["version"]}, expected {STORE_VERSION}'
+            )
+        return cls(
+            numpy.load(os.path.join(store_dir, STORE_PACKED), mmap_mode='r'),
+            numpy.load(os.path.join(store_dir, STORE_N_BLOCKS)),
+            numpy.load(os.path.join(store_dir, STORE_MASK_BLOCKS)),
+            metadata['sequences'],
+        )
+
+    @property
+    def references(self) -> List[str]:
+        return [sequence['name'] for sequence in self.sequences]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sequence_index
+
+    def sequence_ids(self, chroms: Iterable[str]) -> numpy.ndarray:
+        inverse, names = pandas.factorize(numpy.asarray(chroms).ravel())
+        missing = [str(name) for name in names if name not in self.sequence_index]
+        if missing:
+            raise KeyError(f'sequences not in the genome store: {missing[:10]}')
+        return numpy.array([self.sequence_index[name] for name in names], dtype=numpy.int64)[
+            inverse
+        ]
+
+    def in_blocks(self, blocks: numpy.ndarray, positions: numpy.ndarray) -> numpy.ndarray:
+        block = numpy.searchsorted(blocks[:, 0], positions, side='right') - 1
+        return (block >= 0) & (positions < blocks[numpy.maximum(block, 0), 1])
+
+    def overlaps_blocks(
+        self, blocks: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray
+    ) -> numpy.ndarray:
+        """
+        Whether each global region [start, end) overlaps any of the (sorted, disjoint) blocks
+        """
+        # blocks starting before the end of the region, and the first block ending after its start
+        return numpy.searchsorted(blocks[:, 1], starts, side='right') < numpy.searchsorted(
+            blocks[:, 0], ends, side='left'
+        )
+
+    def unpack(self, positions: numpy.ndarray) -> numpy.ndarray:
+        """
+        2-bit codes of the bases at the given global positions (N not applied)
+        """
+        # the low bits of the position select the base within its byte (first base in the high bits)
+        shifts = numpy.uint8(6) - (
+            (positions.astype(numpy.uint8) & numpy.uint8(3)) << numpy.uint8(1)
+        )
+        return (self.packed[positions >> 2] >> shifts) & numpy.uint8(3)
+
+    def unpack_fixed(self, starts: numpy.ndarray, length: int) -> numpy.ndarray:
+        """
+        (num_regions, length) 2-bit codes of fixed-length regions starting at the given global
+        positions (N not applied). Whole bytes are unpacked through a lookup table and the bases
+        before the start of each region are then dropped
+        """
+        codes = numpy.empty((len(starts), length), dtype=numpy.uint8)
+        if not len(starts) or not length:
+            return codes
+        byte_index = (starts >> 2)[:, None] + numpy.arange(-(-length // 4) + 1)
+        unpacked = BYTE_CODES[self.packed[numpy.minimum(byte_index, len(self.packed) - 1)]].reshape(
+            len(starts), -1
+        )
+        first_base = starts & 3
+        for skip in range(4):
+            rows = first_base == skip
+            codes[rows] = unpacked[rows, skip : skip + length]
+        return codes
+
+    def check_regions(self, ids: numpy.ndarray, starts: numpy.ndarray, ends: numpy.ndarray) -> None:
+        bad = (starts < 0) | (ends < starts) | (ends > self.lengths[ids])
+        if bad.any():
+            i = int(numpy.flatnonzero(bad)[0])
+            raise ValueError(
+                f'region {self.sequences[ids[i]]["name"]}:{starts[i]}-{ends[i]} is outside of the '
+                f'sequence (length {self.lengths[ids[i]]})'
+            )
+
+    def extract(
+        self, chroms: Iterable[str], starts: Iterable[int], length: int, soft_mask: bool = False
+    ):
+        """
+        Fixed-length regions [start, start + length) (0-based), for every region at once
+
+        Returns:
+            (num_regions, length) uint8 codes, and the matching soft-mask flags if soft_mask
+        """
+        ids = self.sequence_ids(chroms)
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        self.check_regions(ids, starts, starts + length)
+        region_starts = self.offsets[ids] + starts
+        codes = self.unpack_fixed(region_starts, length)
+
+        flagged = []
+        for blocks in [self.n_blocks] + ([self.mask_blocks] if soft_mask else []):
+            flags = numpy.zeros(codes.shape, dtype=bool)
+            # only the regions overlapping a block are looked up base by base
+            hit = numpy.flatnonzero(
+                self.overlaps_blocks(blocks, region_starts, region_starts + length)
+            )
+            if len(hit):
+                flags[hit] = self.in_blocks(
+                    blocks, region_starts[hit][:, None] + numpy.arange(length)
+                )
+            flagged.append(flags)
+        codes[flagged[0]] = INVALID_CODE
+        return (codes, flagged[1]) if soft_mask else codes
+
+    def extract_regions(
+        self,
+        chroms: Iterable[str],
+        starts: Iterable[int],
+        ends: Iterable[int],
+        soft_mask: bool = False,
+    ):
+        """
+        Regions [start, end) (0-based) of any length, for every region at once
+
+        Returns:
+            the uint8 codes of every region concatenated, and the offset of each region in them
+            (num_regions + 1 values), followed by the soft-mask flags if soft_mask
+        """
+        ids = self.sequence_ids(chroms)
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        self.check_regions(ids, starts, ends)
+        sizes = ends - starts
+        region_offsets = numpy.concatenate([[0], numpy.cumsum(sizes)])
+        region_starts = self.offsets[ids] + starts
+        region_rows = numpy.repeat(numpy.arange(len(ids)), sizes)
+        # position of each base: the start of its region plus its index within the region
+        positions = (
+            numpy.arange(region_offsets[-1], dtype=numpy.int64)
+            + (region_starts - region_offsets[:-1])[region_rows]
+        )
+        codes = self.unpack(positions)
+
+        flagged = []
+        for blocks in [self.n_blocks] + ([self.mask_blocks] if soft_mask else []):
+            flags = numpy.zeros(codes.shape, dtype=bool)
+            # only the bases of the regions overlapping a block are looked up
+            hit = self.overlaps_blocks(blocks, region_starts, region_starts + sizes)[region_rows]
+            if hit.any():
+                flags[hit] = self.in_blocks(blocks, positions[hit])
+            flagged.append(flags)
+        codes[flagged[0]] = INVALID_CODE
+        return (codes, region_offsets, flagged[1]) if soft_mask else (codes, region_offsets)
+
+    def fetch(self, chrom: str, start: int = 0, end: Optional[int] = None) -> numpy.ndarray:
+        end = self.lengths[self.sequence_index[chrom]] if end is None else end
+        return self.extract_regions([chrom], [start], [end])[0]
+
+
+def decode(codes: numpy.ndarray, masked: Optional[numpy.ndarray] = None) -> str:
+    """
+    Letters of the codes (for display), lowercase where masked
+    """
+    letters = CODE_LETTERS[codes]
+    if masked is not None:
+        letters = letters | (masked.astype(numpy.uint8) << 5)
+    return letters.tobytes().decode('ascii')
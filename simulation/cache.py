@@ -0,0 +1,118 @@
+# cache.py
+
+"""
+On-disk cache of parsed study files, keyed by the fingerprints of the input files
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Callable, Dict, Optional
+
+from .util import logger
+
+# bump when the output of any of the cached loaders changes so that stale entries are not reused
+CACHE_VERSION = 3
+HASH_BLOCK_SIZE = 1 << 20
+FINGERPRINTS_FILENAME = 'fingerprints.json'
+
+
+def hash_file(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_text(*parts: str) -> str:
+    return hashlib.sha256('\n'.join(parts).encode('utf8')).hexdigest()
+
+
+def write_atomic(filename: str, obj) -> None:
+    """
+    pickle the object to a temporary file and move it into place so that readers never see a
+    partially written entry
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+class StudyCache:
+    """
+    Caches the parsed output of the study loaders (ex. load_small_mutations). Entries are keyed
+    by the content hash of each input file so that a rerun only re-parses the files which have
+    changed. The size and mtime of each file are recorded alongside its hash so that unchanged
+    files are not re-hashed on every run
+    """
+
+    def __init__(self, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.fingerprints_filename = os.path.join(cache_dir, FINGERPRINTS_FILENAME)
+        self.fingerprints: Dict[str, Dict] = {}
+        if os.path.exists(self.fingerprints_filename):
+            with open(self.fingerprints_filename, 'r') as fh:
+                self.fingerprints = json.load(fh)
+
+    def fingerprint(self, filename: Optional[str]) -> str:
+        if not filename:
+            return ''
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        known = self.fingerprints.get(path)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+
+        self.fingerprints[path] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': hash_file(path),
+        }
+        with open(self.fingerprints_filename, 'w') as fh:
+            json.dump(self.fingerprints, fh, indent=2, sort_keys=True)
+        return self.fingerprints[path]['sha256']
+
+    def load(self, loader: Callable, *filenames: Optional[str], **kwargs):
+        """
+        Return the output of loader(*filenames, **kwargs), parsing the files only when no entry
+        exists for their current content
+        """
+        name = loader.__name__
+        # the slot identifies the call (which files, which options), the key also its input content
+        slot = hash_text(
+            str(CACHE_VERSION),
+            loader.__module__,
+            name,
+            *[os.path.abspath(f) if f else '' for f in filenames],
+            repr(sorted(kwargs.items())),
+        )[:16]
+        key = hash_text(slot, *[self.fingerprint(f) for f in filenames])[:16]
+        entry = os.path.join(self.cache_dir, f'{name}.{slot}.{key}.pkl')
+
+        if os.path.exists(entry):
+            try:
+                with open(entry, 'rb') as fh:
+                    result = pickle.load(fh)
+                logger.info(f'loaded cached {name} ({entry})')
+                return result
+            except (OSError, EOFError, pickle.UnpicklingError) as err:
+                logger.warning(f'ignoring unreadable cache entry ({entry}): {err}')
+
+        result = loader(*filenames, **kwargs)
+
+        # drop the entries for previous versions of the same input files
+        for stale in glob.glob(os.path.join(self.cache_dir, f'{name}.{slot}.*.pkl')):
+            if stale != entry:
+                os.remove(stale)
+        write_atomic(entry, result)
+        logger.info(f'cached {name} ({entry})')
+        return result
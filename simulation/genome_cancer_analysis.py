@@ -2,11 +2,14 @@
 
 import pandas as pd
 import matplotlib.pyplot as plt
-from Bio import SeqIO
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 
+from modules.fasta import IndexedFasta
+from modules.intervals import read_gene_table, regions_to_genes
+from modules.twobit import GenomeStore
+
 def load_chip_seq_data(filepath):
     """
     Load and visualize ChIP-Seq data from a CSV file. The function plots the coverage
@@ -20,15 +23,64 @@ def load_chip_seq_data(filepath):
     plt.title('ChIP-Seq Peak Coverage by Chromosome')
     plt.show()
 
-def process_genomic_sequences(filepath):
+def extract_peak_sequences(filepath, genome_store_dir):
+    """
+    Extract the sequence of every ChIP-Seq peak from a 2-bit genome store (see
+    modules.twobit.build_genome_store) in one batch.
+    
+    Args:
+        filepath (str): Path to the ChIP-Seq data file (chromosome, peak_start, peak_end).
+        genome_store_dir (str): Directory of the genome store.
+    
+    Returns:
+        Tuple[ndarray, ndarray]: The uint8 base codes (A=0, C=1, G=2, T=3, N=4) of every peak
+        concatenated, and the offset of each peak in them.
+    """
+    chip_seq_data = pd.read_csv(filepath)
+    return GenomeStore.open(genome_store_dir).extract_regions(
+        chip_seq_data['chromosome'].to_numpy(),
+        chip_seq_data['peak_start'].to_numpy(),
+        chip_seq_data['peak_end'].to_numpy(),
+    )
+
+def assign_peaks_to_genes(filepath, gene_table, output_file=None, window=1000):
+    """
+    Assign every ChIP-Seq peak to the genes whose TSS is within window of the peak center, and
+    to the gene with the nearest TSS, with batched interval queries (see modules.intervals).
+    
+    Args:
+        filepath (str): Path to the ChIP-Seq data file (chromosome, peak_start, peak_end).
+        gene_table (str): Path to a UCSC gene table (ex. mm9.20150218.knownGene.xls).
+        output_file (str): Where to write the assignments as a tab-separated regionsToGenes.xls
+            file (read by ParseTestInput), if given.
+        window (int): Largest distance (bp) between a peak center and the TSS of its genes.
+    
+    Returns:
+        DataFrame: One row per (peak, gene) pair.
+    """
+    chip_seq_data = pd.read_csv(filepath)
+    peaks = pd.DataFrame({
+        'chrom': chip_seq_data['chromosome'].astype(str),
+        'start': chip_seq_data['peak_start'],
+        'end': chip_seq_data['peak_end'],
+    })
+    assignments = regions_to_genes(peaks, read_gene_table(gene_table), window=window)
+    if output_file is not None:
+        assignments.to_csv(output_file, sep='\t', index=False)
+    return assignments
+
+def process_genomic_sequences(filepath, index_dir=None):
     """
-    Parse genomic sequences from a FASTA file and print the chromosome ID and sequence length.
+    Print the chromosome ID and sequence length of each sequence of a FASTA file, read from its
+    .fai index (built on first use) instead of parsing the sequences.
     
     Args:
         filepath (str): Path to the FASTA file containing genomic sequences.
+        index_dir (str): Directory to keep the index in (defaults to next to the FASTA file).
     """
-    for seq_record in SeqIO.parse(filepath, "fasta"):
-        print(f"Chromosome: {seq_record.id}, Length: {len(seq_record)}")
+    with IndexedFasta(filepath, index_dir=index_dir) as fasta:
+        for entry in fasta:
+            print(f"Chromosome: {entry.name}, Length: {entry.length}")
 
 def random_forest_classifier(X_train, y_train, X_test, y_test):
     """
@@ -1,8 +1,14 @@
 # util.py
 
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List
 
 import pandas
+import requests
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 # name the logger after the package to make it simple to disable for packages using this one as a dependency
 # https://stackoverflow.com/questions/11029717/how-do-i-disable-log-messages-from-the-requests-library
@@ -20,6 +26,97 @@ LOG_LEVELS = {
 }
 
 
+class ThreadLogBuffer(logging.Filter):
+    """
+    Holds back the records logged by any thread which has an active buffer so that the logs
+    of work done concurrently can be emitted later in a deterministic order
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+log_buffer = ThreadLogBuffer()
+logger.addFilter(log_buffer)
+
+
+@contextmanager
+def buffered_logs():
+    """
+    collect the records logged by the current thread instead of emitting them
+    """
+    records: List[logging.LogRecord] = []
+    log_buffer.local.records = records
+    try:
+        yield records
+    finally:
+        log_buffer.local.records = None
+
+
+def replay_logs(records: List[logging.LogRecord]) -> None:
+    """
+    emit the records collected by buffered_logs
+    """
+    for record in records:
+        logger.handle(record)
+
+
+def request_not_sent(err: Exception) -> bool:
+    """
+    whether a requests error happened before the request reached the server (the connection
+    was refused or timed out), so that sending it again cannot repeat its effect
+    """
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def is_transient_error(err: Exception, idempotent: bool = True) -> bool:
+    """
+    whether a failed request is worth sending again: connection errors and timeouts, and 5xx
+    responses. Requests which are not idempotent (ex. creating a report) are only sent again when
+    they never reached the server, as the server may have acted on them before failing
+    """
+    if isinstance(err, requests.HTTPError):
+        status = err.response.status_code if err.response is not None else None
+        return idempotent and status is not None and status >= 500
+    if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+        return idempotent or request_not_sent(err)
+    return False
+
+
+def call_with_retries(
+    func: Callable,
+    *pos,
+    retries: int = 0,
+    retry_delay: float = 1,
+    idempotent: bool = True,
+    **kwargs,
+):
+    """
+    calls the function, retrying with exponential backoff on transient request errors (see
+    is_transient_error). Any other error (ex. a 4xx response) is raised immediately
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*pos, **kwargs)
+        except Exception as err:
+            if attempt >= retries or not is_transient_error(err, idempotent):
+                raise
+            delay = retry_delay * 2**attempt
+            logger.warning(f'{err} (retrying in {delay}s, attempt {attempt + 1} of {retries})')
+            time.sleep(delay)
+
+
 def add_optional_columns(df, columns, default_value=''):
     for column in columns:
         if column not in df.columns:
@@ -3,7 +3,11 @@
 """
 Process study download data files
 """
+import os
+import pickle
 import re
+import tempfile
+from concurrent.futures import Executor, ThreadPoolExecutor
 from typing import Dict, Iterable, List, Optional
 
 import pandas
@@ -11,13 +15,52 @@ from graphkb.match import INPUT_COPY_CATEGORIES, INPUT_EXPRESSION_CATEGORIES
 from ipr import main
 from ipr.connection import IprConnection
 
-from simulation.util import add_optional_columns, logger, read_csv
-from simulation.expression import load_zscore_data, upload_expression_density_plots
+from modules.expression import (
+    EXPRESSION_DOWN,
+    EXPRESSION_UP,
+    DensityPlotCache,
+    ExpressionMatrix,
+    start_density_plot_pool,
+    load_zscore_data,
+    upload_expression_density_plots,
+)
+from modules.image_upload import ImageUploader
+from simulation.cache import StudyCache
+from simulation.util import (
+    add_optional_columns,
+    buffered_logs,
+    call_with_retries,
+    logger,
+    read_csv,
+    replay_logs,
+)
 
 
 GENE_NAME = 'Hugo_Symbol'
 GENE_ID = 'Entrez_Gene_Id'
 
+SMALL_MUTATION_COLUMNS = [
+    'gene',
+    'chromosome',
+    'transcript',
+    'refSeq',
+    'altSeq',
+    'tumourRefCount',
+    'tumourAltCount',
+    'tumourDepth',
+    'normalRefCount',
+    'normalAltCount',
+    'normalDepth',
+    'startPosition',
+    'endPosition',
+    'hgvsGenomic',
+    'hgvsCds',
+    'hgvsProtein',
+    'proteinChange',
+    'sample_id',
+    'ncbiBuild',
+]
+
 
 def load_copy_variants(
     filename_discrete: str, filename_log2cna: Optional[str] = None
@@ -37,8 +80,11 @@ def load_copy_variants(
     return copy_varints_df
 
 
-def load_small_mutations(filename, **kwargs) -> pandas.DataFrame:
-    mutations_df = read_csv(
+def read_small_mutations(filename, **kwargs):
+    """
+    Read the raw MAF file. Returns an iterator of DataFrame chunks when chunksize is given
+    """
+    return read_csv(
         filename,
         dtype={
             't_alt_count': float,
@@ -82,6 +128,12 @@ def load_small_mutations(filename, **kwargs) -> pandas.DataFrame:
         ],
         **kwargs,
     )
+
+
+def normalize_small_mutations(mutations_df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Rename the MAF columns and compose the variant notation used by IPR
+    """
     mutations_df = mutations_df.rename(
         columns={
             'Chromosome': 'chromosome',
@@ -106,72 +158,97 @@ def load_small_mutations(filename, **kwargs) -> pandas.DataFrame:
         }
     )
 
-    def normalize_protein_change(proteinChange):
-        if pandas.isnull(proteinChange):
-            return ''
-        if proteinChange.endswith('_splice'):
-            proteinChange = proteinChange.replace('_splice', 'spl')
-        if not proteinChange.startswith('p.'):
-            proteinChange = 'p.' + proteinChange
-        return proteinChange
-
-    mutations_df['proteinChange'] = mutations_df['proteinChange'].apply(normalize_protein_change)
-
-    def hgvs_protein(row):
-        if pandas.isnull(row['proteinChange']) or not row['proteinChange'].strip():
-            return ''
-        return row['gene'] + ':' + row['proteinChange']
-
-    def hgvs_cds(row):
-        if pandas.isnull(row.hgvsCds):
-            return ''
-        if ':' not in row.hgvsCds:
-            return f'{row.transcript}:{row.hgvsCds}'
-        return row.hgvsCds
-
-    mutations_df['hgvsProtein'] = mutations_df.apply(hgvs_protein, axis=1)
-    mutations_df['hgvsCds'] = mutations_df.apply(hgvs_cds, axis=1)
+    # normalize the protein change notation
+    protein_change = mutations_df['proteinChange'].astype(object)
+    missing_protein = protein_change.isna()
+    protein_change = protein_change.fillna('').astype(str)
+    splice = protein_change.str.endswith('_splice')
+    protein_change = protein_change.mask(
+        splice, protein_change.str.replace('_splice', 'spl', regex=False)
+    )
+    protein_change = protein_change.mask(
+        ~missing_protein & ~protein_change.str.startswith('p.'), 'p.' + protein_change
+    )
+    mutations_df['proteinChange'] = protein_change
+
+    # compose the gene-qualified protein notation
+    has_protein = protein_change.str.strip() != ''
+    hgvs_protein = (mutations_df['gene'].astype(object) + ':' + protein_change).astype(object)
+    mutations_df['hgvsProtein'] = hgvs_protein.where(has_protein, '')
+
+    # prefix the transcript when the cds notation does not already include a reference
+    hgvs_cds = mutations_df['hgvsCds'].astype(object)
+    missing_cds = hgvs_cds.isna()
+    hgvs_cds = hgvs_cds.fillna('').astype(str)
+    transcript = mutations_df['transcript'].astype(object).astype(str)
+    hgvs_cds = hgvs_cds.mask(~hgvs_cds.str.contains(':', regex=False), transcript + ':' + hgvs_cds)
+    mutations_df['hgvsCds'] = hgvs_cds.mask(missing_cds, '')
     mutations_df['refSeq'] = mutations_df.refSeq.replace('-', '')
     mutations_df['altSeq'] = mutations_df.altSeq.replace('-', '')
     mutations_df['hgvsGenomic'] = ''  # TODO: Compose genomic hgvs notation where possible
-    mutations_df = mutations_df[
-        [
-            'gene',
-            'chromosome',
-            'transcript',
-            'refSeq',
-            'altSeq',
-            'tumourRefCount',
-            'tumourAltCount',
-            'tumourDepth',
-            'normalRefCount',
-            'normalAltCount',
-            'normalDepth',
-            'startPosition',
-            'endPosition',
-            'hgvsGenomic',
-            'hgvsCds',
-            'hgvsProtein',
-            'proteinChange',
-            'sample_id',
-            'ncbiBuild',
-        ]
-    ]
+    mutations_df = mutations_df[SMALL_MUTATION_COLUMNS]
 
-    def choose_main_variant(row):
-        if row.proteinChange:
-            return row.proteinChange
-        if row.hgvsCds:
-            return row.hgvsCds.split(':')[1] if ':' in row.hgvsCds else row.hgvsCds
-        if row.hgvsGenomic:
-            return row.hgvsGenomic.split(':')[1] if ':' in row.hgvsGenomic else row.hgvsGenomic
-        return row.proteinChange
+    def variant_notation(hgvs: pandas.Series) -> pandas.Series:
+        # drop the reference sequence prefix (ex. transcript) from the hgvs notation
+        return hgvs.str.split(':').str[1].where(hgvs.str.contains(':', regex=False), hgvs)
 
-    mutations_df['proteinChange'] = mutations_df.apply(choose_main_variant, axis=1)
+    # choose the main variant notation, falling back from protein to cds to genomic
+    protein_change = mutations_df['proteinChange']
+    hgvs_cds = mutations_df['hgvsCds']
+    hgvs_genomic = mutations_df['hgvsGenomic']
+    main_variant = protein_change.where(hgvs_genomic == '', variant_notation(hgvs_genomic))
+    main_variant = main_variant.mask(hgvs_cds != '', variant_notation(hgvs_cds))
+    mutations_df['proteinChange'] = main_variant.mask(protein_change != '', protein_change)
 
     return mutations_df.drop_duplicates()
 
 
+def load_small_mutations(filename, **kwargs) -> pandas.DataFrame:
+    return normalize_small_mutations(read_small_mutations(filename, **kwargs))
+
+
+def partition_small_mutations(
+    filename: str, output_dir: str, chunksize: int = 100000, **kwargs
+) -> Dict[str, str]:
+    """
+    Stream the MAF file in chunks, normalizing each chunk as it is read and appending its rows to
+    a partition file per sample. Only a single chunk is held in memory at a time. The rows are
+    appended as pickled frames rather than as text so that missing values and dtypes are kept as
+    load_small_mutations returns them
+
+    Returns:
+        mapping of sample_id to the partition file for that sample
+    """
+    partitions: Dict[str, str] = {}
+
+    for chunk_df in read_small_mutations(filename, chunksize=chunksize, **kwargs):
+        chunk_df = normalize_small_mutations(chunk_df)
+
+        for sample_id, sample_df in chunk_df.groupby('sample_id', sort=False):
+            new_partition = sample_id not in partitions
+            if new_partition:
+                partitions[sample_id] = os.path.join(output_dir, f'part-{len(partitions):06d}.pkl')
+            with open(partitions[sample_id], 'wb' if new_partition else 'ab') as fh:
+                pickle.dump(sample_df, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    logger.info(f'wrote small mutations for {len(partitions)} samples to {output_dir}')
+    return partitions
+
+
+def load_small_mutations_partition(filename: str) -> pandas.DataFrame:
+    """
+    Read a single sample partition written by partition_small_mutations. Duplicates are only
+    removed within a chunk while partitioning so rows repeated across chunks are dropped here
+    """
+    frames = []
+    with open(filename, 'rb') as fh:
+        while True:
+            try:
+                frames.append(pickle.load(fh))
+            except EOFError:
+                break
+    return pandas.concat(frames, ignore_index=True).drop_duplicates().reset_index(drop=True)
+
+
 def load_fusions(filename, **kwargs) -> pandas.DataFrame:
     mutations_df = read_csv(
         filename,
@@ -290,12 +367,27 @@ def drop_fields_with_value(rows: List[Dict], *fields: str, value=''):
     return rows
 
 
+def split_by_sample(df: Optional[pandas.DataFrame]) -> Optional[Dict[str, pandas.DataFrame]]:
+    """
+    Group the rows of a variant or clinical table by sample in a single pass so that each report
+    does not have to scan the full table for its rows. The table is sorted by sample once and the
+    rows of each sample are a contiguous slice (a view, not a copy) of the sorted table
+    """
+    if df is None:
+        return None
+    df = df.sort_values('sample_id', kind='stable')
+    return {
+        sample_id: df.iloc[rows[0] : rows[-1] + 1]
+        for sample_id, rows in df.groupby('sample_id', sort=False).indices.items()
+    }
+
+
 def create_report(
     study_id: str,
     patient_id: str,
     sample_id: str,
     clinical_df: pandas.DataFrame,
-    expression_df: pandas.DataFrame,
+    expression_matrix: Optional[ExpressionMatrix],
     small_mutations_df: pandas.DataFrame,
     copy_variants_df: pandas.DataFrame,
     fusions_df: pandas.DataFrame,
@@ -310,35 +402,44 @@ def create_report(
     copy_homd_threshold=-2,
     study_size: Optional[int] = None,
     debugging_filename: Optional[str] = None,
+    small_mutations_partitions: Optional[Dict[str, str]] = None,
+    retries: int = 0,
+    retry_delay: float = 1,
+    density_plot_dpi: int = 600,
+    density_plot_format: str = 'png',
+    density_plot_workers: Optional[int] = None,
+    density_plot_cache: Optional[DensityPlotCache] = None,
+    density_plot_pool: Optional[Executor] = None,
+    image_uploader: Optional[ImageUploader] = None,
     **kwargs,
 ):
-    def categorize_expression(row):
-        if row.diseaseZScore >= zscore_threshold:
-            if row.diseasePercentile >= percentile_threshold:
-                return INPUT_EXPRESSION_CATEGORIES.UP
-        elif row.diseaseZScore <= (zscore_threshold * -1):
-            if row.diseasePercentile <= 100 - percentile_threshold:
-                return INPUT_EXPRESSION_CATEGORIES.DOWN
-        return ''
-
-    if expression_df is not None and sample_id in expression_df.columns:
-        expression = expression_df[['gene', 'gene_id', sample_id, 'type']].copy()
+    if expression_matrix is not None and sample_id in expression_matrix:
+        expression = expression_matrix.sample_frame(
+            sample_id, zscore_threshold, percentile_threshold
+        )
         expression = expression[~expression.gene.isin(gene_conflicts)]
         expression = expression[~pandas.isnull(expression.gene)]
-        expression = pandas.pivot_table(
-            expression, columns=['type'], values=[sample_id], index=['gene']
-        ).reset_index()
-        # flatten the multi-index
-        expression.columns = [tup[-1] if tup[-1] else tup[-2] for tup in expression.columns.values]
-        expression = expression.rename(
-            columns={'percentile': 'diseasePercentile', 'zscore': 'diseaseZScore'}
+        expression['kbCategory'] = expression.kbCategory.map(
+            {
+                EXPRESSION_UP: INPUT_EXPRESSION_CATEGORIES.UP,
+                EXPRESSION_DOWN: INPUT_EXPRESSION_CATEGORIES.DOWN,
+                0: '',
+            }
         )
-        expression['kbCategory'] = expression.apply(categorize_expression, axis=1)
+        expression = expression.sort_values('gene', kind='stable')
         expression = expression.drop_duplicates(['gene', 'kbCategory']).to_dict('records')
     else:
         logger.warning(f'no expression data found for sample ({sample_id})')
         expression = []
 
+    if small_mutations_partitions is not None:
+        # only the partition for the current sample is read when the MAF has been streamed
+        if sample_id in small_mutations_partitions:
+            small_mutations_df = load_small_mutations_partition(
+                small_mutations_partitions[sample_id]
+            )
+        else:
+            small_mutations_df = pandas.DataFrame(columns=SMALL_MUTATION_COLUMNS)
     small_mutations = small_mutations_df[small_mutations_df['sample_id'] == sample_id].copy()
     small_mutations = small_mutations.drop(columns=['sample_id'])
     small_mutations = small_mutations[~small_mutations.gene.isin(gene_conflicts)]
@@ -389,7 +490,12 @@ def create_report(
             f'unable to handle cases ({patient_id}) without or with multiple clinical records per sample ({sample_id}_'
         )
     clinical = clinical[0]
-    content = main.create_report(
+    # creating a report is not idempotent, it is only sent again if it never reached IPR
+    content = call_with_retries(
+        main.create_report,
+        retries=retries,
+        retry_delay=retry_delay,
+        idempotent=False,
         generate_therapeutics=True,
         output_json_path=debugging_filename,
         content={
@@ -422,9 +528,54 @@ def create_report(
         ipr_url=ipr_url,
         **kwargs,
     )
-    ipr_conn = IprConnection(username, password, ipr_url)
+    ipr_conn = image_uploader or IprConnection(username, password, ipr_url)
+
+    upload_expression_density_plots(
+        ipr_conn,
+        expression_matrix,
+        sample_id,
+        content,
+        dpi=density_plot_dpi,
+        image_format=density_plot_format,
+        workers=density_plot_workers,
+        plot_cache=density_plot_cache,
+        pool=density_plot_pool,
+    )
+
+
+def read_gene_ids(filename: str) -> Optional[pandas.DataFrame]:
+    """
+    Column-projected read of only the gene name and ID columns of a variant file. Returns None if
+    the file does not define gene IDs
+    """
+    df = read_csv(
+        filename,
+        usecols=lambda col: col in {GENE_NAME, GENE_ID},
+        dtype={GENE_NAME: 'string', GENE_ID: 'string'},
+    )
+    if GENE_ID not in df.columns:
+        return None
+    return df.rename(columns={GENE_NAME: 'gene', GENE_ID: 'gene_id'})
 
-    upload_expression_density_plots(ipr_conn, expression_df, sample_id, content)
+
+def gene_name_conflicts(*gene_dfs: Optional[pandas.DataFrame]) -> List[str]:
+    """
+    Given the gene/gene_id columns of the loaded variant files, return the gene names which are
+    defined with more than one gene ID
+    """
+    gene_dfs = [
+        df[['gene', 'gene_id']] for df in gene_dfs if df is not None and 'gene_id' in df.columns
+    ]
+    if not gene_dfs:
+        return []
+    genes_df = pandas.concat(gene_dfs).astype(object)
+    # compare IDs by value where numeric so that ex. 7157 and 7157.0 are the same definition
+    numeric_ids = pandas.to_numeric(genes_df['gene_id'], errors='coerce')
+    genes_df['gene_id'] = numeric_ids.astype(object).where(numeric_ids.notna(), genes_df['gene_id'])
+    genes_df = genes_df.drop_duplicates()
+    genes_df = genes_df.dropna(subset=['gene_id'])
+    genes_df = genes_df.dropna(subset=['gene'])
+    return genes_df[genes_df.duplicated('gene')]['gene'].tolist()
 
 
 def find_conflicting_gene_names(
@@ -438,39 +589,22 @@ def find_conflicting_gene_names(
     Cbioportal mixes Ensembl, Entrez, and HGNC gene definitions. Since only the gene names (HGNC)
     are used consistently throughout the variant files we must remove any genes that have conflicting
     definitions based solely on the gene name
-    """
-    genes_df = read_csv(small_mutations_filename)
-    genes_df = genes_df[
-        ['SYMBOL']
-    ].copy()  # Gene in small mutations is ensembl ID which is not helpful
-    genes_df = genes_df.rename(columns={'SYMBOL': GENE_NAME})
-
-    for filename in [
-        discrete_copy_variants_filename,
-        continuous_copy_variants_filename,
-        expression_filename,
-    ]:
-        if not filename:
-            continue
-        df = read_csv(filename)
-        if GENE_ID in df.columns:
-            df = df[[GENE_NAME, GENE_ID]].copy()
-            genes_df = pandas.concat([genes_df, df])
 
-    if fusions_filename:
-        df = read_csv(fusions_filename)
-        if GENE_ID in df.columns:
-            genes_df = pandas.concat([genes_df, df[[GENE_NAME, GENE_ID]].copy()])
-            df[[GENE_NAME, 'Hugo_Symbol2']] = df.Fusion.str.split('-', 1, expand=True)
-            genes_df = pandas.concat([genes_df, df[[GENE_NAME]].copy()])
-            genes_df = pandas.concat(
-                [genes_df, df[['Hugo_Symbol2']].rename(columns={'Hugo_Symbol2': GENE_NAME}).copy()]
-            )
-    genes_df = genes_df.drop_duplicates()
-    genes_df = genes_df.dropna(subset=[GENE_ID])
-    genes_df = genes_df.dropna(subset=[GENE_NAME])
-    conflicts = genes_df[genes_df.duplicated(GENE_NAME)][GENE_NAME].tolist()
-    return conflicts
+    Note: the small mutations file (and the fusion names) do not define an Entrez gene ID so cannot
+    introduce a conflict and are not read
+    """
+    return gene_name_conflicts(
+        *[
+            read_gene_ids(filename)
+            for filename in [
+                discrete_copy_variants_filename,
+                continuous_copy_variants_filename,
+                expression_filename,
+                fusions_filename,
+            ]
+            if filename
+        ]
+    )
 
 
 def generate_reports(
@@ -488,67 +622,186 @@ def generate_reports(
     ipr_project: str,
     patients_subset: Optional[List[str]] = [],
     strict: bool = False,
+    small_mutations_chunksize: Optional[int] = None,
+    workers: int = 1,
+    retries: int = 0,
+    retry_delay: float = 1,
+    cache_dir: Optional[str] = None,
     **kwargs,
 ):
+    """
+    Create an IPR report for each sample in the study
+
+    Args:
+        small_mutations_chunksize: when given, the MAF file is streamed in chunks of this many rows
+            into per-sample partitions instead of being loaded into memory all at once
+        workers: number of reports to build and upload concurrently. The logs of each report are
+            held back and emitted in sample order once that report is complete
+        retries: number of times to retry an IPR request which fails to connect. Report creation
+            and image uploads are not idempotent so they are only sent again when the connection
+            was refused or timed out before the request reached IPR (see call_with_retries)
+        retry_delay: seconds to wait before the first retry, doubled on each subsequent retry
+        expression_filename: cBioPortal z-score file or an expression store directory (see
+            build_expression_store)
+        cache_dir: directory to cache the parsed study files and the rendered expression density
+            plots in. Only files which have changed since the previous run are parsed again
+    """
     logger.info(f'generating study ({study_id}) reports')
-    clinical_df = load_clinical_data(patients_filename, samples_filename)
-
-    gene_conflicts = find_conflicting_gene_names(
-        continuous_copy_variants_filename,
-        discrete_copy_variants_filename,
-        small_mutations_filename,
-        expression_filename,
-        fusions_filename,
+    cache = StudyCache(cache_dir) if cache_dir else None
+    if cache_dir:
+        kwargs.setdefault(
+            'density_plot_cache', DensityPlotCache(os.path.join(cache_dir, 'density_plots'))
+        )
+    # one pooled connection for the image uploads of every report
+    image_uploader = ImageUploader(
+        username,
+        password,
+        ipr_url,
+        pool_size=max(workers, 1),
+        retries=retries,
+        retry_delay=retry_delay,
     )
-    if gene_conflicts:
-        logger.warning(
-            f'ignoring {len(gene_conflicts)} gene names with conflicting definitions: {", ".join(sorted(list(gene_conflicts)))}'
+    # and one process pool to render the density plots of every report
+    plot_pool = None
+    if expression_filename and kwargs.get('density_plot_workers') != 1:
+        plot_pool = start_density_plot_pool(kwargs.get('density_plot_workers'))
+
+    def load(loader, *filenames):
+        if cache:
+            return cache.load(loader, *filenames)
+        return loader(*filenames)
+
+    clinical_df = load(load_clinical_data, patients_filename, samples_filename)
+
+    if expression_filename and os.path.isdir(expression_filename):
+        # memory-mapped expression store, there is nothing to parse or cache
+        expression_matrix = load_zscore_data(expression_filename)
+    elif expression_filename:
+        expression_matrix = load(load_zscore_data, expression_filename)
+    else:
+        expression_matrix = None
+
+    small_mutations_partitions = None
+    partitions_dir = None
+    if small_mutations_chunksize:
+        partitions_dir = tempfile.TemporaryDirectory()
+        small_mutations_df = None
+        small_mutations_partitions = partition_small_mutations(
+            small_mutations_filename, partitions_dir.name, chunksize=small_mutations_chunksize
         )
-
-    if expression_filename:
-        expression_df = load_zscore_data(expression_filename)
     else:
-        expression_df = None
-
-    small_mutations_df = load_small_mutations(small_mutations_filename)
-    copy_variants_df = load_copy_variants(
+        small_mutations_df = load(load_small_mutations, small_mutations_filename)
+    copy_variants_df = load(
+        load_copy_variants,
         discrete_copy_variants_filename,
         continuous_copy_variants_filename,
     )
     if fusions_filename:
-        fusions_df = load_fusions(fusions_filename)
+        fusions_df = load(load_fusions, fusions_filename)
+        fusion_gene_ids_df = load(read_gene_ids, fusions_filename)
     else:
         fusions_df = None
+        fusion_gene_ids_df = None
+
+    # the gene IDs are collected from the files already loaded rather than reading them again
+    gene_conflicts = gene_name_conflicts(
+        copy_variants_df,
+        expression_matrix.genes if expression_matrix is not None else None,
+        fusion_gene_ids_df,
+    )
+    if gene_conflicts:
+        logger.warning(
+            f'ignoring {len(gene_conflicts)} gene names with conflicting definitions: {", ".join(sorted(list(gene_conflicts)))}'
+        )
 
     patients_filter = {p.lower() for p in (patients_subset or [])}
     sample_count = clinical_df.sample_id.nunique()
-    for _, row in clinical_df.iterrows():
-        if patients_filter and row.patientId.lower() not in patients_filter:
+    clinical_by_sample = split_by_sample(clinical_df)
+    small_mutations_by_sample = split_by_sample(small_mutations_df)
+    fusions_by_sample = split_by_sample(fusions_df)
+    # only the sorted copies are used from here on, keep just the (empty) headers of the originals
+    if small_mutations_df is not None:
+        small_mutations_df = small_mutations_df.iloc[0:0]
+    if fusions_df is not None:
+        fusions_df = fusions_df.iloc[0:0]
+
+    def sample_rows(df, df_by_sample, sample_id):
+        if df is None:
+            return None
+        return df_by_sample.get(sample_id, df.iloc[0:0])
+
+    def process_sample(patient_id, sample_id):
+        if patients_filter and patient_id.lower() not in patients_filter:
             logger.warning(
-                f'skipping patient {row.patientId} not in patients selected subset {patients_subset}'
-            )
-            continue
-        logger.info(f'creating a report for {row["patientId"]} {row["sample_id"]}')
-        try:
-            create_report(
-                study_id,
-                row['patientId'],
-                row['sample_id'],
-                clinical_df,
-                expression_df,
-                small_mutations_df,
-                copy_variants_df,
-                fusions_df,
-                gene_conflicts,
-                study_size=sample_count,
-                ipr_project=ipr_project,
-                username=username,
-                password=password,
-                ipr_url=ipr_url,
-                **kwargs,
+                f'skipping patient {patient_id} not in patients selected subset {patients_subset}'
             )
-        except Exception as err:
-            if strict:
-                raise err
-            logger.error(err)
-            logger.info('skipping to the next report')
+            return
+        logger.info(f'creating a report for {patient_id} {sample_id}')
+        create_report(
+            study_id,
+            patient_id,
+            sample_id,
+            sample_rows(clinical_df, clinical_by_sample, sample_id),
+            expression_matrix,
+            sample_rows(small_mutations_df, small_mutations_by_sample, sample_id),
+            copy_variants_df,
+            sample_rows(fusions_df, fusions_by_sample, sample_id),
+            gene_conflicts,
+            study_size=sample_count,
+            ipr_project=ipr_project,
+            username=username,
+            password=password,
+            ipr_url=ipr_url,
+            image_uploader=image_uploader,
+            density_plot_pool=plot_pool,
+            small_mutations_partitions=small_mutations_partitions,
+            retries=retries,
+            retry_delay=retry_delay,
+            **kwargs,
+        )
+
+    def process_sample_buffered(patient_id, sample_id):
+        with buffered_logs() as records:
+            try:
+                process_sample(patient_id, sample_id)
+            except Exception as err:
+                return records, err
+        return records, None
+
+    def handle_error(err):
+        if strict:
+            raise err
+        logger.error(err)
+        logger.info('skipping to the next report')
+
+    samples = list(zip(clinical_df.patientId, clinical_df.sample_id))
+    try:
+        if workers <= 1:
+            for patient_id, sample_id in samples:
+                try:
+                    process_sample(patient_id, sample_id)
+                except Exception as err:
+                    handle_error(err)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(process_sample_buffered, patient_id, sample_id)
+                    for patient_id, sample_id in samples
+                ]
+                try:
+                    # collect in submission order so the logs read the same as a serial run
+                    for future in futures:
+                        records, err = future.result()
+                        replay_logs(records)
+                        if err:
+                            handle_error(err)
+                finally:
+                    for future in futures:
+                        future.cancel()
+    finally:
+        image_uploader.log_stats()
+        image_uploader.close()
+        if plot_pool:
+            plot_pool.shutdown()
+        if partitions_dir:
+            partitions_dir.cleanup()
@@ -0,0 +1,80 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request with the next response of the server's script (status, JSON body,
+    seconds to wait before answering). Once the script runs out every request gets a 200
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *pos):
+        pass
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, payload, delay = self.server.next_response(self.command, self.path, body)
+        if delay:
+            time.sleep(delay)
+        response = json.dumps(payload).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = respond
+    do_POST = respond
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local HTTP server standing in for IPR. Records the method, path and body of every request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, respond: Optional[Callable[[str, str, bytes], Tuple]] = None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.respond = respond
+        self.script: List[Tuple[int, Dict, float]] = []
+        self.requests: List[Tuple[str, str, bytes]] = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def next_response(self, method: str, path: str, body: bytes) -> Tuple[int, Dict, float]:
+        with self.lock:
+            self.requests.append((method, path, body))
+            if self.respond:
+                return self.respond(method, path, body)
+            if self.script:
+                return self.script.pop(0)
+        return 200, {}, 0
+
+    def __enter__(self) -> 'StubServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def closed_port_url() -> str:
+    """
+    URL of a local port nothing listens on, so that connecting to it is refused
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
@@ -0,0 +1,375 @@
+import types
+
+import numpy
+import pytest
+import scipy.stats as stats
+from scipy import integrate
+from lifelines import KaplanMeierFitter
+from lifelines.statistics import logrank_test
+
+from simulation import ctss_simulation
+from simulation.ctss_simulation import (
+    batched_logrank,
+    batched_ttest,
+    estimate_power,
+    find_sample_size,
+    iter_simulations,
+    kaplan_meier,
+    normal_posterior_superiority,
+    posterior_superiority,
+    run_simulations,
+    simulate_adaptive_trials,
+    simulate_survival_trials,
+    simulate_trial,
+    simulate_trials,
+    survival_at,
+)
+
+
+@pytest.fixture
+def power_curve(monkeypatch):
+    """
+    replace the simulated power with a step at a given sample size
+    """
+
+    def set_curve(minimal_sample_size):
+        def fake_estimate_power(sample_size, *pos, **kwargs):
+            power = 0.9 if sample_size >= minimal_sample_size else 0.1
+            return {'sample_size': sample_size, 'power': power, 'ci': (power, power), 'trials': 1}
+
+        monkeypatch.setattr(ctss_simulation, 'estimate_power', fake_estimate_power)
+
+    return set_curve
+
+
+@pytest.mark.parametrize('minimal_sample_size', [2, 3, 4, 5, 16, 17, 100])
+def test_find_sample_size(power_curve, minimal_sample_size):
+    power_curve(minimal_sample_size)
+    # the normal approximation starts the search at 16 participants
+    result = find_sample_size(1.0, 0.0, min_sample_size=2, seed=0)
+    assert result['sample_size'] == minimal_sample_size
+
+
+def test_find_sample_size_evaluates_min_sample_size(power_curve):
+    power_curve(2)
+    result = find_sample_size(1.0, 0.0, min_sample_size=2, max_sample_size=4, seed=0)
+    assert result['sample_size'] == 2
+
+
+@pytest.mark.parametrize('kwargs', [{'max_trials': 0}, {'batch_trials': 0}])
+def test_trial_counts_are_validated(kwargs):
+    with pytest.raises(ValueError):
+        estimate_power(10, 0.5, 0.1, rng=numpy.random.default_rng(0), **kwargs)
+    with pytest.raises(ValueError):
+        find_sample_size(0.5, 0.1, seed=0, **kwargs)
+
+
+def test_batched_logrank_pike_estimate():
+    durations = numpy.array([[1.0, 2.0, 3.0, 4.0, 5.0, 6.0]])
+    events = numpy.array([[True, True, False, True, True, True]])
+    treated = numpy.array([[False, True, False, False, True, True]])
+    _, _, hazard_ratio = batched_logrank(durations, events, treated)
+    # at risk (treated/total) at each event: 3/6, 3/5, 2/3, 2/2, 1/1
+    expected = 3 / 6 + 3 / 5 + 2 / 3 + 2 / 2 + 1 / 1
+    observed = 3
+    assert hazard_ratio[0] == pytest.approx(
+        (observed / expected) / ((5 - observed) / (5 - expected))
+    )
+
+
+def test_batched_ttest_matches_scipy():
+    rng = numpy.random.default_rng(0)
+    treatment = rng.standard_normal((50, 12), dtype=numpy.float32) + 0.5
+    control = rng.standard_normal((50, 12), dtype=numpy.float32)
+    treatment_mask = rng.random((50, 12)) > 0.3
+    control_mask = rng.random((50, 12)) > 0.3
+    t_stat, p_value = batched_ttest(treatment, control, treatment_mask, control_mask)
+    for i in range(50):
+        expected = stats.ttest_ind(
+            treatment[i, treatment_mask[i]].astype(float), control[i, control_mask[i]].astype(float)
+        )
+        assert t_stat[i] == pytest.approx(expected.statistic, rel=1e-4)
+        assert p_value[i] == pytest.approx(expected.pvalue, rel=1e-4, abs=1e-9)
+
+
+def test_kaplan_meier_matches_lifelines():
+    rng = numpy.random.default_rng(0)
+    durations = numpy.round(rng.exponential(size=(20, 15)), 1) + 0.1  # rounded to have ties
+    events = rng.random((20, 15)) < 0.9
+    mask = rng.random((20, 15)) > 0.2
+    time_grid = numpy.linspace(0, 3, 25)
+    times, survival = kaplan_meier(durations, events, mask)
+    curves = survival_at(times, survival, time_grid)
+    for i in range(20):
+        kmf = KaplanMeierFitter().fit(durations[i, mask[i]], event_observed=events[i, mask[i]])
+        expected = kmf.survival_function_at_times(time_grid).to_numpy()
+        numpy.testing.assert_allclose(curves[i], expected, atol=1e-12)
+
+
+def test_simulate_trials_matches_simulate_trial():
+    """
+    the two draw different random numbers, so the per-trial reference and the batched engine are compared
+    by the distribution of their results
+    """
+    sample_size, effect_size, dropout_rate = 20, 0.5, 0.2
+    numpy.random.seed(0)
+    reference = [simulate_trial(sample_size, effect_size, dropout_rate) for _ in range(300)]
+    reference_p_values = numpy.array([trial['p_value'] for trial in reference])
+    reference_sizes = numpy.array([trial['sample_size'] for trial in reference])
+    results = simulate_trials(
+        20000, sample_size, effect_size, dropout_rate, rng=numpy.random.default_rng(0)
+    )
+
+    assert stats.ks_2samp(reference_p_values, results['p_value']).pvalue > 0.01
+    reference_power = (reference_p_values < 0.05).mean()
+    power = (results['p_value'] < 0.05).mean()
+    assert abs(power - reference_power) < 4 * numpy.sqrt(power * (1 - power) / len(reference))
+    # completed treatment participants are Binomial(sample_size, 1 - dropout_rate) in both
+    assert results['sample_size'].mean() == pytest.approx(16, abs=0.05)
+    assert stats.ks_2samp(reference_sizes, results['sample_size']).pvalue > 0.01
+
+
+def simulate_records(seed, workers):
+    chunks = iter_simulations(
+        2 * ctss_simulation.CHUNK_TRIALS + 5,
+        10,
+        0.3,
+        0.1,
+        seed=seed,
+        workers=workers,
+        time_grid=[-1.0, 0.0, 1.0],
+    )
+    return [chunk.copy() for chunk in chunks]
+
+
+def test_simulations_do_not_depend_on_workers():
+    serial = simulate_records(seed=7, workers=1)
+    assert [len(chunk) for chunk in serial] == ctss_simulation.chunk_sizes(
+        2 * ctss_simulation.CHUNK_TRIALS + 5
+    )
+    for workers in [1, 2, 3]:
+        chunks = simulate_records(seed=7, workers=workers)
+        assert len(chunks) == len(serial)
+        for chunk, expected in zip(chunks, serial):
+            numpy.testing.assert_array_equal(chunk, expected)
+    assert not numpy.array_equal(simulate_records(seed=8, workers=1)[0], serial[0])
+
+
+def test_run_simulations_is_reproducible():
+    first = run_simulations(1000, 10, 0.3, 0.1, seed=3, workers=2)
+    second = run_simulations(1000, 10, 0.3, 0.1, seed=3, workers=2)
+    assert first.equals(second)
+    assert first.equals(run_simulations(1000, 10, 0.3, 0.1, seed=3, workers=1))
+
+
+def test_batched_logrank_matches_lifelines():
+    rng = numpy.random.default_rng(0)
+    durations = rng.exponential(size=(10, 30))
+    events = rng.random((10, 30)) < 0.8
+    treated = rng.random((10, 30)) < 0.5
+    z_stat, p_value, _ = batched_logrank(durations, events, treated)
+    for i in range(10):
+        expected = logrank_test(
+            durations[i, treated[i]],
+            durations[i, ~treated[i]],
+            events[i, treated[i]],
+            events[i, ~treated[i]],
+        )
+        assert z_stat[i] ** 2 == pytest.approx(expected.test_statistic)
+        assert p_value[i] == pytest.approx(expected.p_value)
+
+
+@pytest.mark.parametrize('alpha', [0.01, 0.05])
+def test_logrank_type_one_error(alpha):
+    num_trials = 20000
+    results = simulate_survival_trials(
+        num_trials,
+        50,
+        hazard_ratio=1.0,
+        accrual_time=1.0,
+        follow_up_time=1.0,
+        dropout_hazard=0.1,
+        rng=numpy.random.default_rng(1),
+    )
+    rejection_rate = (results['p_value'] < alpha).mean()
+    assert abs(rejection_rate - alpha) < 4 * numpy.sqrt(alpha * (1 - alpha) / num_trials)
+
+
+TIME_GRID = [-1.0, 0.0, 0.5, 1.0]
+
+
+def test_run_simulations_trials_mode_columns():
+    trials = run_simulations(500, 10, 0.3, 0.1, seed=5, workers=1)
+    assert list(trials.columns) == ['p_value', 'sample_size']
+    trials = run_simulations(500, 10, 0.3, 0.1, seed=5, workers=1, time_grid=TIME_GRID)
+    assert list(trials.columns) == ['p_value', 'sample_size', 'survival_curve']
+    assert trials.survival_curve[0].shape == (len(TIME_GRID),)
+
+
+def test_run_simulations_stream_mode():
+    num_trials = ctss_simulation.CHUNK_TRIALS + 100
+    chunks = run_simulations(num_trials, 10, 0.3, 0.1, seed=5, workers=1, mode='stream')
+    assert isinstance(chunks, types.GeneratorType)
+    chunks = list(chunks)
+    assert [len(chunk) for chunk in chunks] == ctss_simulation.chunk_sizes(num_trials)
+    trials = run_simulations(num_trials, 10, 0.3, 0.1, seed=5, workers=1)
+    records = numpy.concatenate(chunks)
+    numpy.testing.assert_array_equal(records['p_value'], trials.p_value)
+    numpy.testing.assert_array_equal(records['sample_size'], trials.sample_size)
+
+
+def test_run_simulations_summary_mode():
+    num_trials = ctss_simulation.CHUNK_TRIALS + 100
+    kwargs = {'seed': 5, 'workers': 1, 'time_grid': TIME_GRID}
+    summary = run_simulations(num_trials, 10, 0.3, 0.1, mode='summary', alpha=0.1, **kwargs)
+    trials = run_simulations(num_trials, 10, 0.3, 0.1, **kwargs)
+
+    assert summary['trials'] == num_trials
+    assert summary['power'] == (trials.p_value < 0.1).mean()
+    assert summary['power_ci'][0] < summary['power'] < summary['power_ci'][1]
+    assert summary['mean_sample_size'] == pytest.approx(trials.sample_size.mean())
+    expected_histogram, _ = numpy.histogram(trials.p_value.dropna(), bins=summary['p_value_bins'])
+    numpy.testing.assert_array_equal(summary['p_value_histogram'], expected_histogram)
+
+    curves = numpy.stack(trials.survival_curve)
+    bands = summary['survival_bands']
+    assert list(bands.index) == TIME_GRID
+    for quantile in bands.columns:
+        expected = numpy.quantile(curves, quantile, axis=0, method='inverted_cdf')
+        # read from a histogram of 1000 bins
+        numpy.testing.assert_allclose(bands[quantile], expected, atol=1e-3)
+
+
+def test_run_simulations_unknown_mode():
+    with pytest.raises(ValueError):
+        run_simulations(10, 10, 0.3, 0.1, seed=5, workers=1, mode='records')
+
+
+# beta posterior parameters (treatment alpha, beta, control alpha, beta), from uniform to skewed and peaked
+BETA_POSTERIORS = numpy.array(
+    [
+        (1, 1, 1, 1),
+        (10, 20, 5, 25),
+        (50, 150, 40, 160),
+        (2, 1, 1, 2),
+        (300, 700, 250, 750),
+        (1, 1, 5, 2),
+        (1, 30, 1, 30),
+        (30, 1, 29, 2),
+    ],
+    dtype=float,
+)
+
+
+def test_posterior_superiority_matches_quadrature_and_monte_carlo():
+    probabilities = posterior_superiority(*BETA_POSTERIORS.T)
+    rng = numpy.random.default_rng(0)
+    for (alpha_t, beta_t, alpha_c, beta_c), probability in zip(BETA_POSTERIORS, probabilities):
+        expected, _ = integrate.quad(
+            lambda x: stats.beta.pdf(x, alpha_t, beta_t) * stats.beta.cdf(x, alpha_c, beta_c),
+            0,
+            1,
+            epsabs=1e-12,
+            limit=200,
+        )
+        assert probability == pytest.approx(expected, abs=1e-4)
+        draws = 400000
+        monte_carlo = (rng.beta(alpha_t, beta_t, draws) > rng.beta(alpha_c, beta_c, draws)).mean()
+        assert probability == pytest.approx(monte_carlo, abs=5e-3)
+
+
+def grid_posterior(outcome_sum, n, prior_sd, grid):
+    """
+    posterior of an arm mean evaluated numerically on a grid (rather than from the conjugate formulas)
+    """
+    log_density = -(grid**2) / (2 * prior_sd**2) + grid * outcome_sum - n * grid**2 / 2
+    density = numpy.exp(log_density - log_density.max())
+    return density / density.sum()
+
+
+@pytest.mark.parametrize(
+    'treatment_sum,treatment_n,control_sum,control_n,prior_sd',
+    [
+        (0.0, 0, 0.0, 0, 10.0),
+        (5.0, 20, 1.0, 20, 10.0),
+        (-3.0, 10, 2.0, 15, 10.0),
+        (30.0, 100, 20.0, 90, 1.0),
+        (0.5, 1, 0.0, 2, 0.5),
+    ],
+)
+def test_normal_posterior_superiority_matches_numerical_posterior(
+    treatment_sum, treatment_n, control_sum, control_n, prior_sd
+):
+    probability = normal_posterior_superiority(
+        numpy.array([treatment_sum]),
+        numpy.array([treatment_n]),
+        numpy.array([control_sum]),
+        numpy.array([control_n]),
+        prior_sd,
+    )[0]
+    grid = numpy.linspace(-60, 60, 200001)
+    treatment = grid_posterior(treatment_sum, treatment_n, prior_sd, grid)
+    control = grid_posterior(control_sum, control_n, prior_sd, grid)
+    # P(control mean < treatment mean), up to the grid spacing
+    expected = (treatment * (numpy.cumsum(control) - control / 2)).sum()
+    assert probability == pytest.approx(expected, abs=1e-4)
+    rng = numpy.random.default_rng(0)
+    draws = 400000
+    monte_carlo = (rng.choice(grid, draws, p=treatment) > rng.choice(grid, draws, p=control)).mean()
+    assert probability == pytest.approx(monte_carlo, abs=5e-3)
+
+
+@pytest.mark.parametrize(
+    'kwargs',
+    [
+        {'endpoint': 'binary', 'control_rate': 0.3, 'treatment_rate': 0.45},
+        {'endpoint': 'binary', 'control_rate': 0.3, 'treatment_rate': 0.3},
+        {'endpoint': 'normal', 'effect_size': 0.3},
+        {'endpoint': 'normal', 'effect_size': 0.0, 'adaptive_randomization': True},
+    ],
+)
+def test_adaptive_trials_stop_at_the_thresholds(kwargs):
+    num_looks, max_sample_size = 4, 200
+    efficacy_threshold, futility_threshold = 0.975, 0.1
+    result = simulate_adaptive_trials(
+        5000,
+        max_sample_size,
+        num_looks=num_looks,
+        efficacy_threshold=efficacy_threshold,
+        futility_threshold=futility_threshold,
+        rng=numpy.random.default_rng(0),
+        **kwargs,
+    )
+    trials = result['trials']
+    early = trials.stop_look < num_looks - 1
+    # both kinds of early stops happen, and only past their thresholds
+    assert (early & trials.success).any() and (early & ~trials.success).any()
+    assert (trials.posterior_probability[trials.success] > efficacy_threshold).all()
+    assert (trials.posterior_probability[early & ~trials.success] < futility_threshold).all()
+    # trials reaching the final analysis without efficacy are not stopped for futility
+    assert (trials.posterior_probability[~trials.success] <= efficacy_threshold).all()
+    assert result['stop_futility'][-1] == 0
+
+    # each trial enrolled every stage up to the look it stopped at
+    looks = numpy.round(numpy.linspace(0, max_sample_size, num_looks + 1)).astype(int)[1:]
+    numpy.testing.assert_array_equal(trials.sample_size, looks[trials.stop_look])
+    assert result['stop_efficacy'].sum() == pytest.approx(result['power'])
+    stopped = result['stop_efficacy'].sum() + result['stop_futility'].sum()
+    assert stopped == pytest.approx((trials.success | early).mean())
+
+
+@pytest.mark.parametrize('endpoint', ['binary', 'normal'])
+def test_adaptive_trials_without_early_stopping(endpoint):
+    result = simulate_adaptive_trials(
+        1000,
+        100,
+        endpoint=endpoint,
+        treatment_rate=0.5,
+        effect_size=0.5,
+        efficacy_threshold=1.0,
+        futility_threshold=0.0,
+        rng=numpy.random.default_rng(0),
+    )
+    assert (result['trials'].sample_size == 100).all()
+    assert result['power'] == 0
+    assert result['inconclusive'] == 1
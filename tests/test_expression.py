@@ -0,0 +1,194 @@
+import os
+import pickle
+
+import numpy
+import pandas
+import pytest
+
+pytest.importorskip('ipr')
+
+from modules.expression import (  # noqa: E402
+    EXPRESSION_DOWN,
+    EXPRESSION_UP,
+    DensityPlotCache,
+    ExpressionMatrix,
+    build_expression_store,
+    cohort_histograms,
+    load_zscore_data,
+)
+
+ZSCORE_THRESHOLD = 1
+PERCENTILE_THRESHOLD = 90
+
+
+@pytest.fixture
+def expression_matrix():
+    rng = numpy.random.default_rng(0)
+    genes = pandas.DataFrame({'gene': [f'GENE{i}' for i in range(8)], 'gene_id': range(8)})
+    samples = [f'sample{i}' for i in range(100)]
+    return ExpressionMatrix(genes, samples, rng.normal(size=(8, 100)), numpy.zeros((8, 100)))
+
+
+def test_histograms_are_reused(expression_matrix):
+    first = cohort_histograms(expression_matrix, ['GENE0', 'GENE1', 'GENE0'])
+    second = cohort_histograms(expression_matrix, ['GENE1'])
+    assert first[0] is first[2]
+    assert second[0] is first[1]
+    assert len(expression_matrix.histograms) == 2
+
+
+def test_histograms_are_bounded(expression_matrix):
+    histogram = cohort_histograms(expression_matrix, ['GENE0'])[0]
+    expression_matrix.histograms.max_bytes = 3 * (
+        histogram.values.nbytes + histogram.density.nbytes
+    )
+    histograms = cohort_histograms(expression_matrix, [f'GENE{i}' for i in range(8)])
+    assert 0 < len(expression_matrix.histograms) < 8
+    assert expression_matrix.histograms.nbytes <= expression_matrix.histograms.max_bytes
+    # the least recently used genes were evicted
+    assert expression_matrix.histograms.get('GENE7') is histograms[7]
+    assert expression_matrix.histograms.get('GENE0') is None
+
+
+def test_histograms_are_not_pickled(expression_matrix):
+    cohort_histograms(expression_matrix, ['GENE0'])
+    copy = pickle.loads(pickle.dumps(expression_matrix))
+    assert len(copy.histograms) == 0
+    assert copy.histograms.max_bytes == expression_matrix.histograms.max_bytes
+    assert cohort_histograms(copy, ['GENE0'])[0].gene == 'GENE0'
+
+
+def reference_sample_frames(filename, zscore_threshold, percentile_threshold):
+    """
+    The original long-frame implementation (percentile rows appended to the z-score rows, then
+    pivoted per sample), kept as the reference for ExpressionMatrix.sample_frame
+    """
+    df = pandas.read_csv(
+        filename, sep='\t', dtype={'Hugo_Symbol': 'string', 'Entrez_Gene_Id': 'string'}
+    )
+    df = df.rename(columns={'Hugo_Symbol': 'gene', 'Entrez_Gene_Id': 'gene_id'})
+    df['type'] = 'zscore'
+    ranks = df.copy().set_index('gene_id')
+    ranks = ranks.rank(0, pct=True, numeric_only=True).apply(lambda x: round(x * 100))
+    ranks['type'] = 'percentile'
+    ranks['gene_id'] = ranks.index
+    ranks = ranks.reset_index(drop=True)
+    ranks = ranks.merge(df[['gene_id', 'gene']], on='gene_id')
+    df = pandas.concat([df, ranks])
+
+    def categorize(row):
+        if row.diseaseZScore >= zscore_threshold:
+            if row.diseasePercentile >= percentile_threshold:
+                return EXPRESSION_UP
+        elif row.diseaseZScore <= (zscore_threshold * -1):
+            if row.diseasePercentile <= 100 - percentile_threshold:
+                return EXPRESSION_DOWN
+        return 0
+
+    frames = {}
+    for sample_id in [col for col in df.columns if col.startswith('sample')]:
+        expression = df[['gene', 'gene_id', sample_id, 'type']].copy()
+        expression = expression[~pandas.isnull(expression.gene)]
+        expression = pandas.pivot_table(
+            expression, columns=['type'], values=[sample_id], index=['gene']
+        ).reset_index()
+        expression.columns = [tup[-1] if tup[-1] else tup[-2] for tup in expression.columns.values]
+        expression = expression.rename(
+            columns={'percentile': 'diseasePercentile', 'zscore': 'diseaseZScore'}
+        )
+        expression['kbCategory'] = expression.apply(categorize, axis=1)
+        frames[sample_id] = expression
+    return frames
+
+
+@pytest.fixture
+def zscores_file(tmp_path):
+    rng = numpy.random.default_rng(1)
+    num_genes = 40
+    genes = [f'GENE{i}' for i in range(num_genes)]
+    # genes defined by several rows, and a row without a gene name
+    genes[5] = genes[6] = 'DUPLICATE'
+    genes[7] = None
+    df = pandas.DataFrame({'Hugo_Symbol': genes, 'Entrez_Gene_Id': range(1, num_genes + 1)})
+    for i in range(6):
+        values = numpy.round(rng.normal(scale=1.5, size=num_genes), 3)
+        values[rng.choice(num_genes, 3, replace=False)] = numpy.nan
+        df[f'sample{i}'] = values
+    df.loc[:, 'sample5'] = numpy.nan
+    df.loc[0, 'sample5'] = 1.5
+    filename = tmp_path / 'zscores.txt'
+    df.to_csv(filename, sep='\t', index=False)
+    return str(filename)
+
+
+def frame_by_gene(df):
+    df = df[['gene', 'diseasePercentile', 'diseaseZScore', 'kbCategory']]
+    return df.sort_values('gene', kind='stable').reset_index(drop=True)
+
+
+def assert_matches_reference(expression_matrix, expected):
+    assert sorted(expression_matrix.samples) == sorted(expected)
+    for sample_id, expected_df in expected.items():
+        result = expression_matrix.sample_frame(sample_id, ZSCORE_THRESHOLD, PERCENTILE_THRESHOLD)
+        # rows without a gene name are dropped by create_report, as they were before the pivot
+        result = result[result.gene.notna()]
+        pandas.testing.assert_frame_equal(
+            frame_by_gene(result), frame_by_gene(expected_df), check_dtype=False
+        )
+
+
+def test_sample_frame_matches_pivot(zscores_file):
+    expected = reference_sample_frames(zscores_file, ZSCORE_THRESHOLD, PERCENTILE_THRESHOLD)
+    # the thresholds are low enough for the small matrix to have outliers both ways
+    categories = pandas.concat(expected.values()).kbCategory
+    assert {EXPRESSION_UP, EXPRESSION_DOWN} <= set(categories)
+    assert_matches_reference(load_zscore_data(zscores_file), expected)
+
+
+def test_expression_store_matches_pivot(tmp_path, zscores_file):
+    expected = reference_sample_frames(zscores_file, ZSCORE_THRESHOLD, PERCENTILE_THRESHOLD)
+    store_dir = build_expression_store(zscores_file, str(tmp_path / 'store'), chunksize=7)
+    store = load_zscore_data(store_dir)
+    # memory-mapped read-only rather than loaded
+    assert not store.zscores.flags.writeable and not store.percentiles.flags.writeable
+    assert_matches_reference(store, expected)
+
+    in_memory = load_zscore_data(zscores_file)
+    numpy.testing.assert_array_equal(store.zscores, in_memory.zscores)
+    numpy.testing.assert_array_equal(store.percentiles, in_memory.percentiles)
+    pandas.testing.assert_frame_equal(store.genes, in_memory.genes)
+
+
+def write_plot(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def test_density_plot_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    plot_cache = DensityPlotCache(cache_dir, max_bytes=3000)
+
+    def no_scandir(path):
+        raise AssertionError('the cache directory was listed')
+
+    # storing and fetching only track the entries in memory
+    monkeypatch.setattr(os, 'scandir', no_scandir)
+    for i in range(3):
+        plot_cache.store(f'plot{i}.png', write_plot(tmp_path, f'plot{i}.png', 1000))
+    assert plot_cache.fetch('plot0.png', str(tmp_path / 'fetched.png'))
+    plot_cache.store('plot3.png', write_plot(tmp_path, 'plot3.png', 1000))
+    monkeypatch.undo()
+
+    # plot1 was the least recently used once plot0 was fetched
+    assert sorted(os.listdir(cache_dir)) == ['plot0.png', 'plot2.png', 'plot3.png']
+    assert plot_cache.nbytes == 3000
+    assert not plot_cache.fetch('plot1.png', str(tmp_path / 'fetched.png'))
+    assert (plot_cache.hits, plot_cache.misses) == (1, 1)
+
+    # a reopened cache picks up the entries, and a smaller budget evicts the oldest
+    for i, name in enumerate(['plot2.png', 'plot0.png', 'plot3.png']):
+        os.utime(os.path.join(cache_dir, name), (1000 + i, 1000 + i))
+    reopened = DensityPlotCache(cache_dir, max_bytes=2000)
+    assert list(reopened.entries) == ['plot0.png', 'plot3.png']
+    assert sorted(os.listdir(cache_dir)) == ['plot0.png', 'plot3.png']
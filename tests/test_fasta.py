@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from modules.fasta import INDEX_SUFFIX, IndexedFasta, build_fasta_index, index_path
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    filename = tmp_path / 'genome.fa'
+    filename.write_text('>chr1 first\nACGTACGTAC\nGTACGTAC\n>chr2\nTTTTT\nGG\n')
+    return str(filename)
+
+
+def test_fetch(fasta):
+    with IndexedFasta(fasta) as genome:
+        assert genome.lengths == {'chr1': 18, 'chr2': 7}
+        assert genome.fetch('chr1', 8, 12) == b'ACGT'
+        assert genome.fetch('chr2') == b'TTTTTGG'
+    assert os.path.exists(fasta + INDEX_SUFFIX)
+
+
+def test_index_dir(fasta, tmp_path):
+    index_dir = str(tmp_path / 'indexes')
+    with IndexedFasta(fasta, index_dir=index_dir) as genome:
+        assert genome.fetch('chr1', 16) == b'AC'
+    assert not os.path.exists(fasta + INDEX_SUFFIX)
+    assert os.listdir(index_dir) == [os.path.basename(index_path(fasta, index_dir))]
+    # the index is reused
+    mtime = os.path.getmtime(index_path(fasta, index_dir))
+    with IndexedFasta(fasta, index_dir=index_dir) as genome:
+        assert genome.references == ['chr1', 'chr2']
+    assert os.path.getmtime(index_path(fasta, index_dir)) == mtime
+
+
+def test_index_path_is_unique(tmp_path):
+    assert index_path(str(tmp_path / 'a' / 'genome.fa'), str(tmp_path)) != index_path(
+        str(tmp_path / 'b' / 'genome.fa'), str(tmp_path)
+    )
+
+
+@pytest.mark.parametrize(
+    'content,error',
+    [
+        ('>chr1\nACGT\n>\nACGT\n', 'line 3 has no name'),
+        ('>chr1\nACGT\n>  \nACGT\n', 'line 3 has no name'),
+        ('>chr1\nACGT\n>chr1 again\nACGT\n', 'chr1 is the name of several sequences'),
+    ],
+)
+def test_invalid_names(tmp_path, content, error):
+    filename = tmp_path / 'genome.fa'
+    filename.write_text(content)
+    with pytest.raises(ValueError, match=error):
+        build_fasta_index(str(filename))
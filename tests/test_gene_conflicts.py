@@ -0,0 +1,153 @@
+import pandas
+import pytest
+
+pytest.importorskip('graphkb')
+pytest.importorskip('ipr')
+
+import study  # noqa: E402
+from modules.expression import load_zscore_data  # noqa: E402
+from simulation.util import read_csv  # noqa: E402
+
+GENE_NAME = study.GENE_NAME
+GENE_ID = study.GENE_ID
+
+
+def original_find_conflicting_gene_names(
+    continuous_copy_variants_filename,
+    discrete_copy_variants_filename,
+    small_mutations_filename,
+    expression_filename,
+    fusions_filename,
+):
+    """
+    The original implementation which re-read every variant file in full, kept as the reference
+    for the column-projected one
+    """
+    genes_df = read_csv(small_mutations_filename)
+    genes_df = genes_df[['SYMBOL']].copy()
+    genes_df = genes_df.rename(columns={'SYMBOL': GENE_NAME})
+
+    for filename in [
+        discrete_copy_variants_filename,
+        continuous_copy_variants_filename,
+        expression_filename,
+    ]:
+        if not filename:
+            continue
+        df = read_csv(filename)
+        if GENE_ID in df.columns:
+            df = df[[GENE_NAME, GENE_ID]].copy()
+            genes_df = pandas.concat([genes_df, df])
+
+    if fusions_filename:
+        df = read_csv(fusions_filename)
+        if GENE_ID in df.columns:
+            genes_df = pandas.concat([genes_df, df[[GENE_NAME, GENE_ID]].copy()])
+            df[[GENE_NAME, 'Hugo_Symbol2']] = df.Fusion.str.split('-', n=1, expand=True)
+            genes_df = pandas.concat([genes_df, df[[GENE_NAME]].copy()])
+            genes_df = pandas.concat(
+                [genes_df, df[['Hugo_Symbol2']].rename(columns={'Hugo_Symbol2': GENE_NAME}).copy()]
+            )
+    genes_df = genes_df.drop_duplicates()
+    genes_df = genes_df.dropna(subset=[GENE_ID])
+    genes_df = genes_df.dropna(subset=[GENE_NAME])
+    return genes_df[genes_df.duplicated(GENE_NAME)][GENE_NAME].tolist()
+
+
+def write_genes(filename, genes, gene_ids, **columns):
+    df = pandas.DataFrame({GENE_NAME: genes, GENE_ID: gene_ids})
+    for name, value in columns.items():
+        df[name] = value
+    df.to_csv(filename, sep='\t', index=False)
+    return str(filename)
+
+
+@pytest.fixture
+def variant_files(tmp_path):
+    # CONF1 differs between the copy variant files, CONF2 between the copy variants and the
+    # expression (whose IDs are read as floats since one is missing), CONF3 with the fusions.
+    # DUP is defined twice with the same ID and the IDs of the small mutations (TP53) are ignored
+    discrete = write_genes(
+        tmp_path / 'cna.txt',
+        ['BRAF', 'KRAS', 'CONF1', 'CONF2', 'CONF3', 'DUP', 'DUP', 'NOID'],
+        [673, 3845, 100, 200, 300, 5, 5, None],
+        sample0=0,
+    )
+    continuous = write_genes(
+        tmp_path / 'log2cna.txt',
+        ['BRAF', 'KRAS', 'CONF1', None, 'NOID'],
+        [673, 3845, 101, 7, None],
+        sample0=0.5,
+    )
+    expression = write_genes(
+        tmp_path / 'zscores.txt',
+        ['BRAF', 'KRAS', 'CONF2', 'NOID', 'TP53'],
+        [673, 3845, 201, None, 7157],
+        sample0=[0.1, 0.2, 0.3, 0.4, 0.5],
+        sample1=[1.0, -1.0, 0.0, 2.0, 3.0],
+    )
+    fusions = write_genes(
+        tmp_path / 'fusions.txt',
+        ['CONF3', 'BRAF'],
+        [301, 673],
+        Fusion=['CONF3-KRAS fusion', 'BRAF-CONF1 fusion'],
+        Tumor_Sample_Barcode='sample0',
+        Frame='in_frame',
+        DNA_support='yes',
+        RNA_support='yes',
+    )
+    small_mutations = str(tmp_path / 'mutations.maf')
+    pandas.DataFrame(
+        {
+            'SYMBOL': ['TP53', 'TP53', 'MAFONLY', 'CONF1'],
+            GENE_ID: [1, 2, 3, 4],
+            'Tumor_Sample_Barcode': 'sample0',
+        }
+    ).to_csv(small_mutations, sep='\t', index=False)
+    return {
+        'continuous_copy_variants_filename': continuous,
+        'discrete_copy_variants_filename': discrete,
+        'small_mutations_filename': small_mutations,
+        'expression_filename': expression,
+        'fusions_filename': fusions,
+    }
+
+
+def test_find_conflicting_gene_names_matches_original(variant_files):
+    expected = original_find_conflicting_gene_names(**variant_files)
+    assert sorted(expected) == ['CONF1', 'CONF2', 'CONF3']
+    assert sorted(study.find_conflicting_gene_names(**variant_files)) == expected
+
+
+def test_loaded_gene_ids_match_original(variant_files):
+    """
+    generate_reports collects the gene IDs from the frames it has already loaded
+    """
+    expected = original_find_conflicting_gene_names(**variant_files)
+    conflicts = study.gene_name_conflicts(
+        study.load_copy_variants(
+            variant_files['discrete_copy_variants_filename'],
+            variant_files['continuous_copy_variants_filename'],
+        ),
+        load_zscore_data(variant_files['expression_filename']).genes,
+        study.read_gene_ids(variant_files['fusions_filename']),
+    )
+    assert sorted(conflicts) == sorted(expected)
+
+
+def test_files_without_gene_ids_have_no_conflicts(tmp_path, variant_files):
+    discrete = str(tmp_path / 'cna_names.txt')
+    pandas.DataFrame({GENE_NAME: ['CONF1', 'CONF1'], 'sample0': [0, 1]}).to_csv(
+        discrete, sep='\t', index=False
+    )
+    files = dict(
+        variant_files,
+        discrete_copy_variants_filename=discrete,
+        continuous_copy_variants_filename=None,
+        expression_filename=None,
+        fusions_filename=None,
+    )
+    # the original failed when none of the files defined gene IDs
+    with pytest.raises(KeyError):
+        original_find_conflicting_gene_names(**files)
+    assert study.find_conflicting_gene_names(**files) == []
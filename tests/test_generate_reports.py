@@ -0,0 +1,157 @@
+import json
+import logging
+
+import pandas
+import pytest
+import requests
+
+pytest.importorskip('graphkb')
+pytest.importorskip('ipr')
+
+import study  # noqa: E402
+
+from .stub_server import StubServer, closed_port_url  # noqa: E402
+
+NUM_SAMPLES = 12
+
+
+@pytest.fixture
+def study_files(tmp_path):
+    patients = [f'patient{i}' for i in range(NUM_SAMPLES)]
+    samples = [f'sample{i}' for i in range(NUM_SAMPLES)]
+    pandas.DataFrame({'PATIENT_ID': patients, 'SEX': 'Female', 'DAYS_TO_BIRTH': -20000}).to_csv(
+        tmp_path / 'patients.txt', sep='\t', index=False
+    )
+    pandas.DataFrame(
+        {'PATIENT_ID': patients, 'SAMPLE_ID': samples, 'CANCER_TYPE_DETAILED': 'Lung (NOS)'}
+    ).to_csv(tmp_path / 'samples.txt', sep='\t', index=False)
+    copy_variants = pandas.DataFrame(
+        {'Hugo_Symbol': ['BRAF', 'KRAS'], 'Entrez_Gene_Id': [673, 3845]}
+    )
+    for i, sample_id in enumerate(samples):
+        copy_variants[sample_id] = [i % 5 - 2, 0]
+    copy_variants.to_csv(tmp_path / 'cna.txt', sep='\t', index=False)
+    pandas.DataFrame(
+        {
+            'Chromosome': '7',
+            'HGVSg': '',
+            'HGVSc': 'c.1799T>A',
+            'SYMBOL': 'BRAF',
+            'Transcript_ID': 'ENST00000288602',
+            'HGVSp_Short': 'V600E',
+            'Tumor_Sample_Barcode': samples[::2],
+            'Matched_Norm_Sample_Barcode': 'normal',
+            't_alt_count': 10,
+            't_ref_count': 20,
+            'n_ref_count': 30,
+            'n_alt_count': 0,
+            'n_depth': 30,
+            't_depth': 30,
+            'Reference_Allele': 'T',
+            'Allele': 'A',
+            'Start_Position': 140453136,
+            'End_Position': 140453136,
+            'NCBI_Build': 'GRCh37',
+        }
+    ).to_csv(tmp_path / 'mutations.maf', sep='\t', index=False)
+    return {
+        'patients_filename': str(tmp_path / 'patients.txt'),
+        'samples_filename': str(tmp_path / 'samples.txt'),
+        'continuous_copy_variants_filename': None,
+        'discrete_copy_variants_filename': str(tmp_path / 'cna.txt'),
+        'small_mutations_filename': str(tmp_path / 'mutations.maf'),
+        'expression_filename': None,
+        'fusions_filename': None,
+    }
+
+
+def post_report(content, ipr_url, **kwargs):
+    """
+    Stand-in for ipr.main.create_report which uploads the report content to the stub IPR server
+    """
+    resp = requests.post(f'{ipr_url}/reports', json=content, timeout=5)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def respond_with_ident(method, path, body):
+    sample_id = json.loads(body)['biopsyName']
+    if sample_id == 'sample5':
+        return 500, {'error': 'failed to create the report'}, 0
+    return 200, {'ident': f'report-{sample_id}'}, 0.01
+
+
+def run_reports(study_files, url, **kwargs):
+    study.generate_reports(
+        'study',
+        **study_files,
+        username='user',
+        password='pass',
+        ipr_url=url,
+        ipr_project='TEST',
+        retry_delay=0,
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def ipr_server(monkeypatch):
+    monkeypatch.setattr(study.main, 'create_report', post_report)
+    with StubServer(respond_with_ident) as server:
+        yield server
+
+
+def report_logs(caplog):
+    return [record.getMessage() for record in caplog.records if record.name == study.logger.name]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_generate_reports_creates_every_report(study_files, ipr_server, caplog, workers):
+    caplog.set_level(logging.INFO, logger=study.logger.name)
+    run_reports(study_files, ipr_server.url, workers=workers, retries=2)
+
+    created = [json.loads(body)['biopsyName'] for _, _, body in ipr_server.requests]
+    assert sorted(created) == sorted(f'sample{i}' for i in range(NUM_SAMPLES))
+    # the failed report is skipped, and creating a report is never sent twice
+    assert created.count('sample5') == 1
+    logs = report_logs(caplog)
+    assert 'skipping to the next report' in logs
+    starts = [message for message in logs if message.startswith('creating a report for')]
+    assert starts == [f'creating a report for patient{i} sample{i}' for i in range(NUM_SAMPLES)]
+
+
+def test_generate_reports_logs_in_sample_order(study_files, ipr_server, caplog):
+    caplog.set_level(logging.INFO, logger=study.logger.name)
+    run_reports(study_files, ipr_server.url, workers=1)
+    serial = report_logs(caplog)
+    caplog.clear()
+    run_reports(study_files, ipr_server.url, workers=6)
+    assert report_logs(caplog) == serial
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_generate_reports_strict(study_files, ipr_server, workers):
+    with pytest.raises(requests.HTTPError):
+        run_reports(study_files, ipr_server.url, workers=workers, strict=True)
+
+
+def test_generate_reports_retries_refused_connections(study_files, monkeypatch):
+    attempts = []
+
+    def refuse_once(content, ipr_url, **kwargs):
+        attempts.append(content['biopsyName'])
+        if attempts.count(content['biopsyName']) == 1:
+            return post_report(content, closed_port_url())
+        return {'ident': f'report-{content["biopsyName"]}'}
+
+    monkeypatch.setattr(study.main, 'create_report', refuse_once)
+    run_reports(study_files, closed_port_url(), workers=3, retries=1, strict=True)
+    assert sorted(attempts) == sorted(f'sample{i}' for i in range(NUM_SAMPLES) for _ in range(2))
+
+
+def test_generate_reports_partitioned_small_mutations(study_files, ipr_server):
+    run_reports(study_files, ipr_server.url, workers=1)
+    in_memory = [json.loads(body) for _, _, body in ipr_server.requests]
+    ipr_server.requests.clear()
+    run_reports(study_files, ipr_server.url, workers=1, small_mutations_chunksize=2)
+    assert [json.loads(body) for _, _, body in ipr_server.requests] == in_memory
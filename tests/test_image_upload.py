@@ -0,0 +1,146 @@
+import email
+import email.policy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from modules.image_upload import ImageUploader, MultipartBody
+
+from .stub_server import closed_port_url
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the IPR image endpoint. Records the images of every request it receives
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *pos):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = email.message_from_bytes(
+            f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf8') + body,
+            policy=email.policy.HTTP,
+        )
+        images = {}
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                images[name] = part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_payload(decode=True).decode('utf8')
+        self.server.received.append(
+            {
+                'path': self.path,
+                'images': images,
+                'fields': fields,
+                'port': self.client_address[1],
+                'authorized': 'Authorization' in self.headers,
+            }
+        )
+        response = json.dumps([{'key': key, 'upload': 'successful'} for key in images]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+@pytest.fixture
+def image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def images(tmp_path):
+    files = {}
+    for i in range(45):
+        path = tmp_path / f'G{i}.png'
+        path.write_bytes(bytes([i]) * (1000 + i))
+        files[f'expDensity.G{i}'] = str(path)
+    return files
+
+
+def test_multipart_body_length_matches_content(images):
+    body = MultipartBody(dict(list(images.items())[:3]), {'title': 'a title'})
+    assert len(body) == len(b''.join(body))
+
+
+def test_post_images_batches_within_limits(image_server, images):
+    uploader = ImageUploader(
+        'user', 'pass', f'http://127.0.0.1:{image_server.server_port}/api', max_request_bytes=30000
+    )
+    uploader.post_images('report1', images, {'expDensity.G0_title': 'G0 title'})
+    uploader.close()
+
+    received = image_server.received
+    assert all(request['path'] == '/api/reports/report1/image' for request in received)
+    assert all(request['authorized'] for request in received)
+    assert all(len(request['images']) <= 20 for request in received)
+    assert all(sum(map(len, request['images'].values())) <= 30000 for request in received)
+    # every image is sent once, intact
+    uploaded = {key: data for request in received for key, data in request['images'].items()}
+    assert sorted(uploaded) == sorted(images)
+    for key, path in images.items():
+        with open(path, 'rb') as fh:
+            assert uploaded[key] == fh.read()
+    assert received[0]['fields'] == {'expDensity.G0_title': 'G0 title'}
+
+    stats = uploader.stats()
+    assert stats['requests'] == len(received)
+    assert stats['images'] == len(images)
+
+
+def test_post_images_reuses_pooled_connection(image_server, images):
+    uploader = ImageUploader('user', 'pass', f'http://127.0.0.1:{image_server.server_port}/api')
+    for report_id in ['report1', 'report2', 'report3']:
+        uploader.post_images(report_id, dict(list(images.items())[:2]))
+    uploader.close()
+
+    assert len(image_server.received) == 3
+    assert len({request['port'] for request in image_server.received}) == 1
+
+
+def test_post_images_missing_file(image_server, tmp_path):
+    uploader = ImageUploader('user', 'pass', f'http://127.0.0.1:{image_server.server_port}/api')
+    with pytest.raises(FileNotFoundError):
+        uploader.post_images('report1', {'expDensity.G0': str(tmp_path / 'missing.png')})
+    assert not image_server.received
+
+
+def test_post_images_retries_only_the_failed_batch(image_server, images):
+    uploader = ImageUploader(
+        'user', 'pass', f'http://127.0.0.1:{image_server.server_port}/api', retries=2, retry_delay=0
+    )
+    session_post = uploader.session.post
+    attempts = []
+
+    def refuse_second_batch(url, **kwargs):
+        attempts.append(url)
+        if len(attempts) == 2:
+            # the connection for the second batch is refused once
+            return session_post(closed_port_url(), **kwargs)
+        return session_post(url, **kwargs)
+
+    uploader.session.post = refuse_second_batch
+    uploader.post_images('report1', images)
+    uploader.close()
+
+    received = image_server.received
+    assert len(attempts) == len(received) + 1
+    keys = [key for request in received for key in request['images']]
+    # every image is posted exactly once
+    assert sorted(keys) == sorted(images)
+    assert uploader.stats()['images'] == len(images)
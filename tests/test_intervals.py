@@ -0,0 +1,78 @@
+import numpy
+import pandas
+import pytest
+
+from modules.intervals import IntervalIndex, regions_to_genes
+
+
+def brute_force_overlaps(chroms, starts, ends, query_chroms, query_starts, query_ends):
+    ends = numpy.maximum(ends, starts + 1)
+    query_ends = numpy.maximum(query_ends, query_starts + 1)
+    return sorted(
+        (query, row)
+        for query in range(len(query_starts))
+        for row in range(len(starts))
+        if chroms[row] == query_chroms[query]
+        and starts[row] < query_ends[query]
+        and ends[row] > query_starts[query]
+    )
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_overlaps(seed):
+    rng = numpy.random.default_rng(seed)
+    chroms = rng.choice(['chr1', 'chr2', 'chr3'], 50)
+    starts = rng.integers(0, 100, 50)
+    ends = starts + rng.choice([0, 0, 1, 3, 10, 80], 50)
+    query_chroms = rng.choice(['chr1', 'chr2', 'chrX'], 40)
+    query_starts = rng.integers(0, 110, 40)
+    query_ends = query_starts + rng.choice([0, 1, 5, 30], 40)
+
+    query_rows, rows = IntervalIndex(chroms, starts, ends).overlaps(
+        query_chroms, query_starts, query_ends
+    )
+    assert list(zip(query_rows, rows)) == sorted(
+        zip(query_rows, rows), key=lambda pair: (pair[0], starts[pair[1]])
+    )
+    assert sorted(zip(query_rows.tolist(), rows.tolist())) == brute_force_overlaps(
+        chroms, starts, ends, query_chroms, query_starts, query_ends
+    )
+
+
+def test_empty_intervals():
+    index = IntervalIndex(['chr1'], [10], [10])
+    query_rows, _ = index.overlaps(['chr1'] * 4, [10, 9, 9, 11], [11, 11, 10, 12])
+    assert query_rows.tolist() == [0, 1]
+    rows, distances = index.nearest(['chr1', 'chr1', 'chr1'], [10, 11, 8])
+    assert rows.tolist() == [0, 0, 0]
+    assert distances.tolist() == [0, 1, 2]
+
+
+def test_long_interval():
+    # a long interval before every other one does not change the overlaps of the others
+    starts = numpy.arange(0, 10000, 10)
+    index = IntervalIndex(['chr1'] * (len(starts) + 1), [0, *starts], [10**6, *(starts + 5)])
+    query_rows, rows = index.overlaps(['chr1'] * 3, [2, 5002, 9998], [3, 5003, 9999])
+    assert query_rows.tolist() == [0, 0, 1, 1, 2]
+    assert rows.tolist() == [0, 1, 0, 501, 0]
+
+
+def test_regions_to_genes():
+    genes = pandas.DataFrame(
+        {
+            'gene': ['A', 'B'],
+            'chrom': ['chr1', 'chr1'],
+            'strand': ['+', '-'],
+            'start': [1000, 5000],
+            'end': [2000, 8000],
+        }
+    )
+    genes['tss'] = numpy.where(genes['strand'] == '-', genes['end'] - 1, genes['start'])
+    regions = pandas.DataFrame(
+        {'chrom': ['chr1', 'chr1'], 'start': [900, 4000], 'end': [1100, 4100]}
+    )
+    result = regions_to_genes(regions, genes, window=500)
+    assert result[['start', 'gene', 'distance', 'nearest']].values.tolist() == [
+        [900, 'A', 0, True],
+        [4000, 'A', 3050, True],
+    ]
@@ -0,0 +1,67 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from modules.kmers import count_fasta_kmers, kmer_hash, ordered_map
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    filename = tmp_path / 'seqs.fa'
+    records = {
+        f'seq{i}': ''.join(itertools.islice(itertools.cycle('AACGTTTNGCA'), i, 40 + i))
+        for i in range(6)
+    }
+    with open(filename, 'w') as fh:
+        for name, sequence in records.items():
+            fh.write(f'>{name}\n{sequence[:20]}\n{sequence[20:]}\n')
+    return str(filename)
+
+
+def test_kmer_hash_canonical():
+    assert kmer_hash('TTTTT', canonical=True) == kmer_hash('AAAAA') == 0
+    assert kmer_hash('ACGTA', canonical=True) == kmer_hash('TACGT', canonical=True)
+    with pytest.raises(ValueError):
+        kmer_hash('ACNGT')
+
+
+def test_canonical_counts(fasta):
+    counts = count_fasta_kmers(fasta, k=3, canonical=True, kmers=['AAC', 'GTT', 'TTT', 'AAA'])
+    plain = count_fasta_kmers(fasta, k=3, workers=1)
+    # non-canonical k-mers are counted together with their reverse complement
+    assert (counts['AAC'] == counts['GTT']).all()
+    assert (counts['AAC'] == plain['AAC'] + plain['GTT']).all()
+    assert (counts['TTT'] == plain['TTT'] + plain['AAA']).all()
+    assert counts['TTT'].sum() > 0
+
+
+def test_canonical_default_columns(fasta):
+    counts = count_fasta_kmers(fasta, k=3, canonical=True, workers=1)
+    kmers = list(counts.columns[3:])
+    assert len(kmers) == 32
+    assert 'AAA' in kmers and 'TTT' not in kmers
+    plain = count_fasta_kmers(fasta, k=3, workers=1)
+    assert counts[kmers].to_numpy().sum() == plain.iloc[:, 3:].to_numpy().sum()
+
+
+def test_workers(fasta):
+    serial = count_fasta_kmers(fasta, k=4, window=10, step=5, workers=1)
+    parallel = count_fasta_kmers(fasta, k=4, window=10, step=5, workers=2)
+    assert serial.equals(parallel)
+
+
+def test_ordered_map_is_bounded():
+    taken = []
+
+    def tasks():
+        for i in range(20):
+            taken.append(i)
+            yield i
+
+    with ThreadPoolExecutor(2) as executor:
+        for result in ordered_map(executor, lambda x: x * 2, tasks(), max_pending=3):
+            # never more than max_pending tasks taken ahead of the result being collected
+            assert len(taken) <= result // 2 + 4
+            assert taken[result // 2] == result // 2
+    assert len(taken) == 20
@@ -0,0 +1,47 @@
+import os
+import shutil
+
+import pytest
+
+from modules.machine_learning import MachineLearning
+from modules.motif_models import MODEL_DIR
+from modules.motif_trees import compile_motif_models
+
+MOTIF_FEATURES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'data',
+    'fake_data',
+    'motif_features.csv',
+)
+
+
+def test_predict_drug_target_compiled(tmp_path):
+    compile_motif_models(MODEL_DIR, str(tmp_path))
+    scores = MachineLearning(compiled_dir=str(tmp_path)).predict_drug_target(MOTIF_FEATURES)
+    assert scores.shape == (3, len(os.listdir(MODEL_DIR)))
+    assert ((scores > 0) & (scores < 1)).all().all()
+
+
+def test_predict_drug_target_without_models(tmp_path):
+    ml = MachineLearning(model_dir=str(tmp_path), compiled_dir=str(tmp_path / 'compiled'))
+    with pytest.raises(ValueError, match='no motif models'):
+        ml.predict_drug_target(MOTIF_FEATURES)
+
+
+def test_predict_drug_target_missing_features(tmp_path):
+    shutil.copy(MOTIF_FEATURES, tmp_path / 'features.csv')
+    with open(tmp_path / 'features.csv', 'r') as fh:
+        lines = fh.read().replace('f19', 'other')
+    with open(tmp_path / 'features.csv', 'w') as fh:
+        fh.write(lines)
+    with pytest.raises(ValueError, match='f19'):
+        MachineLearning().predict_drug_target(str(tmp_path / 'features.csv'))
+
+
+def test_predict_drug_target_unusable_pickles(tmp_path):
+    xgboost = pytest.importorskip('xgboost')
+    if int(xgboost.__version__.split('.')[0]) < 3:
+        pytest.skip('xgboost<3 loads the pickled models')
+    ml = MachineLearning(compiled_dir=str(tmp_path))
+    with pytest.raises(ValueError, match='compile_motif_models'):
+        ml.predict_drug_target(MOTIF_FEATURES)
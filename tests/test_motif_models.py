@@ -0,0 +1,42 @@
+import numpy
+import pytest
+
+from modules.motif_models import ModelRegistry, load_pickled_model
+from modules.motif_trees import CompiledModels, compile_motif_models
+
+xgboost = pytest.importorskip('xgboost')
+XGBOOST_MAJOR = int(xgboost.__version__.split('.')[0])
+
+
+@pytest.fixture(scope='module')
+def registry():
+    return ModelRegistry()
+
+
+@pytest.mark.skipif(XGBOOST_MAJOR < 3, reason='xgboost<3 loads the legacy boosters')
+def test_load_pickled_model_error(registry):
+    with pytest.raises(ValueError, match='legacy binary booster'):
+        load_pickled_model(registry.paths[registry.motifs[0]])
+
+
+@pytest.mark.skipif(XGBOOST_MAJOR >= 3, reason='xgboost>=3 cannot load the legacy boosters')
+def test_predict_all(registry):
+    features = numpy.random.default_rng(0).normal(size=(100, 20)).astype(numpy.float32)
+    scores = registry.predict_all(features, motifs=registry.motifs[:5], workers=2)
+    assert scores.shape == (100, 5)
+    assert ((scores > 0) & (scores < 1)).all()
+    # one model at a time gives the same scores
+    for column, motif in enumerate(registry.motifs[:5]):
+        booster = load_pickled_model(registry.paths[motif])
+        numpy.testing.assert_array_equal(scores[:, column], booster.inplace_predict(features))
+
+
+@pytest.mark.skipif(XGBOOST_MAJOR >= 3, reason='xgboost>=3 cannot load the legacy boosters')
+def test_compiled_models_match_boosters(registry, tmp_path):
+    features = numpy.random.default_rng(0).normal(size=(100, 20)).astype(numpy.float32)
+    features[::7, 3] = numpy.nan
+    motifs = registry.motifs[:5]
+    compile_motif_models(registry.model_dir, str(tmp_path))
+    compiled = CompiledModels.open(str(tmp_path)).predict(features, motifs=motifs)
+    scores = registry.predict_all(features, motifs=motifs, workers=2)
+    numpy.testing.assert_allclose(compiled, scores, atol=1e-6)
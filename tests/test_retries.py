@@ -0,0 +1,84 @@
+import pytest
+import requests
+
+from simulation.util import call_with_retries, is_transient_error
+
+from .stub_server import StubServer, closed_port_url
+
+
+@pytest.fixture
+def server():
+    with StubServer() as server:
+        yield server
+
+
+def get(url):
+    resp = requests.get(url, timeout=5)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def post(url, timeout=5):
+    resp = requests.post(url, json={'report': 1}, timeout=timeout)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def test_idempotent_request_retried_on_5xx(server):
+    server.script = [(503, {}, 0), (502, {}, 0), (200, {'ok': True}, 0)]
+    assert call_with_retries(get, server.url, retries=3, retry_delay=0) == {'ok': True}
+    assert len(server.requests) == 3
+
+
+def test_4xx_not_retried(server):
+    server.script = [(404, {}, 0), (200, {}, 0)]
+    with pytest.raises(requests.HTTPError):
+        call_with_retries(get, server.url, retries=3, retry_delay=0)
+    assert len(server.requests) == 1
+
+
+def test_non_idempotent_request_not_resent_after_5xx(server):
+    server.script = [(500, {}, 0), (200, {}, 0)]
+    with pytest.raises(requests.HTTPError):
+        call_with_retries(post, server.url, retries=3, retry_delay=0, idempotent=False)
+    assert len(server.requests) == 1
+
+
+def test_non_idempotent_request_not_resent_after_read_timeout(server):
+    # the server received (and may have acted on) the request before the client gave up
+    server.script = [(200, {}, 0.5)]
+    with pytest.raises(requests.ReadTimeout):
+        call_with_retries(post, server.url, timeout=0.1, retries=3, retry_delay=0, idempotent=False)
+    assert len(server.requests) == 1
+
+
+def test_idempotent_request_retried_after_read_timeout(server):
+    server.script = [(200, {}, 0.5), (200, {'ok': True}, 0)]
+    result = call_with_retries(post, server.url, timeout=0.2, retries=1, retry_delay=0)
+    assert result == {'ok': True}
+    assert len(server.requests) == 2
+
+
+def test_non_idempotent_request_resent_when_connection_refused():
+    attempts = []
+
+    def create():
+        attempts.append(1)
+        return post(closed_port_url())
+
+    with pytest.raises(requests.ConnectionError) as err:
+        call_with_retries(create, retries=2, retry_delay=0, idempotent=False)
+    assert is_transient_error(err.value, idempotent=False)
+    assert len(attempts) == 3
+
+
+def test_other_errors_not_retried():
+    attempts = []
+
+    def fail():
+        attempts.append(1)
+        raise ValueError('not a request error')
+
+    with pytest.raises(ValueError):
+        call_with_retries(fail, retries=3, retry_delay=0)
+    assert len(attempts) == 1
@@ -0,0 +1,168 @@
+import os
+import time
+
+import numpy
+import pandas
+import pytest
+
+pytest.importorskip('graphkb')
+pytest.importorskip('ipr')
+
+import study  # noqa: E402
+
+BENCHMARK_ROWS = [10000, 100000, 1000000]
+
+
+def rowwise_normalize_small_mutations(mutations_df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    The original per-row implementation of the small mutation normalization, kept as the
+    reference for the vectorized one
+    """
+    mutations_df = mutations_df.rename(
+        columns={
+            'Chromosome': 'chromosome',
+            'HGVSg': 'hgvsGenomic',
+            'HGVSc': 'hgvsCds',
+            'SYMBOL': 'gene',
+            'Transcript_ID': 'transcript',
+            'HGVSp_Short': 'proteinChange',
+            'Tumor_Sample_Barcode': 'sample_id',
+            'Matched_Norm_Sample_Barcode': 'normalLibrary',
+            't_alt_count': 'tumourAltCount',
+            't_ref_count': 'tumourRefCount',
+            'n_ref_count': 'normalRefCount',
+            'n_alt_count': 'normalAltCount',
+            'n_depth': 'normalDepth',
+            't_depth': 'tumourDepth',
+            'Reference_Allele': 'refSeq',
+            'Allele': 'altSeq',
+            'Start_Position': 'startPosition',
+            'End_Position': 'endPosition',
+            'NCBI_Build': 'ncbiBuild',
+        }
+    )
+
+    def normalize_protein_change(proteinChange):
+        if pandas.isnull(proteinChange):
+            return ''
+        if proteinChange.endswith('_splice'):
+            proteinChange = proteinChange.replace('_splice', 'spl')
+        if not proteinChange.startswith('p.'):
+            proteinChange = 'p.' + proteinChange
+        return proteinChange
+
+    mutations_df['proteinChange'] = mutations_df['proteinChange'].apply(normalize_protein_change)
+
+    def hgvs_protein(row):
+        if pandas.isnull(row['proteinChange']) or not row['proteinChange'].strip():
+            return ''
+        return row['gene'] + ':' + row['proteinChange']
+
+    def hgvs_cds(row):
+        if pandas.isnull(row.hgvsCds):
+            return ''
+        if ':' not in row.hgvsCds:
+            return f'{row.transcript}:{row.hgvsCds}'
+        return row.hgvsCds
+
+    mutations_df['hgvsProtein'] = mutations_df.apply(hgvs_protein, axis=1)
+    mutations_df['hgvsCds'] = mutations_df.apply(hgvs_cds, axis=1)
+    mutations_df['refSeq'] = mutations_df.refSeq.replace('-', '')
+    mutations_df['altSeq'] = mutations_df.altSeq.replace('-', '')
+    mutations_df['hgvsGenomic'] = ''
+    mutations_df = mutations_df[study.SMALL_MUTATION_COLUMNS]
+
+    def choose_main_variant(row):
+        if row.proteinChange:
+            return row.proteinChange
+        if row.hgvsCds:
+            return row.hgvsCds.split(':')[1] if ':' in row.hgvsCds else row.hgvsCds
+        if row.hgvsGenomic:
+            return row.hgvsGenomic.split(':')[1] if ':' in row.hgvsGenomic else row.hgvsGenomic
+        return row.proteinChange
+
+    mutations_df['proteinChange'] = mutations_df.apply(choose_main_variant, axis=1)
+    return mutations_df.drop_duplicates()
+
+
+def write_maf(filename: str, num_rows: int, seed: int = 0) -> str:
+    """
+    Write a MAF file mixing the notations which each branch of the normalization handles
+    (splice sites, missing and prefixed protein changes, cds notation with and without a
+    transcript, NA values and deletions)
+    """
+    rng = numpy.random.default_rng(seed)
+
+    def choice(values):
+        return rng.choice(numpy.array(values, dtype=object), num_rows)
+
+    pandas.DataFrame(
+        {
+            'Chromosome': choice(['1', '17', 'X']),
+            'HGVSg': '',
+            'HGVSc': choice(['c.1799T>A', 'ENST00000288602:c.35G>A', '', 'NA', 'ENST2:c.3:x']),
+            'SYMBOL': choice(['BRAF', 'KRAS', 'TP53', 'NA']),
+            'Transcript_ID': choice(['ENST00000288602', 'ENST00000256078', 'NA']),
+            'HGVSp_Short': choice(
+                ['V600E', 'p.G12D', 'X123_splice', 'p.X1_splice', '', 'NA', '  ', 'p.']
+            ),
+            'Tumor_Sample_Barcode': choice([f'sample{i}' for i in range(50)]),
+            'Matched_Norm_Sample_Barcode': 'normal',
+            't_alt_count': rng.integers(0, 50, num_rows),
+            't_ref_count': rng.integers(0, 50, num_rows),
+            'n_ref_count': rng.integers(0, 50, num_rows),
+            'n_alt_count': 0,
+            'n_depth': 50,
+            't_depth': 50,
+            'Reference_Allele': choice(['A', 'C', '-']),
+            'Allele': choice(['T', 'G', '-']),
+            'Start_Position': rng.integers(1, 10 ** 8, num_rows),
+            'End_Position': rng.integers(1, 10 ** 8, num_rows),
+            'NCBI_Build': 'GRCh37',
+        }
+    ).to_csv(filename, sep='\t', index=False)
+    return filename
+
+
+@pytest.mark.parametrize('num_rows', [1, 100, 5000])
+def test_normalize_small_mutations_matches_rowwise(tmp_path, num_rows):
+    filename = write_maf(str(tmp_path / 'mutations.maf'), num_rows)
+    expected = rowwise_normalize_small_mutations(study.read_small_mutations(filename))
+    result = study.load_small_mutations(filename)
+    pandas.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason='set RUN_BENCHMARKS=1 to run')
+@pytest.mark.parametrize('num_rows', BENCHMARK_ROWS)
+def test_benchmark_normalize_small_mutations(tmp_path, num_rows):
+    filename = write_maf(str(tmp_path / 'mutations.maf'), num_rows)
+    mutations_df = study.read_small_mutations(filename)
+
+    start_time = time.perf_counter()
+    expected = rowwise_normalize_small_mutations(mutations_df.copy())
+    rowwise_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    result = study.normalize_small_mutations(mutations_df.copy())
+    seconds = time.perf_counter() - start_time
+
+    print(
+        f'\n{num_rows} rows: row-wise {rowwise_seconds:.2f}s, vectorized {seconds:.2f}s '
+        f'({rowwise_seconds / seconds:.1f}x)'
+    )
+    pandas.testing.assert_frame_equal(result, expected)
+    assert seconds < rowwise_seconds
+
+
+@pytest.mark.parametrize('chunksize', [7, 100, 5000])
+def test_partitions_match_in_memory(tmp_path, chunksize):
+    filename = write_maf(str(tmp_path / 'mutations.maf'), 600, seed=1)
+    expected = study.split_by_sample(study.load_small_mutations(filename))
+    partitions_dir = tmp_path / 'partitions'
+    partitions_dir.mkdir()
+    partitions = study.partition_small_mutations(filename, str(partitions_dir), chunksize=chunksize)
+    assert sorted(partitions) == sorted(expected)
+    for sample_id, sample_df in expected.items():
+        pandas.testing.assert_frame_equal(
+            study.load_small_mutations_partition(partitions[sample_id]),
+            sample_df.reset_index(drop=True),
+        )
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from simulation import cache as cache_module
+from simulation.cache import StudyCache
+
+calls = []
+
+
+def load_lines(filename, strip=True):
+    calls.append(filename)
+    with open(filename, 'r') as fh:
+        return [line.strip() if strip else line for line in fh]
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    calls.clear()
+    filename = tmp_path / 'input.txt'
+    filename.write_text('a\nb\n')
+    return str(filename)
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    hashed = []
+    hash_file = cache_module.hash_file
+
+    def counting_hash_file(filename):
+        hashed.append(filename)
+        return hash_file(filename)
+
+    monkeypatch.setattr(cache_module, 'hash_file', counting_hash_file)
+    return hashed
+
+
+def set_mtime(filename, mtime_ns):
+    os.utime(filename, ns=(mtime_ns, mtime_ns))
+
+
+def test_unchanged_input_is_not_parsed_again(tmp_path, input_file, hashed):
+    cache_dir = str(tmp_path / 'cache')
+    first = StudyCache(cache_dir).load(load_lines, input_file)
+    # a new cache object stands in for a later run
+    second = StudyCache(cache_dir).load(load_lines, input_file)
+    assert first == second == ['a', 'b']
+    assert calls == [input_file]
+    # the recorded size and mtime are enough to know the file has not changed
+    assert hashed == [os.path.abspath(input_file)]
+
+
+def test_options_are_cached_separately(tmp_path, input_file):
+    cache = StudyCache(str(tmp_path / 'cache'))
+    assert cache.load(load_lines, input_file) == ['a', 'b']
+    assert cache.load(load_lines, input_file, strip=False) == ['a\n', 'b\n']
+    assert len(calls) == 2
+
+
+def test_changed_contents_are_parsed_again(tmp_path, input_file):
+    cache_dir = str(tmp_path / 'cache')
+    assert StudyCache(cache_dir).load(load_lines, input_file) == ['a', 'b']
+    mtime_ns = os.stat(input_file).st_mtime_ns
+    with open(input_file, 'w') as fh:
+        fh.write('c\nd\n')
+    set_mtime(input_file, mtime_ns + 1000000000)
+
+    assert StudyCache(cache_dir).load(load_lines, input_file) == ['c', 'd']
+    assert calls == [input_file, input_file]
+    # the entry for the previous contents is dropped
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.pkl')]) == 1
+
+
+def test_changed_mtime_forces_the_file_to_be_checked(tmp_path, input_file, hashed):
+    cache_dir = str(tmp_path / 'cache')
+    StudyCache(cache_dir).load(load_lines, input_file)
+    mtime_ns = os.stat(input_file).st_mtime_ns
+
+    # touched without changing the contents: hashed again but still served from the cache
+    set_mtime(input_file, mtime_ns + 1000000000)
+    assert StudyCache(cache_dir).load(load_lines, input_file) == ['a', 'b']
+    assert len(hashed) == 2
+    assert calls == [input_file]
+
+    # same size, new contents: only the new mtime tells the cache to look at the file again
+    with open(input_file, 'w') as fh:
+        fh.write('x\ny\n')
+    set_mtime(input_file, mtime_ns + 2000000000)
+    assert StudyCache(cache_dir).load(load_lines, input_file) == ['x', 'y']
+    assert len(hashed) == 3
+    assert calls == [input_file, input_file]
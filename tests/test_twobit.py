@@ -0,0 +1,25 @@
+import numpy
+import pytest
+
+from modules.twobit import GenomeStore, build_genome_store, decode
+
+
+@pytest.fixture
+def store(tmp_path):
+    fasta = tmp_path / 'genome.fa'
+    fasta.write_text('>chr1\nACGTacgtNN\nac-*GT\n>chr2\nggggCCCCnn\n')
+    return GenomeStore.open(build_genome_store(str(fasta), str(tmp_path / 'store'), chunk_bases=4))
+
+
+def test_fetch(store):
+    assert decode(store.fetch('chr1')) == 'ACGTACGTNNACNNGT'
+    assert decode(store.fetch('chr2', 2, 6)) == 'GGCC'
+
+
+def test_soft_mask(store):
+    codes, masked = store.extract(['chr1', 'chr2'], [0, 0], 10, soft_mask=True)
+    assert decode(codes[0], masked[0]) == 'ACGTacgtNN'
+    assert decode(codes[1], masked[1]) == 'ggggCCCCnn'
+    # '-' and '*' are not lowercase letters, so they are not soft-masked
+    codes, offsets, masked = store.extract_regions(['chr1'], [10], [16], soft_mask=True)
+    numpy.testing.assert_array_equal(masked, [True, True, False, False, False, False])